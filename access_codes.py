@@ -0,0 +1,72 @@
+import threading
+
+from database import db_connection
+
+OTP = 'otp'
+SPECIAL = 'special'
+
+
+class AccessCodeIndex:
+    """
+    In-memory hash map of active pickup codes (lockers.otp_code and
+    lockers.special_code) to locker ids.
+    Subscribed to the LockerStore so committed writes to those columns keep
+    the map coherent with the database, and customer_pickup can resolve or
+    reject a code without querying SQLite. OTPs take precedence over special
+    codes.
+    """
+    def __init__(self):
+        self._codes = {OTP: {}, SPECIAL: {}}  # kind -> {code: locker_id}
+        self._by_locker = {OTP: {}, SPECIAL: {}}  # kind -> {locker_id: code}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """(Re)build the map from the lockers table."""
+        with db_connection() as conn:
+            rows = conn.execute('''SELECT id, otp_code, special_code FROM lockers
+                WHERE otp_code IS NOT NULL OR special_code IS NOT NULL''').fetchall()
+
+        codes = {OTP: {}, SPECIAL: {}}
+        by_locker = {OTP: {}, SPECIAL: {}}
+        for row in rows:
+            for kind, code in ((OTP, row['otp_code']), (SPECIAL, row['special_code'])):
+                if code:
+                    codes[kind][code] = row['id']
+                    by_locker[kind][row['id']] = code
+        with self._lock:
+            self._codes = codes
+            self._by_locker = by_locker
+
+    def lookup(self, code):
+        """Return (locker_id, kind) for an active code, or None."""
+        with self._lock:
+            for kind in (OTP, SPECIAL):
+                locker_id = self._codes[kind].get(code)
+                if locker_id is not None:
+                    return locker_id, kind
+        return None
+
+    def is_active(self, code):
+        with self._lock:
+            return code in self._codes[OTP] or code in self._codes[SPECIAL]
+
+    def sync(self, record, changes, version):
+        """LockerStore listener: follow committed otp_code/special_code changes."""
+        if 'otp_code' in changes:
+            self.set_code(record.id, OTP, changes['otp_code'])
+        if 'special_code' in changes:
+            self.set_code(record.id, SPECIAL, changes['special_code'])
+
+    def set_code(self, locker_id, kind, code):
+        """Record that locker_id's code of this kind is now code (None clears it)."""
+        with self._lock:
+            old = self._by_locker[kind].pop(locker_id, None)
+            if old is not None and self._codes[kind].get(old) == locker_id:
+                del self._codes[kind][old]
+            if code:
+                self._codes[kind][code] = locker_id
+                self._by_locker[kind][locker_id] = code
+
+
+# Shared by all routes in this process
+code_index = AccessCodeIndex()
@@ -0,0 +1,194 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+from metrics import locker_actuations, locker_actuation_failures
+
+# Command priorities, lowest runs first (FIFO within a priority)
+PRIORITY_RECONFIGURE = -1  # Swap hardware before anything else is actuated
+PRIORITY_PICKUP = 0        # Customer waiting at the door
+PRIORITY_DELIVERY = 1      # Courier opening an empty locker
+PRIORITY_DIAGNOSTIC = 2    # Admin and test actions
+
+# Solenoids energised at once (None = unlimited); each one draws about 1 A
+DEFAULT_MAX_CONCURRENT_PULSES = 2
+
+
+class _Command:
+    __slots__ = ('priority', 'seq', 'run', 'future', 'locker_id', 'superseded')
+
+    def __init__(self, priority, seq, run, future, locker_id=None):
+        self.priority = priority
+        self.seq = seq
+        self.run = run
+        self.future = future
+        self.locker_id = locker_id  # Set for open commands
+        self.superseded = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class HardwareActuator:
+    """
+    Single owner of the hardware's outputs.
+    Request threads never pulse a solenoid or rewire the hardware themselves:
+    they queue a command and get a Future back, and one actuator thread runs
+    the commands in priority order. Reads happen elsewhere: the health thread
+    checks the expanders, and door sensors without an INT line are read by
+    whichever thread asks DoorMonitor.current_states() (request threads
+    included). Those share the I2C buses, which serialise each transaction
+    (see InstrumentedBus). Opening a locker that already has an open queued returns the queued
+    command's Future (raised to the higher priority) instead of a second
+    pulse. reconfigure() and replace() run between two commands, so no
+    command runs against a half-applied configuration.
+    At most max_concurrent_pulses solenoids are energised at once: the next
+    open waits in the queue until a running pulse is released, while other
+    commands keep running.
+    """
+    def __init__(self, hw, max_concurrent_pulses=DEFAULT_MAX_CONCURRENT_PULSES):
+        self.hardware = hw
+        self.max_concurrent_pulses = max_concurrent_pulses
+        self._active_pulses = 0
+        self._heap = []
+        self._queued_opens = {}  # locker_id -> _Command not started yet
+        self._swap_listeners = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='hardware-actuator', daemon=True)
+        self._thread.start()
+
+    def subscribe_swap(self, callback):
+        """callback(hw) on the actuator thread after the hardware is replaced or rewired."""
+        self._swap_listeners.append(callback)
+
+    def _push(self, priority, run, future=None, locker_id=None):
+        command = _Command(priority, next(self._seq), run, future or Future(), locker_id)
+        heapq.heappush(self._heap, command)
+        self._cond.notify()
+        return command
+
+    def submit(self, fn, priority=PRIORITY_DIAGNOSTIC):
+        """Run fn(hardware) on the actuator thread. Returns a Future of its result."""
+        with self._cond:
+            return self._push(priority, fn).future
+
+    def open_locker(self, locker_id, priority=PRIORITY_DELIVERY):
+        """
+        Queue a solenoid pulse. The Future resolves when the relay is released,
+        with None if the locker cannot be actuated.
+        """
+        with self._cond:
+            queued = self._queued_opens.get(locker_id)
+            if queued is not None:
+                if priority < queued.priority:
+                    # Re-queue at the higher priority; the old heap entry is skipped
+                    queued.superseded = True
+                    queued = self._push(priority, queued.run, queued.future, locker_id)
+                    self._queued_opens[locker_id] = queued
+                return queued.future
+            command = self._push(priority, lambda hw: hw.open_locker(locker_id), locker_id=locker_id)
+            self._queued_opens[locker_id] = command
+            return command.future
+
+    def reconfigure(self, locker_config):
+        """
+        Rewire the current hardware in place (hw.reconfigure) before the next
+        queued command. Returns a Future of the changed locker ids.
+        """
+        def rewire(hw):
+            changed = hw.reconfigure(locker_config)
+            if changed:
+                self._swap(hw)
+            return changed
+        with self._cond:
+            return self._push(PRIORITY_RECONFIGURE, rewire).future
+
+    def replace(self, factory):
+        """
+        Build a new hardware instance with factory() on the actuator thread and
+        swap it in before the next queued command. Returns a Future of the new
+        instance; if factory() fails the current hardware stays in place.
+        """
+        with self._cond:
+            return self._push(PRIORITY_RECONFIGURE, lambda hw: self._swap(factory())).future
+
+    def _swap(self, hw):
+        old, self.hardware = self.hardware, hw
+        if old is not hw and hasattr(old, 'close'):
+            old.close()
+        for callback in list(self._swap_listeners):
+            try:
+                callback(hw)
+            except Exception as e:
+                print(f"[Actuator] Swap listener failed: {e}")
+        return hw
+
+    @property
+    def queue_depth(self):
+        with self._cond:
+            return sum(1 for command in self._heap if not command.superseded)
+
+    @property
+    def active_pulses(self):
+        return self._active_pulses
+
+    def _pulse_budget_spent(self):
+        return self.max_concurrent_pulses is not None and self._active_pulses >= self.max_concurrent_pulses
+
+    def _release_pulse(self):
+        with self._cond:
+            self._active_pulses -= 1
+            self._cond.notify()
+
+    def _next_command(self):
+        # Called with self._cond held. An open at the head of the queue waits
+        # for the pulse budget; anything ahead of it in priority still runs.
+        while True:
+            while self._heap and self._heap[0].superseded:
+                heapq.heappop(self._heap)
+            if self._heap and not (self._heap[0].locker_id is not None and self._pulse_budget_spent()):
+                command = heapq.heappop(self._heap)
+                if command.locker_id is not None:
+                    del self._queued_opens[command.locker_id]
+                    self._active_pulses += 1
+                return command
+            self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                command = self._next_command()
+
+            try:
+                result = command.run(self.hardware)
+            except Exception as e:
+                print(f"[Actuator] Command failed: {e}")
+                if command.locker_id is not None:
+                    self._release_pulse()
+                    locker_actuation_failures.inc(command.locker_id)
+                command.future.set_exception(e)
+                continue
+
+            if command.locker_id is not None and isinstance(result, Future):
+                locker_actuations.inc(command.locker_id)
+                # Resolve (and free the budget) once the pulse scheduler releases the relay
+                result.add_done_callback(lambda pulse, future=command.future: self._pulse_done(pulse, future))
+            else:
+                if command.locker_id is not None:
+                    self._release_pulse()
+                    locker_actuation_failures.inc(command.locker_id)
+                command.future.set_result(result)
+
+    def _pulse_done(self, pulse, future):
+        self._release_pulse()
+        _copy_result(pulse, future)
+
+
+def _copy_result(source, target):
+    error = source.exception()
+    if error is not None:
+        target.set_exception(error)
+    else:
+        target.set_result(source.result())
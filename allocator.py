@@ -0,0 +1,154 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+from database import db_connection
+from locker_store import locker_store
+
+# Parcel size classes, smallest first
+SIZES = ('S', 'M', 'L')
+DEFAULT_SIZE = 'M'
+
+# Columns that decide whether and where a locker sits in the free lists
+_ALLOCATION_COLUMNS = {'is_occupied', 'state', 'special_code', 'size', 'hardware_type', 'mcp_address', 'i2c_bus'}
+
+
+def _in_use(record):
+    # Occupied, or in the middle of a delivery or pickup (see occupancy.py)
+    return bool(record.is_occupied) or (record.state or 'idle') != 'idle'
+
+
+def locker_size(record):
+    return record.size if record.size in SIZES else DEFAULT_SIZE
+
+
+def locker_chip(record):
+    """Expander a locker's solenoid hangs off: (bus, address), or ('pi',) for Pi GPIO."""
+    if record.hardware_type == 'mcp':
+        return (record.i2c_bus or 1, record.mcp_address or 0x20)
+    return ('pi',)
+
+
+class LockerAllocator:
+    """
+    Picks a free locker for a parcel without scanning the lockers.
+    Free lockers are kept per size class and per chip, each list in the
+    order the lockers became free:
+    - best fit: the smallest size class that fits the parcel and has a
+      free locker is used, larger ones only when it is full
+    - wear-leveling: the locker free for longest goes first, so deliveries
+      rotate over every solenoid (at startup, least used first)
+    - spread_chips: the chip with the most free lockers of that size is
+      used first, so an expander failing takes out as few parcels as
+      possible; otherwise the locker free for longest across chips wins
+    A picked locker is reserved until the delivery commits (the LockerStore
+    listener sees it leave the idle state) or release() hands it back, so
+    concurrent couriers never get the same locker. Lockers with a special
+    code are kept for their code holder and never picked.
+    """
+    def __init__(self, store, spread_chips=True):
+        self.store = store
+        self.spread_chips = spread_chips
+        self._free = {size: {} for size in SIZES}  # size -> {chip: OrderedDict(locker_id -> freed stamp)}
+        self._where = {}  # locker_id -> (size, chip) while free
+        self._reserved = set()
+        self._stamp = itertools.count()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """(Re)build the free lists from the locker store, least used lockers first."""
+        with db_connection() as conn:
+            uses = dict(conn.execute('SELECT locker_id, count(*) FROM otp_codes GROUP BY locker_id').fetchall())
+        with self._lock:
+            self._free = {size: {} for size in SIZES}
+            self._where = {}
+            self._reserved = set()
+            for record in sorted(self.store.all(), key=lambda r: (uses.get(r.id, 0), r.id)):
+                if self._allocatable(record):
+                    self._add(record)
+
+    def _allocatable(self, record):
+        return not _in_use(record) and not record.special_code and record.id not in self._reserved
+
+    def _add(self, record):
+        size, chip = locker_size(record), locker_chip(record)
+        self._free[size].setdefault(chip, OrderedDict())[record.id] = next(self._stamp)
+        self._where[record.id] = (size, chip)
+
+    def _remove(self, locker_id):
+        where = self._where.pop(locker_id, None)
+        if where is None:
+            return
+        size, chip = where
+        lockers = self._free[size][chip]
+        del lockers[locker_id]
+        if not lockers:
+            del self._free[size][chip]
+
+    def _pick_chip(self, chips):
+        def oldest(chip):
+            return next(iter(chips[chip].values()))
+        if self.spread_chips:
+            return max(chips, key=lambda chip: (len(chips[chip]), -oldest(chip)))
+        return min(chips, key=oldest)
+
+    def allocate(self, size=DEFAULT_SIZE, exact=False):
+        """
+        Reserve a free locker for a parcel of this size class (exact=False
+        also accepts larger lockers). Returns the locker id, or None if
+        nothing fits.
+        """
+        if size not in SIZES:
+            raise ValueError(f"Unknown locker size {size!r}")
+        sizes = (size,) if exact else SIZES[SIZES.index(size):]
+        with self._lock:
+            for candidate in sizes:
+                chips = self._free[candidate]
+                if chips:
+                    locker_id = next(iter(chips[self._pick_chip(chips)]))
+                    self._remove(locker_id)
+                    self._reserved.add(locker_id)
+                    return locker_id
+        return None
+
+    def reserve(self, locker_id):
+        """Reserve a specific locker (courier's own choice). False if in use or already reserved."""
+        with self._lock:
+            record = self.store.get(locker_id)
+            if record is None or _in_use(record) or locker_id in self._reserved:
+                return False
+            self._remove(locker_id)
+            self._reserved.add(locker_id)
+            return True
+
+    def release(self, locker_id):
+        """Hand back a reservation that was not committed (no-op once it was)."""
+        with self._lock:
+            if locker_id not in self._reserved:
+                return
+            self._reserved.discard(locker_id)
+            record = self.store.get(locker_id)
+            if record is not None and self._allocatable(record):
+                self._add(record)
+
+    def sync(self, record, changes, version):
+        """LockerStore listener: follow committed occupancy, size and wiring changes."""
+        if not _ALLOCATION_COLUMNS.intersection(changes):
+            return
+        with self._lock:
+            if _in_use(record):
+                self._reserved.discard(record.id)  # The delivery committed
+            if not self._allocatable(record):
+                self._remove(record.id)
+            elif self._where.get(record.id) != (locker_size(record), locker_chip(record)):
+                self._remove(record.id)
+                self._add(record)
+
+    def free_counts(self):
+        """{size: free lockers} (reserved lockers excluded)."""
+        with self._lock:
+            return {size: sum(len(lockers) for lockers in chips.values()) for size, chips in self._free.items()}
+
+
+# Shared by all routes in this process
+allocator = LockerAllocator(locker_store)
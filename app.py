@@ -1,121 +1,112 @@
 from flask import Flask, session
 from database import init_db
+from access_codes import code_index
+from locker_store import locker_store
+from audit import audit_log
+from allocator import allocator
 from hardware import get_hardware
+from actuator import HardwareActuator
+from door_monitor import DoorMonitor
+from occupancy import OccupancyTracker
+from rate_limit import AttemptLimiter
+from i18n import catalog
+from profiling import RequestProfiler
 
 # Configuration
 USE_MOCK_HARDWARE = True # Set to False for real Raspberry Pi
+USE_SIMULATOR = False # Run on simulated MCP23017 lockers with I2C latency and door timing (load testing)
+LOCKER_COUNT = 32 # Lockers in this bank (extra lockers are added with default MCP wiring)
+MCP_INT_GPIO = None # BCM pin wired to MCP23017 INTA/INTB for door interrupts (None = not wired)
+MAX_CONCURRENT_PULSES = 2 # Solenoids energised at once, sized to the 12 V supply (None = no limit)
+ALLOCATE_ACROSS_CHIPS = True # Automatic allocation spreads parcels over the MCP23017 expanders
+DOOR_OPEN_TIMEOUT_S = 15 # A delivery/pickup whose door has not opened this long after the pulse is rolled back
+OTP_LIFETIME_HOURS = 72 # Uncollected codes expire and the parcel is due for courier return (None = never)
+MAX_OTP_LIFETIME_HOURS = 24 * 90 # Longest lifetime_hours a delivery request may ask for
+PIN_ATTEMPTS_PER_MINUTE = 5 # Courier PIN guesses per client (burst of 5), checked before the database
+CODE_ATTEMPTS_PER_MINUTE = 10 # Pickup code guesses per client (burst of 10)
+GLOBAL_ATTEMPTS_PER_MINUTE = 120 # PIN or pickup code guesses across all clients, per form
+LOCKOUT_AFTER_FAILURES = 5 # Consecutive wrong guesses before a lockout (30 s, doubling up to 15 min)
+AUDIT_FLUSH_INTERVAL_S = 0.5 # Audit events reach audit/ in batches at most this late (one fsync per batch)
+PROFILE_SAMPLE_RATE = 0.0 # Fraction of requests profiled, results in /metrics (0 = off, 0.05 = 1 in 20)
+PROFILE_SLOW_MS = 500 # Sampled requests slower than this save a cProfile snapshot
+PROFILE_DIR = 'profiles' # Where slow-request snapshots are written
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey' # Change for production
-
-# Translations
-TRANSLATIONS = {
-    'fr': {
-        'title': 'Système de Casier Intelligent',
-        'delivery': 'Retirer',
-        'pickup': 'Récupérer',
-        'login_title': 'Connexion Livreur',
-        'enter_pin': 'Entrez le PIN',
-        'back': 'Retour',
-        'pickup_title': 'Retrait Client',
-        'enter_otp': 'Entrez le Code OTP',
-        'select_locker': 'Sélectionnez un Casier',
-        'logout': 'Déconnexion',
-        'door_open': 'PORTE OUVERTE',
-        'occupied': 'Occupé',
-        'available': 'Disponible',
-        'locker_opened': 'Casier Ouvert !',
-        'generated_otp': 'Code OTP Généré :',
-        'place_package': 'Veuillez déposer le colis et fermer la porte.',
-        'take_package': 'Veuillez récupérer votre colis et fermer la porte.',
-        'done': 'Terminé',
-        'error': 'Erreur',
-        'invalid_pin': 'PIN Invalide',
-        'invalid_otp': 'OTP Invalide',
-        'locker_not_found': 'Casier introuvable',
-        'request_failed': 'Échec de la requête',
-        'confirm_open': 'Ouvrir le casier',
-        'already_occupied': 'Ce casier est déjà occupé !',
-        'configuration': 'Configuration',
-        'locker_config': 'Configuration des Casiers',
-        'special_code': 'Code Spécial',
-        'save': 'Enregistrer',
-        'cancel': 'Annuler'
-    },
-    'ar': {
-        'title': 'نظام الخزائن الذكية',
-        'delivery': 'سحب',
-        'pickup': 'استلام',
-        'login_title': 'تسجيل دخول المندوب',
-        'enter_pin': 'أدخل الرمز السري',
-        'back': 'رجوع',
-        'pickup_title': 'استلام العميل',
-        'enter_otp': 'أدخل رمز التحقق',
-        'select_locker': 'اختر خزانة',
-        'logout': 'خروج',
-        'door_open': 'الباب مفتوح',
-        'occupied': 'مشغول',
-        'available': 'متاح',
-        'locker_opened': 'تم فتح الخزانة!',
-        'generated_otp': 'رمز التحقق الجديد:',
-        'place_package': 'يرجى وضع الطرد وإغلاق الباب.',
-        'take_package': 'يرجى أخذ الطرد وإغلاق الباب.',
-        'done': 'تم',
-        'error': 'خطأ',
-        'invalid_pin': 'رمز خاطئ',
-        'invalid_otp': 'رمز تحقق خاطئ',
-        'locker_not_found': 'الخزانة غير موجودة',
-        'request_failed': 'فشل الطلب',
-        'confirm_open': 'فتح الخزانة',
-        'already_occupied': 'هذه الخزانة مشغولة بالفعل!',
-        'configuration': 'الإعدادات',
-        'locker_config': 'إعداد الخزائن',
-        'special_code': 'رمز خاص',
-        'save': 'حفظ',
-        'cancel': 'إلغاء'
-    }
-}
+RequestProfiler(app, sample_rate=PROFILE_SAMPLE_RATE, slow_ms=PROFILE_SLOW_MS, output_dir=PROFILE_DIR)
 
 @app.context_processor
 def inject_conf_var():
-    lang = session.get('lang', 'fr')
-    return dict(lang=lang, t=TRANSLATIONS, dir='rtl' if lang == 'ar' else 'ltr')
+    language = catalog.get(session.get('lang'))
+    # Only the active language's strings are handed to the template
+    return dict(lang=language.code, t={language.code: language.strings}, dir=language.dir,
+                languages=catalog.languages)
+
+# UI strings from translations/*.json
+catalog.load()
 
 # Initialize Database
-init_db()
+init_db(locker_count=LOCKER_COUNT)
+
+# Lockers are served from memory; the code index and free lists follow committed changes
+locker_store.load()
+# Audit trail: a snapshot at every start, then every committed locker change
+audit_log.flush_interval_s = AUDIT_FLUSH_INTERVAL_S
+audit_log.open()
+audit_log.snapshot(locker_store)
+locker_store.subscribe(audit_log.locker_changed)
+code_index.load()
+locker_store.subscribe(code_index.sync)
+allocator.spread_chips = ALLOCATE_ACROSS_CHIPS
+allocator.load()
+locker_store.subscribe(allocator.sync)
 
-# Load locker configuration from database
+# Load locker configuration from the locker store
 def load_locker_config():
-    from database import get_db_connection
-    conn = get_db_connection()
-    lockers = conn.execute('SELECT id, hardware_type, gpio_pin, sensor_pin FROM lockers').fetchall()
-    conn.close()
-    
     config = {}
-    for locker in lockers:
-        locker_id = locker['id']
-        hw_type = locker['hardware_type'] if locker['hardware_type'] else 'pi'
-        gpio_pin = locker['gpio_pin']
-        # sqlite3.Row doesn't have .get(), use try/except or check if column exists
-        try:
-            sensor_pin = locker['sensor_pin']
-        except (KeyError, IndexError):
-            sensor_pin = None
-        
-        config[locker_id] = {
-            'type': hw_type,
-            'pin': gpio_pin if gpio_pin is not None else 4,
-            'sensor_pin': sensor_pin
+    for locker in locker_store.all():
+        config[locker.id] = {
+            'type': locker.hardware_type or 'pi',
+            'pin': locker.gpio_pin if locker.gpio_pin is not None else 4,
+            'sensor_pin': locker.sensor_pin,
+            'pulse_ms': locker.pulse_ms,  # None -> hardware default
+            'address': locker.mcp_address,  # MCP only; None -> 0x20
+            'bus': locker.i2c_bus  # MCP only; None -> bus 1
         }
     
     return config
 
 # Initialize Hardware with configuration
 locker_config = load_locker_config() if not USE_MOCK_HARDWARE else None
-hardware = get_hardware(use_mock=USE_MOCK_HARDWARE, locker_config=locker_config)
+hardware = get_hardware(use_mock=USE_MOCK_HARDWARE, locker_config=locker_config, locker_count=LOCKER_COUNT,
+                        simulate=USE_SIMULATOR)
+# All actuation goes through the actuator thread, which owns the hardware from here on
+actuator = HardwareActuator(hardware, max_concurrent_pulses=MAX_CONCURRENT_PULSES)
+door_monitor = DoorMonitor(int_pin=MCP_INT_GPIO)
+# Brute-force throttling for the PIN and pickup code forms
+login_limiter = AttemptLimiter('login', per_minute=PIN_ATTEMPTS_PER_MINUTE, burst=PIN_ATTEMPTS_PER_MINUTE,
+                               global_per_minute=GLOBAL_ATTEMPTS_PER_MINUTE, lockout_after=LOCKOUT_AFTER_FAILURES)
+code_limiter = AttemptLimiter('pickup', per_minute=CODE_ATTEMPTS_PER_MINUTE, burst=CODE_ATTEMPTS_PER_MINUTE,
+                              global_per_minute=GLOBAL_ATTEMPTS_PER_MINUTE, lockout_after=LOCKOUT_AFTER_FAILURES)
+# Occupancy follows the door sensors (delivery/pickup state machine)
+occupancy = OccupancyTracker(locker_store, door_monitor, open_timeout_s=DOOR_OPEN_TIMEOUT_S,
+                             otp_lifetime_s=OTP_LIFETIME_HOURS * 3600 if OTP_LIFETIME_HOURS else None)
 
 # Import routes after app initialization to avoid circular imports
 from routes import *
 
+# Door sensors push open/close events; keep lockers.door_closed in sync
+def persist_door_event(locker_id, closed):
+    update_locker_status(locker_id, door_closed=1 if closed else 0)
+
+door_monitor.subscribe(persist_door_event)
+door_monitor.subscribe(lambda locker_id, closed: audit_log.record('door', locker_id, closed=closed))
+door_monitor.attach(hardware)
+actuator.subscribe_swap(door_monitor.attach)
+occupancy.start()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only (production: serve.py). The reloader is off
+    # because it re-imports this module in a second process that would also
+    # try to drive the hardware.
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
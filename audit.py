@@ -0,0 +1,280 @@
+"""
+Append-only audit log of everything that happens to the lockers:
+
+    python3 audit.py replay                  # rebuild lockers from the log, show what differs
+    python3 audit.py replay --until 2026-10-01T18:00 --write   # restore (app stopped)
+
+Events are JSON lines {"seq", "ts", "kind", "locker_id", ...} in
+audit/current.jsonl, moved into one gzip segment per day
+(audit/YYYY-MM-DD.jsonl.gz) once the day is over.
+"""
+import argparse
+import atexit
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+from metrics import audit_events, audit_flush_seconds
+
+AUDIT_DIR = 'audit'
+ACTIVE_LOG = 'current.jsonl'
+FLUSH_INTERVAL_S = 0.5  # An event is on disk at most this long after it happened
+BATCH_SIZE = 256  # Events written per flush at most
+IDLE_CHECK_S = 60  # How often an idle writer checks whether a day is over
+
+
+def _day(ts):
+    return time.strftime('%Y-%m-%d', time.localtime(ts))
+
+
+def _read_lines(lines):
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue  # Torn last line after a power cut
+
+
+class AuditLog:
+    """
+    Group-commit writer for the audit log. record() only queues the event,
+    so request threads never wait for the disk; the writer thread collects
+    events for up to flush_interval_s (or batch_size events), writes them
+    with a single write and one fsync, and after a day boundary moves the
+    finished days out of the active log into daily segments.
+    Every event carries a sequence number; readers skip numbers they have
+    already seen, so a compaction cut short by a power cut only leaves
+    harmless duplicates behind.
+    """
+    def __init__(self, flush_interval_s=FLUSH_INTERVAL_S, batch_size=BATCH_SIZE):
+        self.flush_interval_s = flush_interval_s
+        self.batch_size = batch_size
+        self.directory = None
+        self._queue = queue.Queue()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._active_day = None  # Day of the oldest event in the active log
+        self._thread = None
+
+    def open(self, directory=None):
+        """Resume numbering from the existing log and start the writer thread."""
+        self.directory = directory or AUDIT_DIR
+        os.makedirs(self.directory, exist_ok=True)
+        last = None
+        for event in self._read_active():
+            last = event
+            self._active_day = self._active_day or _day(event['ts'])
+        if last is None:
+            segments = self.segments()
+            if segments:
+                for event in self._read_segment(segments[-1]):
+                    last = event
+        self._seq = last['seq'] if last else 0
+        self._thread = threading.Thread(target=self._run, name='audit', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)  # The last batch is not lost on a clean exit
+        print(f"[Audit] Logging to {self.directory} (last event #{self._seq})")
+
+    @property
+    def active_path(self):
+        return os.path.join(self.directory, ACTIVE_LOG)
+
+    # --- Recording (any thread) ---
+
+    def record(self, kind, locker_id=None, **data):
+        """Queue an event; it reaches the disk with the next batch."""
+        with self._lock:
+            self._seq += 1
+            event = {'seq': self._seq, 'ts': round(time.time(), 3), 'kind': kind, 'locker_id': locker_id}
+            # Queued under the lock so the log stays in sequence order
+            event.update(data)
+            self._queue.put(event)
+
+    def snapshot(self, store):
+        """Record every locker's full row, the starting point for replay."""
+        self.record('snapshot', lockers=[record.to_dict() for record in store.all()])
+
+    def locker_changed(self, record, changes, version):
+        """LockerStore listener: every committed change, in commit order."""
+        self.record('locker', record.id, changes=changes)
+
+    def flush(self, timeout=5):
+        """Wait until everything recorded so far is on disk (tests, shutdown)."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    # --- Writer thread ---
+
+    def _run(self):
+        while True:
+            batch, waiters = [], []
+            try:
+                item = self._queue.get(timeout=IDLE_CHECK_S)
+            except queue.Empty:
+                item = None  # Nothing happening; still compact after midnight
+            deadline = time.monotonic() + self.flush_interval_s
+            while item is not None:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    if not batch:
+                        break
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size or waiters:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            try:
+                if batch:
+                    self._write(batch)
+                if self._active_day and self._active_day < _day(time.time()):
+                    self.compact()
+            except OSError as e:
+                print(f"[Audit] Failed to write {len(batch)} events: {e}")
+            for waiter in waiters:
+                waiter.set()
+
+    def _write(self, batch):
+        with audit_flush_seconds.time():
+            data = ''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in batch)
+            with open(self.active_path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self._active_day = self._active_day or _day(batch[0]['ts'])
+        for event in batch:
+            audit_events.inc(event['kind'])
+
+    def compact(self):
+        """Move finished days from the active log into their daily segments."""
+        today = _day(time.time())
+        by_day = {}
+        for event in self._read_active():
+            by_day.setdefault(_day(event['ts']), []).append(event)
+        for day in sorted(day for day in by_day if day < today):
+            # Appending adds a gzip member; readers see one stream
+            data = ''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in by_day[day])
+            with open(os.path.join(self.directory, f'{day}.jsonl.gz'), 'ab') as f:
+                f.write(gzip.compress(data.encode('utf-8')))
+                f.flush()
+                os.fsync(f.fileno())
+        remaining = by_day.get(today, [])
+        tmp_path = self.active_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(event, separators=(',', ':')) + '\n' for event in remaining)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.active_path)
+        self._active_day = today if remaining else None
+        print(f"[Audit] Compacted {sum(len(by_day[day]) for day in by_day if day < today)} events into daily segments")
+
+    # --- Reading ---
+
+    def segments(self):
+        """Daily segment files, oldest first."""
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.endswith('.jsonl.gz'))
+
+    def _read_segment(self, path):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                yield from _read_lines(f)
+        except (EOFError, gzip.BadGzipFile):
+            pass  # Member cut short by a power cut; its events are still in the active log
+
+    def _read_active(self):
+        if os.path.exists(self.active_path):
+            with open(self.active_path, encoding='utf-8') as f:
+                yield from _read_lines(f)
+
+    def events(self):
+        """Every event on disk in sequence order, without duplicates."""
+        last = 0
+        for path in self.segments():
+            for event in self._read_segment(path):
+                if event['seq'] > last:
+                    last = event['seq']
+                    yield event
+        for event in self._read_active():
+            if event['seq'] > last:
+                last = event['seq']
+                yield event
+
+
+def replay(events, until=None):
+    """
+    Rebuild {locker_id: row} from events: start at the last snapshot at or
+    before until (a Unix time; None = everything) and apply the locker
+    changes after it.
+    """
+    lockers = None
+    for event in events:
+        if until is not None and event['ts'] > until:
+            break
+        if event['kind'] == 'snapshot':
+            lockers = {row['id']: dict(row) for row in event['lockers']}
+        elif event['kind'] == 'locker' and lockers is not None:
+            lockers.setdefault(event['locker_id'], {'id': event['locker_id']}).update(event['changes'])
+    return lockers or {}
+
+
+# Shared by all routes in this process
+audit_log = AuditLog()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Smart locker audit log tools.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='rebuild the lockers table from the audit log')
+    replay_parser.add_argument('--dir', default=AUDIT_DIR, help='audit log directory')
+    replay_parser.add_argument('--db', help='database file (default smartlocker.db)')
+    replay_parser.add_argument('--until', help='stop at this local time (YYYY-MM-DDTHH:MM[:SS])')
+    replay_parser.add_argument('--write', action='store_true',
+                               help='write the rebuilt rows to the database (stop the app first)')
+    args = parser.parse_args(argv)
+
+    import database
+    from database import db_connection
+    from locker_store import COLUMNS
+
+    if args.db:
+        database.DB_NAME = args.db
+
+    log = AuditLog()
+    log.directory = args.dir
+    until = None
+    if args.until:
+        fmt = '%Y-%m-%dT%H:%M:%S' if args.until.count(':') == 2 else '%Y-%m-%dT%H:%M'
+        until = time.mktime(time.strptime(args.until, fmt))
+    lockers = replay(log.events(), until)
+    if not lockers:
+        print("[Audit] No snapshot in the log, nothing to replay")
+        return 1
+
+    with db_connection() as conn:
+        current = {row['id']: dict(row) for row in conn.execute(f"SELECT {', '.join(COLUMNS)} FROM lockers")}
+        differences = 0
+        for locker_id, row in sorted(lockers.items()):
+            changed = {name: value for name, value in row.items()
+                       if name in COLUMNS and current.get(locker_id, {}).get(name) != value}
+            if changed:
+                differences += 1
+                print(f"Locker {locker_id}: " + ', '.join(
+                    f"{name} {current.get(locker_id, {}).get(name)!r} -> {value!r}" for name, value in changed.items()))
+                if args.write and locker_id in current:
+                    conn.execute(f"UPDATE lockers SET {', '.join(f'{name} = ?' for name in changed)} WHERE id = ?",
+                                 (*changed.values(), locker_id))
+        print(f"[Audit] {len(lockers)} lockers replayed, {differences} differ from the database"
+              + (' (written)' if args.write and differences else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
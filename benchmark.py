@@ -0,0 +1,321 @@
+"""
+End-to-end benchmarks of the kiosk request paths:
+
+    python3 benchmark.py                            # writes benchmarks/<time>.json
+    python3 benchmark.py --compare benchmarks/baseline.json
+
+Drives the Flask app through its test client (no sockets) on the hardware
+simulator, so requests pay simulated I2C latency for door reads and
+solenoid pulses, with concurrent clients each running their own
+test client on a thread. Every scenario reports throughput and p50/p99
+latency. --compare exits with status 1 when a scenario's p99 or
+throughput is more than --tolerance worse than in the given results file.
+Runs against a throwaway database and audit log, never smartlocker.db.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+
+import audit
+import database
+
+# Defaults
+CLIENTS = 8
+REQUESTS = 400  # Per scenario, across all clients
+WARMUP = 20  # Untimed requests per scenario before measuring
+TOLERANCE = 0.25  # Allowed relative regression in p99 and throughput
+BENCHMARK_DIR = 'benchmarks'
+BENCHMARK_DB = 'benchmark_smartlocker.db'
+BENCHMARK_AUDIT_DIR = 'benchmark_audit'
+# Short door cycles so lockers are free again quickly: pulses just long enough
+# to unlatch, and customers who close the door right away (but only after
+# the pulse, when the sensors are read: they have no interrupt line)
+BENCHMARK_PULSE_MS = 200
+BENCHMARK_CLOSE_DELAY_S = (0.1, 0.2)
+BENCHMARK_DOOR_RECHECK_S = 0.02  # Simulated sensors have no interrupt line
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Scenario:
+    """
+    One request path. request(client, n, prepared) issues the n-th timed
+    request and returns the response; prepare(client, n), if given, runs
+    untimed before it and its result is passed as prepared.
+    """
+    def __init__(self, name, request, prepare=None):
+        self.name = name
+        self.request = request
+        self.prepare = prepare
+
+
+def build_scenarios(locker_count):
+    from locker_store import locker_store
+    from occupancy import IDLE, OCCUPIED
+
+    claimed = set()
+    claim_lock = threading.Lock()
+
+    def locker_for(n):
+        return n % locker_count + 1
+
+    def wait_for_state(locker_id, states, timeout=10.0):
+        # Doors cycle on the simulator clock (simulated customers close them)
+        deadline = time.monotonic() + timeout
+        while locker_store.get(locker_id).state not in states and time.monotonic() < deadline:
+            time.sleep(0.002)
+
+    def claim(locker_id):
+        # One client per locker at a time, or a slow door cycle makes the
+        # next client find it busy
+        while True:
+            with claim_lock:
+                if locker_id not in claimed:
+                    claimed.add(locker_id)
+                    return
+            time.sleep(0.002)
+
+    def release(locker_id):
+        with claim_lock:
+            claimed.discard(locker_id)
+
+    def prepare_open(client, n):
+        claim(locker_for(n))
+        wait_for_state(locker_for(n), (IDLE, OCCUPIED))
+
+    def open_locker(client, n, prepared):
+        try:
+            return client.post(f'/api/open_locker/{locker_for(n)}')
+        finally:
+            release(locker_for(n))
+
+    def prepare_pickup(client, n):
+        # A delivery leaves an OTP behind for the customer to type
+        prepare_open(client, n)
+        response = client.post(f'/api/open_locker/{locker_for(n)}')
+        wait_for_state(locker_for(n), (OCCUPIED,))
+        return {'otp': response.get_json()['otp']}
+
+    def pickup(client, n, form):
+        try:
+            return client.post('/customer/pickup', data=form)
+        finally:
+            release(locker_for(n))
+
+    def prepare_configuration(client, n):
+        # The full form the admin page posts, with one special code changed
+        form = {}
+        for locker in locker_store.all():
+            locker_id = locker['id']
+            form.update({
+                f'hw_type_{locker_id}': locker['hardware_type'] or 'pi',
+                f'gpio_pin_{locker_id}': '' if locker['gpio_pin'] is None else locker['gpio_pin'],
+                f'sensor_pin_{locker_id}': '' if locker['sensor_pin'] is None else locker['sensor_pin'],
+                f'pulse_ms_{locker_id}': locker['pulse_ms'] or '',
+                f'mcp_address_{locker_id}': '' if locker['mcp_address'] is None else hex(locker['mcp_address']),
+                f'i2c_bus_{locker_id}': '' if locker['i2c_bus'] is None else locker['i2c_bus'],
+                f'special_code_{locker_id}': locker['special_code'] or '',
+                f'size_{locker_id}': locker['size'],
+            })
+        form[f'special_code_{locker_for(n)}'] = f'B{n:05d}'
+        return form
+
+    def configuration(client, n, form):
+        return client.post('/configuration', data=form)
+
+    return [
+        Scenario('api_status', lambda client, n, prepared: client.get('/api/status')),
+        Scenario('api_open_locker', open_locker, prepare_open),
+        Scenario('customer_pickup', pickup, prepare_pickup),
+        Scenario('delivery_dashboard', lambda client, n, prepared: client.get('/delivery/dashboard')),
+        Scenario('configuration_save', configuration, prepare_configuration),
+    ]
+
+
+def run_scenario(app, scenario, clients, requests, warmup):
+    latencies = []
+    errors = [0]
+    busy_time = [0.0]
+    lock = threading.Lock()
+    counter = iter(range(warmup + requests))
+
+    def next_request():
+        with lock:
+            return next(counter, None)
+
+    def client_loop():
+        client = app.test_client()
+        own = []
+        failed = 0
+        preparing = 0.0
+        began = time.perf_counter()
+        while True:
+            n = next_request()
+            if n is None:
+                break
+            prepared = None
+            if scenario.prepare:
+                start = time.perf_counter()
+                prepared = scenario.prepare(client, n)
+                preparing += time.perf_counter() - start
+            start = time.perf_counter()
+            response = scenario.request(client, n, prepared)
+            elapsed = time.perf_counter() - start
+            if n >= warmup:
+                own.append(elapsed)
+                failed += response.status_code >= 400
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+            busy_time[0] += time.perf_counter() - began - preparing
+
+    threads = [threading.Thread(target=client_loop, name=f'bench-{i}') for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Time clients spent issuing requests, averaged over clients: preparing
+    # (waiting for simulated doors to cycle) is left out
+    wall = busy_time[0] / clients
+
+    latencies.sort()
+    # Throughput counts only timed requests, but over the busy time
+    # including warmup, so it is comparable between revisions
+    measured = len(latencies)
+    return {
+        'requests': measured,
+        'errors': errors[0],
+        'throughput_rps': round(measured / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / measured * 1000, 3) if measured else 0.0,
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against baseline; returns the list of regressions."""
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            print(f"  {name:20s} (not in baseline)")
+            continue
+        p99_change = current['p99_ms'] / previous['p99_ms'] - 1 if previous['p99_ms'] else 0.0
+        rps_change = current['throughput_rps'] / previous['throughput_rps'] - 1 if previous['throughput_rps'] else 0.0
+        flag = ''
+        if p99_change > tolerance or rps_change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"  {name:20s} p99 {p99_change:+7.1%}  throughput {rps_change:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the kiosk request paths on the hardware simulator.')
+    parser.add_argument('--clients', type=int, default=CLIENTS, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=REQUESTS, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=WARMUP, help='untimed requests per scenario')
+    parser.add_argument('--scenario', action='append', help='run only this scenario (repeatable)')
+    parser.add_argument('--i2c-latency-ms', type=float, default=None, help='simulated I2C transaction time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='simulated I2C error rate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help=f'results file (default {BENCHMARK_DIR}/<time>.json)')
+    parser.add_argument('--compare', metavar='RESULTS', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    # The app sets up its database and hardware on import
+    if os.path.exists(BENCHMARK_DB):
+        os.remove(BENCHMARK_DB)
+    database.DB_NAME = BENCHMARK_DB
+    shutil.rmtree(BENCHMARK_AUDIT_DIR, ignore_errors=True)
+    audit.AUDIT_DIR = BENCHMARK_AUDIT_DIR
+    from app import app, actuator, occupancy, code_limiter, LOCKER_COUNT
+    from simulator import HardwareSimulator, I2C_LATENCY_MS
+
+    simulator = HardwareSimulator(locker_count=LOCKER_COUNT, seed=args.seed, error_rate=args.error_rate,
+                                  i2c_latency_ms=args.i2c_latency_ms if args.i2c_latency_ms is not None else I2C_LATENCY_MS,
+                                  pulse_ms=BENCHMARK_PULSE_MS, close_delay_s=BENCHMARK_CLOSE_DELAY_S)
+    simulator.clock.start()
+    # Request paths are measured, not the pulse queue behind the power budget
+    actuator.max_concurrent_pulses = None
+    occupancy.door_recheck_s = BENCHMARK_DOOR_RECHECK_S
+    # Every test client shares one address; measure the limiter without it throttling
+    code_limiter.per_minute = code_limiter.burst = code_limiter.global_per_minute = 10 ** 9
+    hw = actuator.replace(simulator.hardware).result(timeout=10)
+    hw.wait_ready(timeout=10)
+
+    scenarios = build_scenarios(LOCKER_COUNT)
+    if args.scenario:
+        scenarios = [s for s in scenarios if s.name in args.scenario]
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {
+            'clients': args.clients, 'requests': args.requests, 'warmup': args.warmup,
+            'lockers': LOCKER_COUNT, 'i2c_latency_ms': simulator.i2c_latency_ms,
+            'error_rate': args.error_rate, 'seed': args.seed,
+        },
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        # The app logs every open; keep the console out of the measurement
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            stats = run_scenario(app, scenario, args.clients, args.requests, args.warmup)
+        results['scenarios'][scenario.name] = stats
+        print(f"[Benchmark] {scenario.name:20s} {stats['throughput_rps']:8.1f} req/s  "
+              f"p50 {stats['p50_ms']:7.2f} ms  p99 {stats['p99_ms']:7.2f} ms  errors {stats['errors']}")
+    results['simulator'] = simulator.stats()
+
+    output = args.output or os.path.join(BENCHMARK_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"[Benchmark] Results written to {output}")
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"[Benchmark] Compared with {args.compare} ({baseline.get('revision')}):")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"[Benchmark] Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            status = 1
+
+    audit.audit_log.flush()
+    shutil.rmtree(BENCHMARK_AUDIT_DIR, ignore_errors=True)
+    database.close_pool()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(BENCHMARK_DB + suffix):
+            os.remove(BENCHMARK_DB + suffix)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
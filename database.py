@@ -1,19 +1,202 @@
 import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+from profiling import current_profile
+
 DB_NAME = "smartlocker.db"
 
+# Connection pool settings
+POOL_SIZE = 4
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+
+_pool = queue.LifoQueue()  # (pool key, connection) ready for reuse
+_generation = 0  # Bumped by close_pool(): connections borrowed before it are not reused
+_local = threading.local()  # connection borrowed by the current thread, if any
+# Held from the commit through the after_commit callbacks of transactions that
+# have any, so callbacks run in commit order (re-entrant: callbacks may commit)
+_commit_lock = threading.RLock()
+
+class ProfiledConnection(sqlite3.Connection):
+    """Reports statement count and time to the request profiler when the request is sampled."""
+    def execute(self, *args):
+        profile = current_profile()
+        if profile is None:
+            return super().execute(*args)
+        profile.sql_statements += 1
+        profile.begin('db')
+        try:
+            return super().execute(*args)
+        finally:
+            profile.end('db')
+
+    def executemany(self, *args):
+        profile = current_profile()
+        if profile is None:
+            return super().executemany(*args)
+        profile.sql_statements += 1
+        profile.begin('db')
+        try:
+            return super().executemany(*args)
+        finally:
+            profile.end('db')
+
+    def commit(self):
+        profile = current_profile()
+        if profile is None:
+            return super().commit()
+        profile.begin('db')
+        try:
+            return super().commit()
+        finally:
+            profile.end('db')
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+    """Open a new standalone connection. The caller must close() it."""
+    conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT_MS / 1000.0, factory=ProfiledConnection,
+                           check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while a write is in progress; NORMAL only fsyncs at checkpoints
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
     return conn
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _pool_key():
+    return DB_NAME, _generation
+
+def _checkout():
+    while True:
+        try:
+            name, conn = _pool.get_nowait()
+        except queue.Empty:
+            return get_db_connection()
+        if name == _pool_key():
+            return conn
+        conn.close()  # DB_NAME changed or pool closed (tests), drop stale connection
+
+def _checkin(conn, name):
+    if name == _pool_key() and _pool.qsize() < POOL_SIZE:
+        _pool.put((name, conn))
+    else:
+        conn.close()
 
+@contextmanager
+def db_connection():
+    """
+    Borrow a pooled connection for the duration of a with-block.
+    Commits on success and rolls back on error. Nested blocks on the same
+    thread share the outer connection and transaction, so helpers such as
+    update_locker_status() can be called from inside a route's block.
+    Pooled connections keep their prepared statement cache between requests.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    name = _pool_key()
+    conn = _checkout()
+    _local.conn = conn
+    _local.on_commit = []
+    ordered = False
+    try:
+        yield conn
+        ordered = bool(_local.on_commit)
+        if ordered:
+            _commit_lock.acquire()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if ordered:
+            _commit_lock.release()
+        raise
+    finally:
+        callbacks = _local.on_commit
+        _local.conn = None
+        _local.on_commit = None
+        _checkin(conn, name)
+    
+    try:
+        for callback in callbacks:
+            callback()
+    finally:
+        if ordered:
+            _commit_lock.release()
+
+def after_commit(callback):
+    """
+    Run callback once the current thread's db_connection() transaction has
+    committed (dropped on rollback). Outside a transaction it runs immediately.
+    Callbacks of different transactions run in the order they committed.
+    """
+    pending = getattr(_local, 'on_commit', None)
+    if pending is None:
+        callback()
+    else:
+        pending.append(callback)
+
+def close_pool():
+    """
+    Close every idle pooled connection (shutdown, or before deleting the DB
+    file). Connections borrowed at the time are closed when given back.
+    """
+    global _generation
+    _generation += 1
+    while True:
+        try:
+            _, conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        conn.close()
+
+# Number of lockers created on a fresh install (app.LOCKER_COUNT overrides)
+DEFAULT_LOCKER_COUNT = 32
+
+# Default pin assignments: lockers 1-22 use Pi GPIO, the rest use MCP23017 chips
+PI_GPIOS = [4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 2, 3, 14, 15, 8]
+PI_SENSORS = [7, 8, 9, 10, 11, 14, 15, 2, 3, 4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23]
+MCP_LOCKERS_PER_CHIP = 8  # Relays on Port A, sensors on the matching Port B pin
+MCP_CHIPS_PER_BUS = 8     # Addresses 0x20-0x27
+
+def default_locker_rows(first_id, last_id):
+    """(id, hardware_type, gpio_pin, sensor_pin, mcp_address, i2c_bus) for default lockers."""
+    rows = []
+    for i in range(first_id, last_id + 1):
+        if i <= len(PI_GPIOS):
+            rows.append((i, 'pi', PI_GPIOS[i-1], PI_SENSORS[i-1], None, None))
+        else:
+            chip_index, pin = divmod(i - len(PI_GPIOS) - 1, MCP_LOCKERS_PER_CHIP)
+            rows.append((i, 'mcp', pin, 8 + pin,
+                         0x20 + chip_index % MCP_CHIPS_PER_BUS, 1 + chip_index // MCP_CHIPS_PER_BUS))
+    return rows
+
+def _legacy_locker_rows():
+    """(id, hardware_type, gpio_pin, sensor_pin) as seeded by migration 2 (10 MCP pins on 0x20)."""
+    rows = []
+    for i in range(1, 33):
+        if i <= 22:
+            rows.append((i, 'pi', PI_GPIOS[i-1], PI_SENSORS[i-1]))
+        else:
+            rows.append((i, 'mcp', i - 23, None))
+    return rows
+
+# --- Migrations ---
+# Each migration runs exactly once, in its own transaction, and bumps
+# PRAGMA user_version. Append new migrations; never edit applied ones.
+
+def _add_missing_columns(conn, table, columns):
+    existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for name, definition in columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+def _migration_001_base_schema(conn):
     # Table: lockers
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS lockers (
             id INTEGER PRIMARY KEY,
             is_occupied BOOLEAN DEFAULT 0,
@@ -26,30 +209,16 @@ def init_db():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    # Migrate existing database: Add new columns if they don't exist
-    try:
-        cursor.execute('ALTER TABLE lockers ADD COLUMN hardware_type TEXT DEFAULT "pi"')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    try:
-        cursor.execute('ALTER TABLE lockers ADD COLUMN gpio_pin INTEGER')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    try:
-        cursor.execute('ALTER TABLE lockers ADD COLUMN sensor_pin INTEGER')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    try:
-        cursor.execute('ALTER TABLE lockers ADD COLUMN special_code TEXT')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
+    # Databases created before hardware configuration existed
+    _add_missing_columns(conn, 'lockers', [
+        ('hardware_type', "TEXT DEFAULT 'pi'"),
+        ('gpio_pin', 'INTEGER'),
+        ('sensor_pin', 'INTEGER'),
+        ('special_code', 'TEXT'),
+    ])
 
     # Table: otp_codes
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS otp_codes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             locker_id INTEGER,
@@ -62,7 +231,7 @@ def init_db():
     ''')
 
     # Table: delivery_users
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS delivery_users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -70,74 +239,103 @@ def init_db():
         )
     ''')
 
-    # Default pin assignments (used for initialization and migration)
-    pi_gpios = [4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 2, 3, 14, 15, 8]
-    pi_sensors = [7, 8, 9, 10, 11, 14, 15, 2, 3, 4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23]
-    
-    # Initialize 32 lockers if they don't exist, or update existing ones
-    cursor.execute('SELECT count(*) FROM lockers')
-    locker_count = cursor.fetchone()[0]
-    
-    if locker_count == 0:
-        # Default: lockers 1-22 use Pi GPIO, 23-32 use MCP
-        for i in range(1, 33):
-            if i <= 22:
-                # Pi GPIO lockers
-                gpio_pin = pi_gpios[i-1] if i-1 < len(pi_gpios) else 4
-                sensor_pin = pi_sensors[i-1] if i-1 < len(pi_sensors) else 7
-                cursor.execute('''INSERT INTO lockers 
-                    (id, is_occupied, door_closed, hardware_type, gpio_pin, sensor_pin) 
-                    VALUES (?, 0, 1, 'pi', ?, ?)''', (i, gpio_pin, sensor_pin))
-            else:
-                # MCP lockers
-                mcp_pin = i - 23
-                cursor.execute('''INSERT INTO lockers 
-                    (id, is_occupied, door_closed, hardware_type, gpio_pin) 
-                    VALUES (?, 0, 1, 'mcp', ?)''', (i, mcp_pin))
-        print("Initialized 32 lockers.")
-    elif locker_count < 32:
-        # Add missing lockers (if upgrading from 16 to 32)
-        for i in range(locker_count + 1, 33):
-            if i <= 22:
-                gpio_pin = pi_gpios[i-1] if i-1 < len(pi_gpios) else 4
-                sensor_pin = pi_sensors[i-1] if i-1 < len(pi_sensors) else 7
-                cursor.execute('''INSERT INTO lockers 
-                    (id, is_occupied, door_closed, hardware_type, gpio_pin, sensor_pin) 
-                    VALUES (?, 0, 1, 'pi', ?, ?)''', (i, gpio_pin, sensor_pin))
-            else:
-                mcp_pin = i - 23
-                cursor.execute('''INSERT INTO lockers 
-                    (id, is_occupied, door_closed, hardware_type, gpio_pin) 
-                    VALUES (?, 0, 1, 'mcp', ?)''', (i, mcp_pin))
-        print(f"Added {32 - locker_count} new lockers (total: 32).")
-    
-    # Update existing lockers with default hardware_type if NULL
-    cursor.execute('UPDATE lockers SET hardware_type = "pi" WHERE hardware_type IS NULL AND id <= 22')
-    cursor.execute('UPDATE lockers SET hardware_type = "mcp" WHERE hardware_type IS NULL AND id > 22')
-    
-    # Set default GPIO pins for existing lockers if NULL
-    for i in range(1, min(locker_count + 1, 23)):
-        locker = cursor.execute('SELECT gpio_pin FROM lockers WHERE id = ?', (i,)).fetchone()
-        if locker and locker[0] is None:
-            gpio_pin = pi_gpios[i-1] if i-1 < len(pi_gpios) else 4
-            sensor_pin = pi_sensors[i-1] if i-1 < len(pi_sensors) else 7
-            cursor.execute('UPDATE lockers SET gpio_pin = ?, sensor_pin = ? WHERE id = ?', 
-                         (gpio_pin, sensor_pin, i))
-    
-    for i in range(23, min(locker_count + 1, 33)):
-        locker = cursor.execute('SELECT gpio_pin FROM lockers WHERE id = ?', (i,)).fetchone()
-        if locker and locker[0] is None:
-            mcp_pin = i - 23
-            cursor.execute('UPDATE lockers SET gpio_pin = ? WHERE id = ?', (mcp_pin, i))
+def _migration_002_seed_defaults(conn):
+    rows = _legacy_locker_rows()
+    # Add missing lockers (fresh install, or upgrading from 16 to 32)
+    conn.executemany('''INSERT OR IGNORE INTO lockers
+        (id, is_occupied, door_closed, hardware_type, gpio_pin, sensor_pin)
+        VALUES (?, 0, 1, ?, ?, ?)''', rows)
+    # Fill in wiring left NULL by older versions
+    conn.executemany('''UPDATE lockers SET hardware_type = ? WHERE id = ? AND hardware_type IS NULL''',
+                     [(hw_type, locker_id) for locker_id, hw_type, _, _ in rows])
+    conn.executemany('''UPDATE lockers SET gpio_pin = ?, sensor_pin = COALESCE(sensor_pin, ?)
+        WHERE id = ? AND gpio_pin IS NULL''',
+                     [(gpio_pin, sensor_pin, locker_id) for locker_id, _, gpio_pin, sensor_pin in rows])
 
     # Initialize default delivery user if not exists
-    cursor.execute('SELECT count(*) FROM delivery_users')
-    if cursor.fetchone()[0] == 0:
-        cursor.execute('INSERT INTO delivery_users (name, pin_code) VALUES (?, ?)', ('Admin', '1234'))
+    if conn.execute('SELECT count(*) FROM delivery_users').fetchone()[0] == 0:
+        conn.execute('INSERT INTO delivery_users (name, pin_code) VALUES (?, ?)', ('Admin', '1234'))
         print("Initialized default delivery user (PIN: 1234).")
 
-    conn.commit()
-    conn.close()
+def _migration_003_pulse_width(conn):
+    _add_missing_columns(conn, 'lockers', [('pulse_ms', 'INTEGER')])
+
+def _migration_004_code_indexes(conn):
+    # Indexes for code lookups (pickup by OTP/special code, OTP history per locker)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_lockers_otp_code ON lockers (otp_code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_lockers_special_code ON lockers (special_code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_otp_codes_code ON otp_codes (code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_otp_codes_locker_id ON otp_codes (locker_id)')
+
+def _migration_005_expander_topology(conn):
+    # Which MCP23017 a locker is wired to (NULL = 0x20 on bus 1)
+    _add_missing_columns(conn, 'lockers', [
+        ('mcp_address', 'INTEGER'),
+        ('i2c_bus', 'INTEGER'),
+    ])
+    # The legacy default put lockers 31-32 on MCP pins 8-9, which are Port B
+    # sensor inputs and could never drive a relay. Move rows still on that
+    # default to the first pins of a second chip at 0x21.
+    conn.executemany('''UPDATE lockers SET gpio_pin = ?, mcp_address = 0x21
+        WHERE id = ? AND hardware_type = 'mcp' AND gpio_pin = ? AND mcp_address IS NULL''',
+                     [(0, 31, 8), (1, 32, 9)])
+
+def _migration_006_size_classes(conn):
+    # Parcel size class for automatic allocation ('S', 'M', 'L')
+    _add_missing_columns(conn, 'lockers', [('size', "TEXT DEFAULT 'M'")])
+
+def _migration_007_locker_states(conn):
+    # Delivery/pickup state machine (see occupancy.py)
+    _add_missing_columns(conn, 'lockers', [('state', "TEXT DEFAULT 'idle'")])
+    conn.execute("UPDATE lockers SET state = 'occupied' WHERE is_occupied = 1")
+
+def _migration_008_otp_expiry(conn):
+    # Codes lapse at otp_expires_at (Unix time, NULL = never; see occupancy.py)
+    _add_missing_columns(conn, 'lockers', [('otp_expires_at', 'REAL')])
+
+MIGRATIONS = [
+    _migration_001_base_schema,
+    _migration_002_seed_defaults,
+    _migration_003_pulse_width,
+    _migration_004_code_indexes,
+    _migration_005_expander_topology,
+    _migration_006_size_classes,
+    _migration_007_locker_states,
+    _migration_008_otp_expiry,
+]
+
+def _ensure_locker_count(conn, locker_count):
+    """Append default rows up to locker_count (one indexed MAX when nothing is missing)."""
+    last_id = conn.execute('SELECT max(id) FROM lockers').fetchone()[0] or 0
+    if last_id >= locker_count:
+        return
+    with conn:
+        conn.executemany('''INSERT INTO lockers
+            (id, is_occupied, door_closed, hardware_type, gpio_pin, sensor_pin, mcp_address, i2c_bus)
+            VALUES (?, 0, 1, ?, ?, ?, ?, ?)''', default_locker_rows(last_id + 1, locker_count))
+    print(f"[Database] Added lockers {last_id + 1}-{locker_count}.")
+
+def init_db(locker_count=DEFAULT_LOCKER_COUNT):
+    """
+    Bring the schema up to date and make sure locker_count lockers exist.
+    A current database costs a PRAGMA read and a MAX(id).
+    """
+    conn = get_db_connection()
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute('BEGIN')
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            print(f"[Database] Applied migration {number}: {migration.__name__}")
+        _ensure_locker_count(conn, locker_count)
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,214 @@
+import queue
+import threading
+
+import hardware
+from hardware import HAS_GPIO, pulse_scheduler
+
+# A sensor must hold its new level this long before the change is published
+DOOR_DEBOUNCE_MS = 50
+
+# MCP23017 interrupt registers (IOCON.BANK = 0)
+GPINTENA = 0x04  # Interrupt-on-change enable A (B follows at 0x05)
+INTCONA = 0x08   # 0 = compare against previous value (any change)
+IOCON = 0x0A
+INTCAPA = 0x10   # Port values captured at interrupt time (reading clears INT)
+IOCON_MIRROR = 0x40  # INTA and INTB are OR'ed so either pin can be wired
+IOCON_ODR = 0x04     # Open-drain INT so several chips can share one Pi GPIO
+
+
+class DoorMonitor:
+    """
+    Event-driven door sensor monitor.
+    - Pi-wired sensors use RPi.GPIO edge callbacks.
+    - MCP-wired sensors raise INTA/INTB (mirrored, open-drain) on a Pi GPIO
+      shared by every expander; the handler reads INTCAP on each chip to clear
+      the interrupt.
+    - MockMCP23017 reports changes through its sensor_listeners hook.
+    An edge only schedules a settle check on the pulse scheduler; the level is
+    read again after DOOR_DEBOUNCE_MS and published if it differs from the last
+    published state. Listeners run on a dedicated dispatcher thread so slow
+    subscribers (SQLite writes) never delay a solenoid release.
+    """
+    def __init__(self, int_pin=None, scheduler=None):
+        """int_pin: BCM pin wired to the MCP23017 INTA/INTB outputs (None = not wired)"""
+        self.int_pin = int_pin
+        self.scheduler = scheduler or pulse_scheduler
+        self.hardware = None
+        self.states = {}  # locker_id -> last published closed state
+        self.version = 0  # Bumped whenever states changes
+        self._listeners = []
+        self._pending = set()  # sources with a settle check already scheduled
+        self._pi_lockers = {}  # BCM sensor pin -> [locker_id, ...]
+        self._watched_pins = []
+        self._mcp_unmonitored = False  # MCP sensors present but no INT line wired
+        self._lock = threading.Lock()
+        self._attach_lock = threading.RLock()  # Serialises attach/detach
+        self._events = queue.Queue()
+        self._dispatcher = None
+
+    def subscribe(self, callback):
+        """callback(locker_id, closed) is called for every debounced door change."""
+        self._listeners.append(callback)
+
+    def attach(self, hw):
+        """Start monitoring hw, detaching from any previously monitored hardware."""
+        # Called from the health thread (chip_listeners) and the actuator thread
+        with self._attach_lock:
+            self.detach()
+            self.hardware = hw
+            with self._lock:
+                self.states = dict(hw.get_all_lockers_states())
+                self.version += 1
+
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='door-monitor', daemon=True)
+                self._dispatcher.start()
+
+            if hasattr(hw, 'sensor_listeners'):
+                hw.sensor_listeners.append(self._on_mock_change)
+            if hasattr(hw, 'chip_listeners'):
+                # Expanders coming up, dropping out or being reprogrammed after a reset
+                hw.chip_listeners.append(self.attach)
+
+            if HAS_GPIO and getattr(hw, 'pi_sensor_pins', None):
+                for locker_id, pin in hw.pi_sensor_pins:
+                    self._pi_lockers.setdefault(pin, []).append(locker_id)
+                for pin in self._pi_lockers:
+                    hardware.GPIO.add_event_detect(pin, hardware.GPIO.BOTH, callback=self._on_pi_edge)
+                    self._watched_pins.append(pin)
+
+            if getattr(hw, 'sensor_chips', None):
+                if self.int_pin is None or not HAS_GPIO:
+                    print("[DoorMonitor] MCP23017 INT pin not wired, MCP door sensors are read on demand")
+                    self._mcp_unmonitored = True
+                else:
+                    self._enable_mcp_interrupts(hw)
+
+            print(f"[DoorMonitor] Watching {len(self.states)} lockers")
+
+    def detach(self):
+        with self._attach_lock:
+            hw = self.hardware
+            if hw is None:
+                return
+            if hasattr(hw, 'sensor_listeners') and self._on_mock_change in hw.sensor_listeners:
+                hw.sensor_listeners.remove(self._on_mock_change)
+            if hasattr(hw, 'chip_listeners') and self.attach in hw.chip_listeners:
+                hw.chip_listeners.remove(self.attach)
+            if HAS_GPIO:
+                for pin in self._watched_pins:
+                    hardware.GPIO.remove_event_detect(pin)
+            if self.int_pin in self._watched_pins:
+                for chip in hw.sensor_chips:
+                    try:
+                        chip.bus.write_i2c_block_data(chip.address, GPINTENA, [0x00, 0x00])
+                    except (OSError, IOError) as e:
+                        print(f"[DoorMonitor] Failed to disable interrupts on {chip}: {e}")
+            self._watched_pins = []
+            self._pi_lockers = {}
+            self._mcp_unmonitored = False
+            self.hardware = None
+
+    @property
+    def needs_polling(self):
+        """True when some door sensors only report changes when read (MCP23017 without INT line)."""
+        return self._mcp_unmonitored
+
+    def current_states(self):
+        """
+        locker_id -> closed for every door. Served from memory; only MCP
+        sensors without a wired INT line are read (one block read per chip),
+        and any change found is published like an interrupt would be.
+        """
+        if self._mcp_unmonitored:
+            self._check_mcp()
+        with self._lock:
+            return dict(self.states)
+
+    def _enable_mcp_interrupts(self, hw):
+        for chip in hw.sensor_chips:
+            mask = chip.input_mask
+            try:
+                chip.bus.write_byte_data(chip.address, IOCON, IOCON_MIRROR | IOCON_ODR)
+                chip.bus.write_i2c_block_data(chip.address, INTCONA, [0x00, 0x00])
+                chip.bus.write_i2c_block_data(chip.address, GPINTENA, [mask & 0xFF, mask >> 8])
+                chip.bus.read_i2c_block_data(chip.address, INTCAPA, 2)  # Clear any stale interrupt
+            except (OSError, IOError) as e:
+                print(f"[DoorMonitor] Failed to enable interrupts on {chip}: {e}")
+
+        # INT is open-drain/active-low: falling edge means a sensor changed
+        hardware.GPIO.setup(self.int_pin, hardware.GPIO.IN, pull_up_down=hardware.GPIO.PUD_UP)
+        hardware.GPIO.add_event_detect(self.int_pin, hardware.GPIO.FALLING, callback=self._on_mcp_interrupt)
+        self._watched_pins.append(self.int_pin)
+
+    # --- Edge handlers (called from RPi.GPIO's callback thread) ---
+
+    def _on_pi_edge(self, pin):
+        self._settle(('pi', pin), lambda: self._check_pi(pin))
+
+    def _on_mcp_interrupt(self, pin):
+        hw = self.hardware
+        if hw is None:
+            return
+        # The shared line doesn't say which chip fired; reading INTCAP clears it on all of them
+        for chip in hw.sensor_chips:
+            try:
+                chip.bus.read_i2c_block_data(chip.address, INTCAPA, 2)
+            except (OSError, IOError) as e:
+                print(f"[DoorMonitor] Failed to read INTCAP on {chip}: {e}")
+        self._settle('mcp', self._check_mcp)
+
+    def _on_mock_change(self, locker_id, closed):
+        self._publish(locker_id, closed)
+
+    # --- Debounce and publish ---
+
+    def _settle(self, source, check):
+        with self._lock:
+            if source in self._pending:
+                return
+            self._pending.add(source)
+
+        def run():
+            with self._lock:
+                self._pending.discard(source)
+            check()
+
+        self.scheduler.call_later(DOOR_DEBOUNCE_MS / 1000.0, run)
+
+    def _check_pi(self, pin):
+        # Assuming pull-up: LOW (0) = door closed, HIGH (1) = door open
+        closed = hardware.GPIO.input(pin) == hardware.GPIO.LOW
+        for locker_id in self._pi_lockers.get(pin, []):
+            self._publish(locker_id, closed)
+
+    def _check_mcp(self):
+        hw = self.hardware
+        if hw is None:
+            return
+        for chip in hw.sensor_chips:
+            try:
+                inputs = chip.read_inputs()
+            except (OSError, IOError) as e:
+                print(f"[DoorMonitor] Failed to read sensors on {chip}: {e}")
+                continue
+            for locker_id, mask in chip.sensor_masks:
+                self._publish(locker_id, not (inputs & mask))
+
+    def _publish(self, locker_id, closed):
+        with self._lock:
+            if self.states.get(locker_id) == closed:
+                return
+            self.states[locker_id] = closed
+            self.version += 1
+        self._events.put((locker_id, closed))
+
+    def _dispatch(self):
+        while True:
+            locker_id, closed = self._events.get()
+            print(f"[DoorMonitor] Locker {locker_id} door {'closed' if closed else 'opened'}")
+            for callback in list(self._listeners):
+                try:
+                    callback(locker_id, closed)
+                except Exception as e:
+                    print(f"[DoorMonitor] Listener failed for locker {locker_id}: {e}")
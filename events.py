@@ -0,0 +1,96 @@
+import collections
+import itertools
+import json
+import queue
+import threading
+
+# Events kept for clients reconnecting with Last-Event-ID
+EVENT_HISTORY = 256
+# Per-subscriber backlog; a client this far behind is dropped and must reconnect
+SUBSCRIBER_QUEUE_SIZE = 512
+
+
+class Event:
+    def __init__(self, seq, kind, data):
+        self.seq = seq
+        self.kind = kind
+        self.data = data
+
+    def to_sse(self):
+        return f"id: {self.seq}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class Subscription:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+        self.resumed = False  # Events after the client's Last-Event-ID were all queued
+
+    def get(self, timeout=None):
+        """Next Event, or None if nothing arrived within timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeBus:
+    """
+    In-process fan-out of locker changes.
+    Producers (routes, the door monitor) call publish() once; every
+    subscriber (e.g. an /api/events stream) gets its own bounded queue,
+    so a slow client can never block a producer.
+    """
+    def __init__(self):
+        self._subscribers = set()
+        self._history = collections.deque(maxlen=EVENT_HISTORY)
+        self._seq = itertools.count(1)
+        self._last_seq = 0
+        self._lock = threading.Lock()
+
+    def publish(self, kind, **data):
+        with self._lock:
+            event = Event(next(self._seq), kind, data)
+            self._last_seq = event.seq
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(event)
+            except queue.Full:
+                sub.overflowed = True
+        return event
+
+    def subscribe(self, last_event_id=None):
+        """
+        Register a new subscriber. With last_event_id, events after it are
+        queued first so a reconnecting client doesn't miss changes, and
+        sub.resumed is set. If some of them already fell out of the history,
+        or the id is from before a restart (newer than the last event),
+        nothing is queued and sub.resumed stays False: the client needs a
+        fresh snapshot.
+        """
+        sub = Subscription()
+        with self._lock:
+            oldest = self._history[0].seq if self._history else self._last_seq + 1
+            if last_event_id is not None and oldest - 1 <= last_event_id <= self._last_seq:
+                sub.resumed = True
+                for event in self._history:
+                    if event.seq > last_event_id:
+                        sub.queue.put_nowait(event)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+# Shared by the routes and the hardware layer in this process
+change_bus = ChangeBus()
@@ -0,0 +1,44 @@
+import threading
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """
+    Rendered template fragments keyed by (name, language, ...).
+    Each entry remembers the version it was rendered at; a lookup with any
+    other version re-renders and replaces it. Stale entries are simply
+    overwritten, so nothing needs explicit invalidation and the cache holds
+    at most one copy per key.
+    """
+    def __init__(self):
+        self._entries = {}  # key -> (version, Markup)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, version, render):
+        """
+        Cached HTML for key at version, calling render() on a miss.
+        Read version BEFORE the data render() uses: a change in between then
+        only causes one extra render, never a stale hit.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        html = Markup(render())
+        with self._lock:
+            self._entries[key] = (version, html)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all routes in this process
+fragment_cache = FragmentCache()
@@ -1,5 +1,15 @@
+import os
 import time
 import random
+import heapq
+import functools
+import itertools
+import threading
+from concurrent.futures import Future
+
+from database import DEFAULT_LOCKER_COUNT, default_locker_rows
+from metrics import hardware_seconds, i2c_transactions, i2c_errors, i2c_retries
+from profiling import span
 
 # Try to import smbus for real hardware, handle failure for non-Pi environments
 try:
@@ -15,8 +25,259 @@ try:
 except ImportError:
     HAS_GPIO = False
 
+# Default solenoid pulse width in milliseconds (overridable per locker)
+DEFAULT_PULSE_MS = 1000
+
+class PulseScheduler:
+    """
+    Drives solenoid pulses without blocking the caller.
+    pulse() switches the relay ON immediately and hands the OFF edge to a
+    single background timer thread, returning a Future that resolves once
+    the relay has been released. Any number of lockers can pulse at once.
+    """
+    def __init__(self):
+        self._timers = []  # heap of (deadline, seq, callback, future)
+        self._active = {}  # key -> Future of the pulse currently running
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='pulse-scheduler', daemon=True)
+            self._thread.start()
+
+    def _schedule(self, delay, callback, future):
+        with self._cond:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._seq), callback, future))
+            self._ensure_thread()
+            self._cond.notify()
+        return future
+
+    def call_later(self, delay, callback):
+        """Run callback on the timer thread after delay seconds. Returns a Future."""
+        return self._schedule(delay, callback, Future())
+
+    def pulse(self, key, on, off, width_ms=DEFAULT_PULSE_MS):
+        """
+        Call on() now and off() width_ms later. A second pulse for the same key
+        while one is running returns the running pulse's Future instead of
+        cutting it short.
+        """
+        with self._cond:
+            future = self._active.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._active[key] = future
+
+        try:
+            on()
+        except Exception as e:
+            with self._cond:
+                self._active.pop(key, None)
+            future.set_exception(e)
+            return future
+
+        def release():
+            try:
+                off()
+            finally:
+                with self._cond:
+                    self._active.pop(key, None)
+            return key
+
+        return self._schedule(width_ms / 1000.0, release, future)
+
+    def is_pulsing(self, key):
+        with self._cond:
+            return key in self._active
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._timers:
+                    self._cond.wait()
+                deadline = self._timers[0][0]
+                now = time.monotonic()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                _, _, callback, future = heapq.heappop(self._timers)
+
+            try:
+                future.set_result(callback())
+            except Exception as e:
+                print(f"[PulseScheduler] Timer callback failed: {e}")
+                future.set_exception(e)
+
+# Shared by all hardware instances so a configuration reload doesn't orphan pulses
+pulse_scheduler = PulseScheduler()
+
+# How often the output latch shadows are compared against the chips
+LATCH_RECONCILE_SECONDS = 30
+
+class MCPOutputLatch:
+    """
+    In-process shadow of one MCP23017's OLATA/OLATB output latches.
+    Relay changes flip a bit in the cached byte under a lock and write it in a
+    single I2C transaction, so there is no read-back per actuation and two
+    concurrent pulses can't restore each other's stale value.
+    """
+    OLATA = 0x14
+    OLATB = 0x15
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+        self.drift_count = 0
+        self.reconcile_timer = None  # Token of the running reconcile loop, None when stopped
+        self._latch = [0x00, 0x00]  # Port A, Port B
+        self._lock = threading.Lock()
+
+    def _register(self, port):
+        return self.OLATA if port == 0 else self.OLATB
+
+    def flush(self):
+        """Write both cached latch bytes to the chip."""
+        with self._lock:
+            for port in (0, 1):
+                self.bus.write_byte_data(self.address, self._register(port), self._latch[port])
+
+    def set_pin(self, pin_index, state):
+        # pin_index 0-15. 0-7 is Port A, 8-15 is Port B.
+        port = 0 if pin_index < 8 else 1
+        mask = 1 << (pin_index % 8)
+        with self._lock:
+            if state:
+                self._latch[port] |= mask
+            else:
+                self._latch[port] &= ~mask
+            self.bus.write_byte_data(self.address, self._register(port), self._latch[port])
+
+    def get_pin(self, pin_index):
+        port = 0 if pin_index < 8 else 1
+        with self._lock:
+            return bool(self._latch[port] & (1 << (pin_index % 8)))
+
+    def reconcile(self):
+        """
+        Read the latches back and rewrite any byte that drifted from the shadow
+        (e.g. the chip browned out and reset to 0x00). Returns True on drift.
+        """
+        drifted = False
+        with self._lock:
+            for port in (0, 1):
+                register = self._register(port)
+                actual = self.bus.read_byte_data(self.address, register)
+                if actual != self._latch[port]:
+                    drifted = True
+                    self.drift_count += 1
+                    print(f"[MCPOutputLatch] 0x{self.address:x} OLAT{'AB'[port]} drifted: "
+                          f"chip=0x{actual:02x} shadow=0x{self._latch[port]:02x}, rewriting")
+                    self.bus.write_byte_data(self.address, register, self._latch[port])
+        return drifted
+
+# One shadow per physical chip, shared across hardware re-initialisations
+_output_latches = {}
+_output_latches_lock = threading.Lock()
+
+def get_output_latch(bus, bus_num, address, scheduler=None):
+    """
+    Return the process-wide latch shadow for the chip at (bus_num, address),
+    creating it on first use. The latch writes through the bus of the
+    hardware that asked last, and is reconciled periodically until that
+    hardware releases it. The cached state is written to the chip either way.
+    """
+    scheduler = scheduler or pulse_scheduler
+    with _output_latches_lock:
+        latch = _output_latches.get((bus_num, address))
+        if latch is None:
+            latch = MCPOutputLatch(bus, address)
+            _output_latches[(bus_num, address)] = latch
+        elif latch.bus is not bus:
+            with latch._lock:
+                latch.bus = bus  # A new hardware instance took the chip over
+        timer = None
+        if latch.reconcile_timer is None:
+            timer = latch.reconcile_timer = object()
+    latch.flush()
+
+    if timer is not None:
+        def reconcile_periodically():
+            with _output_latches_lock:
+                if latch.reconcile_timer is not timer:
+                    return  # Released, or restarted by a newer owner
+            try:
+                latch.reconcile()
+            except (OSError, IOError) as e:
+                print(f"[MCPOutputLatch] Reconcile failed at 0x{address:x}: {e}")
+            scheduler.call_later(LATCH_RECONCILE_SECONDS, reconcile_periodically)
+
+        scheduler.call_later(LATCH_RECONCILE_SECONDS, reconcile_periodically)
+    return latch
+
+def release_output_latch(bus, bus_num, address):
+    """
+    Stop reconciling the chip's latch if bus still owns it (its hardware is
+    being closed). The shadow itself is kept for the next hardware instance.
+    """
+    with _output_latches_lock:
+        latch = _output_latches.get((bus_num, address))
+        if latch is not None and latch.bus is bus:
+            latch.reconcile_timer = None
+
+def timed(operation):
+    """Record the decorated hardware operation's latency for /metrics."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with span('hardware'):
+                    return fn(*args, **kwargs)
+            finally:
+                hardware_seconds.observe(time.perf_counter() - start, operation)
+        return wrapper
+    return decorate
+
+class InstrumentedBus:
+    """
+    smbus.SMBus wrapper counting transactions and failures per chip address
+    for /metrics. Exceptions are re-raised unchanged. Transactions are
+    serialised: the actuator, health and door monitor threads share one
+    handle, and smbus sets the chip address and transfers in separate calls.
+    """
+    def __init__(self, bus, bus_num):
+        self.bus = bus
+        self.bus_num = bus_num
+        self._lock = threading.Lock()
+
+    def _call(self, operation, method, address, *args):
+        label = f'0x{address:02x}'
+        i2c_transactions.inc(self.bus_num, label)
+        try:
+            with span('hardware'), self._lock:
+                return method(address, *args)
+        except (OSError, IOError):
+            i2c_errors.inc(self.bus_num, label, operation)
+            raise
+
+    def read_byte_data(self, address, register):
+        return self._call('read_byte_data', self.bus.read_byte_data, address, register)
+
+    def write_byte_data(self, address, register, value):
+        return self._call('write_byte_data', self.bus.write_byte_data, address, register, value)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._call('read_i2c_block_data', self.bus.read_i2c_block_data, address, register, length)
+
+    def write_i2c_block_data(self, address, register, values):
+        return self._call('write_i2c_block_data', self.bus.write_i2c_block_data, address, register, values)
+
 class HardwareInterface:
     def open_locker(self, locker_id):
+        """Start a solenoid pulse and return a Future resolved when the relay is released."""
         raise NotImplementedError
 
     def read_door_state(self, locker_id):
@@ -25,12 +286,26 @@ class HardwareInterface:
     def get_all_lockers_states(self):
         raise NotImplementedError
 
+    def reconfigure(self, locker_config):
+        """Apply new wiring in place. Returns the ids of lockers that changed."""
+        return set()
+
+    def health(self):
+        """{'ready': bool, 'chips': [per-expander status]} for diagnostics."""
+        return {'ready': True, 'chips': []}
+
+    def close(self):
+        """Stop background threads (the instance is being replaced)."""
+
 class RealMCP23017(HardwareInterface):
-    def __init__(self, address_relays=0x20, address_sensors=0x21, bus_num=1):
+    def __init__(self, address_relays=0x20, address_sensors=0x21, bus_num=1,
+                 pulse_ms=DEFAULT_PULSE_MS, scheduler=None):
         if not HAS_SMBUS:
             raise RuntimeError("smbus not found. Cannot use RealMCP23017.")
         
-        self.bus = smbus.SMBus(bus_num)
+        self.scheduler = scheduler or pulse_scheduler
+        self.pulse_ms = pulse_ms
+        self.bus = InstrumentedBus(smbus.SMBus(bus_num), bus_num)
         self.addr_relays = address_relays
         self.addr_sensors = address_sensors
 
@@ -47,9 +322,8 @@ class RealMCP23017(HardwareInterface):
         self.bus.write_byte_data(self.addr_relays, self.IODIRA, 0x00)
         self.bus.write_byte_data(self.addr_relays, self.IODIRB, 0x00)
         # Turn off all relays initially (assuming Active LOW or HIGH, let's assume Active LOW for relays usually, but here 0=OFF, 1=ON for simplicity logic, will invert if needed)
-        # Actually, let's assume writing 0 to GPIO turns it OFF, 1 turns it ON.
-        self.bus.write_byte_data(self.addr_relays, self.GPIOA, 0x00)
-        self.bus.write_byte_data(self.addr_relays, self.GPIOB, 0x00)
+        # Actually, let's assume writing 0 to the latch turns it OFF, 1 turns it ON.
+        self.relay_latch = get_output_latch(self.bus, bus_num, self.addr_relays, self.scheduler)
 
         # Initialize Sensors (Inputs) - Chip 2
         # Set all pins to INPUT (0xFF)
@@ -59,28 +333,22 @@ class RealMCP23017(HardwareInterface):
 
     def _set_relay(self, pin_index, state):
         # pin_index 0-15. 0-7 is Port A, 8-15 is Port B.
-        # We need to read current state, modify bit, write back.
-        # Or keep a local state cache. For robustness, read-modify-write.
-        
-        port = self.GPIOA if pin_index < 8 else self.GPIOB
-        pin = pin_index if pin_index < 8 else pin_index - 8
-        
-        current = self.bus.read_byte_data(self.addr_relays, port)
-        if state:
-            new_val = current | (1 << pin)
-        else:
-            new_val = current & ~(1 << pin)
-            
-        self.bus.write_byte_data(self.addr_relays, port, new_val)
+        # Single write of the cached latch byte; no read-modify-write.
+        self.relay_latch.set_pin(pin_index, state)
 
+    @timed('open_locker')
     def open_locker(self, locker_id):
         # locker_id 1-16 -> pin_index 0-15
         pin_index = locker_id - 1
         print(f"[Hardware] Opening locker {locker_id} (Pin {pin_index})")
-        self._set_relay(pin_index, True) # ON
-        time.sleep(1) # Keep open for 1 second (solenoid pulse)
-        self._set_relay(pin_index, False) # OFF
+        # Relay ON now, OFF after the pulse width on the scheduler thread
+        return self.scheduler.pulse(
+            (self, locker_id),
+            lambda: self._set_relay(pin_index, True),
+            lambda: self._set_relay(pin_index, False),
+            self.pulse_ms)
 
+    @timed('read_door_state')
     def read_door_state(self, locker_id):
         # locker_id 1-16 -> pin_index 0-15
         pin_index = locker_id - 1
@@ -95,11 +363,14 @@ class RealMCP23017(HardwareInterface):
         is_closed = not ((val >> pin) & 1) 
         return is_closed
 
+    def close(self):
+        release_output_latch(self.bus, self.bus.bus_num, self.addr_relays)
+
+    @timed('get_all_lockers_states')
     def get_all_lockers_states(self):
         states = {}
-        # Read all at once for efficiency
-        val_a = self.bus.read_byte_data(self.addr_sensors, self.GPIOA)
-        val_b = self.bus.read_byte_data(self.addr_sensors, self.GPIOB)
+        # Read both ports in one sequential block read (IOCON.SEQOP enabled by default)
+        val_a, val_b = self.bus.read_i2c_block_data(self.addr_sensors, self.GPIOA, 2)
         
         for i in range(16):
             locker_id = i + 1
@@ -111,65 +382,208 @@ class RealMCP23017(HardwareInterface):
         return states
 
 class MockMCP23017(HardwareInterface):
-    def __init__(self):
-        print("[MockHardware] Initialized 32 lockers.")
-        self.relays = [False] * 32
+    def __init__(self, locker_count=32, pulse_ms=DEFAULT_PULSE_MS, scheduler=None):
+        print(f"[MockHardware] Initialized {locker_count} lockers.")
+        self.locker_count = locker_count
+        self.scheduler = scheduler or pulse_scheduler
+        self.pulse_ms = pulse_ms
+        self.relays = [False] * locker_count
         # True = Closed, False = Open
-        self.sensors = [True] * 32 
+        self.sensors = [True] * locker_count
+        # callback(locker_id, closed) on every sensor change (see door_monitor.DoorMonitor)
+        self.sensor_listeners = []
 
+    @timed('open_locker')
     def open_locker(self, locker_id):
         idx = locker_id - 1
-        if 0 <= idx < 32:
+        if 0 <= idx < self.locker_count:
             print(f"[MockHardware] Click! Locker {locker_id} opened.")
-            self.relays[idx] = True
-            self.sensors[idx] = False # Door opens
+            self._set_sensor(idx, False) # Door opens
             
             # Simulate user closing door after 5 seconds (async in real life, but here we just toggle state logic)
             # For the sake of the mock, we leave it 'Open' until some other action closes it, 
             # OR we can say it stays open.
             # Let's keep it open. The user might need a "Close Door" button in Mock UI to test logic.
             # But the prompt says "After the door closes (sensor detects)..."
-            # So we need a way to simulate closing.
-            # For now, let's auto-close it after a delay in a background thread? 
-            # Or just provide a helper to close it.
-            pass
+            # So we need a way to simulate closing: see mock_close_door().
+            return self.scheduler.pulse(
+                (self, locker_id),
+                lambda: self._set_relay(idx, True),
+                lambda: self._set_relay(idx, False),
+                self.pulse_ms)
         else:
             print(f"[MockHardware] Invalid locker {locker_id}")
 
+    def _set_relay(self, idx, state):
+        self.relays[idx] = state
+
+    def _set_sensor(self, idx, closed):
+        if self.sensors[idx] == closed:
+            return
+        self.sensors[idx] = closed
+        for callback in list(self.sensor_listeners):
+            callback(idx + 1, closed)
+
+    @timed('read_door_state')
     def read_door_state(self, locker_id):
         idx = locker_id - 1
-        if 0 <= idx < 32:
+        if 0 <= idx < self.locker_count:
             return self.sensors[idx]
         return True  # Default: closed
 
+    @timed('get_all_lockers_states')
     def get_all_lockers_states(self):
         states = {}
-        for i in range(32):
+        for i in range(self.locker_count):
             states[i+1] = self.sensors[i]
         return states
     
     # Helper for testing
     def mock_close_door(self, locker_id):
         idx = locker_id - 1
-        if 0 <= idx < 16:
+        if 0 <= idx < self.locker_count:
             print(f"[MockHardware] Slam! Locker {locker_id} closed.")
-            self.sensors[idx] = True
+            self._set_sensor(idx, True)
+
+class MCP23017Chip:
+    """
+    One MCP23017 expander in the topology.
+    Pins are numbered 0-15 (0-7 Port A, 8-15 Port B). Each pin's role comes
+    from the locker configuration: relay pins are outputs driven through the
+    chip's OLAT shadow, every other pin is a pulled-up input. All inputs are
+    read with a single GPIOA+GPIOB block read.
+    """
+    IODIRA = 0x00
+    IODIRB = 0x01
+    GPPUA = 0x0C  # Pull-up register A
+    GPPUB = 0x0D  # Pull-up register B
+    GPIOA = 0x12
+    GPIOB = 0x13
+
+    def __init__(self, bus, bus_num, address):
+        self.bus = bus
+        self.bus_num = bus_num
+        self.address = address
+        self.relay_pins = {}  # locker_id -> pin 0-15
+        self.sensor_masks = []  # (locker_id, 16-bit mask)
+        self.output_mask = 0
+        self.input_mask = 0
+        self.latch = None
+
+    def __repr__(self):
+        return f"MCP23017(bus {self.bus_num}, 0x{self.address:x})"
+
+    def add_sensor(self, locker_id, pin):
+        self.sensor_masks.append((locker_id, 1 << pin))
+        self.input_mask |= 1 << pin
+
+    def add_relay(self, locker_id, pin):
+        self.relay_pins[locker_id] = pin
+        self.output_mask |= 1 << pin
+
+    @property
+    def iodir(self):
+        """Expected IODIRB:IODIRA (1 = input), and GPPU (every input pulled up)."""
+        return ~self.output_mask & 0xFFFF
+
+    def configure(self, scheduler=None):
+        # Latch first so outputs come up in their cached state, then directions
+        self.latch = get_output_latch(self.bus, self.bus_num, self.address, scheduler)
+        iodir = self.iodir
+        self.bus.write_byte_data(self.address, self.IODIRA, iodir & 0xFF)
+        time.sleep(0.01)  # Small delay between writes
+        self.bus.write_byte_data(self.address, self.IODIRB, iodir >> 8)
+        time.sleep(0.01)
+        self.bus.write_byte_data(self.address, self.GPPUA, iodir & 0xFF)
+        self.bus.write_byte_data(self.address, self.GPPUB, iodir >> 8)
+
+    def read_config(self):
+        """
+        (IODIR, GPPU) as read back from the chip. Power-on reset sets IODIR
+        to 0xFFFF and clears GPPU: an input-only chip only shows it in GPPU,
+        a chip without inputs only in IODIR.
+        """
+        iodir_a, iodir_b = self.bus.read_i2c_block_data(self.address, self.IODIRA, 2)
+        gppu_a, gppu_b = self.bus.read_i2c_block_data(self.address, self.GPPUA, 2)
+        return iodir_a | (iodir_b << 8), gppu_a | (gppu_b << 8)
+
+    def read_inputs(self):
+        """Both ports as one 16-bit value (Port B in the high byte)."""
+        port_a, port_b = self.bus.read_i2c_block_data(self.address, self.GPIOA, 2)
+        return port_a | (port_b << 8)
+
+
+# Background MCP23017 health monitor
+MCP_HEALTH_CHECK_SECONDS = 5
+MCP_HEALTH_FAILURES = 3  # Consecutive failed checks before a chip is taken offline
+
+class ChipHealth:
+    def __init__(self, bus_num, address):
+        self.bus_num = bus_num
+        self.address = address
+        self.state = 'starting'  # starting | up | down
+        self.failures = 0  # Consecutive failed checks
+        self.resets = 0  # Times the chip was found reset (brownout) and reprogrammed
+        self.last_seen = None  # time.time() of the last successful check
+
+    def to_dict(self):
+        return {
+            'bus': self.bus_num,
+            'address': f'0x{self.address:02x}',
+            'state': self.state,
+            'failures': self.failures,
+            'resets': self.resets,
+            'last_seen': self.last_seen,
+        }
+
 
 class HybridHardware(HardwareInterface):
     """
     Hybrid hardware supporting:
-    - 22 Raspberry Pi GPIOs (lockers 1-22)
-    - 10 MCP23017 pins (lockers 23-32)
-    Total: 32 lockers
+    - Raspberry Pi GPIOs (by default lockers 1-22)
+    - Any number of MCP23017 expanders, at addresses 0x20-0x27 on one or more
+      I2C buses (by default 8 lockers per chip from locker 23 on: relays on
+      Port A, sensors on the matching Port B pin)
+    Pi GPIOs are set up immediately. The expanders are brought up by a
+    background health thread, so the web UI is serving while they are probed;
+    the same thread then re-checks every chip each MCP_HEALTH_CHECK_SECONDS,
+    reprograms chips that were reset (brownout) and takes unresponsive ones
+    offline until they answer again. chip_listeners get callback(hw) whenever
+    the set of working chips changes or a chip is reprogrammed.
     """
-    def __init__(self, mcp_address=0x20, bus_num=1, locker_config=None):
+    def __init__(self, mcp_address=0x20, bus_num=1, locker_config=None, scheduler=None,
+                 bus_factory=None, bus_settle_s=0.3, locker_count=DEFAULT_LOCKER_COUNT):
         """
-        locker_config: dict mapping locker_id -> {'type': 'pi'|'mcp', 'pin': int, 'sensor_pin': int}
-        If None, defaults: lockers 1-22 = Pi GPIO, 23-32 = MCP
+        locker_config: dict mapping locker_id -> {'type': 'pi'|'mcp', 'pin': int, 'sensor_pin': int,
+                                                  'address': int, 'bus': int, 'pulse_ms': int}
+        For MCP lockers 'pin' and 'sensor_pin' are chip pins 0-15; sensor_pin defaults
+        to the Port B pin matching the relay pin, address/bus default to
+        mcp_address/bus_num. 'pulse_ms' is optional.
+        If None, locker_count lockers get the default wiring from
+        database.default_locker_rows (1-22 = Pi GPIO, the rest MCP)
+        bus_factory: bus_num -> SMBus-like object (default smbus.SMBus; the
+        simulator passes its own buses)
         """
-        self.locker_config = locker_config or self._default_config()
+        self.scheduler = scheduler or pulse_scheduler
+        self.bus_factory = bus_factory or (smbus.SMBus if HAS_SMBUS else None)
+        self.bus_settle_s = bus_settle_s
+        self.locker_config = locker_config or self._default_config(locker_count)
+        self.mcp_address = mcp_address  # Defaults for MCP lockers without address/bus
+        self.bus_num = bus_num
         self.pi_gpios = {}  # Store GPIO pin numbers for Pi lockers
-        self.mcp_pins = {}  # Store MCP pin indices for MCP lockers
+        self.mcp_pins = {}  # locker_id -> (MCP23017Chip, relay pin) for MCP lockers
+        self.mcp_buses = {}  # bus_num -> SMBus
+        self.mcp_chips = {}  # (bus_num, address) -> MCP23017Chip, only chips that answered
+        self.chip_health = {}  # (bus_num, address) -> ChipHealth for every configured chip
+        self.chip_listeners = []
+        self._chip_lock = threading.Lock()  # Serialises changes to mcp_chips / mcp_pins / chip_health
+        # Held by a health pass and by reconfigure, so a chip is never probed
+        # or programmed by both at once
+        self._rewire_lock = threading.RLock()
+        self._bus_lock = threading.Lock()  # Guards mcp_buses
+        self._ready = threading.Event()
+        self._health_wake = threading.Event()
+        self._closed = False
         
         # Initialize Pi GPIOs
         if HAS_GPIO:
@@ -177,208 +591,441 @@ class HybridHardware(HardwareInterface):
             GPIO.setwarnings(False)
             for locker_id, config in self.locker_config.items():
                 if config['type'] == 'pi':
-                    gpio_pin = config['pin']
-                    GPIO.setup(gpio_pin, GPIO.OUT)
-                    GPIO.output(gpio_pin, GPIO.LOW)
-                    self.pi_gpios[locker_id] = gpio_pin
-                    # Setup sensor pin if provided
-                    if 'sensor_pin' in config:
-                        GPIO.setup(config['sensor_pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                    self._setup_pi_locker(locker_id, config)
         else:
             print("[HybridHardware] Warning: RPi.GPIO not available, Pi GPIOs will not work")
         
-        # Initialize MCP23017
-        self.mcp_bus = None
-        self.mcp_addr = None
-        if HAS_SMBUS:
-            try:
-                self.mcp_bus = smbus.SMBus(bus_num)
-                self.mcp_addr = mcp_address
-                
-                # MCP23017 constants
-                self.IODIRA = 0x00
-                self.IODIRB = 0x01
-                self.GPIOA = 0x12
-                self.GPIOB = 0x13
-                self.GPPUA = 0x0C  # Pull-up register A
-                self.GPPUB = 0x0D  # Pull-up register B
-                
+        self._build_sensor_maps()
+        
+        # MCP23017 chips come up in the background
+        topology = self._mcp_topology(self.locker_config)
+        if topology and self.bus_factory:
+            threading.Thread(target=self._health_loop, name='mcp-health', daemon=True).start()
+        else:
+            if topology:
+                print("[HybridHardware] Warning: smbus not available, MCP23017 will not work")
+            print(f"[HybridHardware] Initialized: {len(self.pi_gpios)} Pi GPIOs")
+            self._ready.set()
+    
+    def _setup_pi_locker(self, locker_id, config):
+        gpio_pin = config['pin']
+        GPIO.setup(gpio_pin, GPIO.OUT)
+        GPIO.output(gpio_pin, GPIO.LOW)
+        self.pi_gpios[locker_id] = gpio_pin
+        # Setup sensor pin if provided
+        if config.get('sensor_pin') is not None:
+            GPIO.setup(config['sensor_pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    
+    def _mcp_topology(self, locker_config):
+        """Group MCP lockers by chip: (bus_num, address) -> [(locker_id, relay pin, sensor pin)]"""
+        topology = {}
+        for locker_id, config in sorted(locker_config.items()):
+            if config['type'] != 'mcp':
+                continue
+            pin = config.get('pin')
+            if pin is None or not 0 <= pin < 16:
+                print(f"[HybridHardware] Locker {locker_id}: invalid MCP pin {pin}, skipping")
+                continue
+            sensor_pin = config.get('sensor_pin')
+            if sensor_pin is None:
+                sensor_pin = 8 + pin % 8  # Matching Port B pin
+            key = (config.get('bus') or self.bus_num, config.get('address') or self.mcp_address)
+            topology.setdefault(key, []).append((locker_id, pin, sensor_pin))
+        return topology
+    
+    def _get_bus(self, bus_num):
+        # One handle per bus, whichever thread asks first
+        with self._bus_lock:
+            if bus_num not in self.mcp_buses:
+                self.mcp_buses[bus_num] = InstrumentedBus(self.bus_factory(bus_num), bus_num)
                 # Wait a bit for I2C bus to stabilize
-                time.sleep(0.3)
+                time.sleep(self.bus_settle_s)
+            return self.mcp_buses[bus_num]
+    
+    def _probe_chip(self, bus, address, attempts=8):
+        """Test MCP23017 communication using write-then-read approach (more reliable than reading immediately)."""
+        for attempt in range(attempts):
+            try:
+                # Step 1: Write to IODIRA register (set all to inputs = 0xFF)
+                # This "wakes up" the device and is less likely to timeout
+                bus.write_byte_data(address, MCP23017Chip.IODIRA, 0xFF)
+                time.sleep(0.1)  # Give device time to process
                 
-                # Test MCP23017 communication using write-then-read approach
-                # This is more reliable than reading immediately
-                mcp_working = False
-                for attempt in range(8):  # More retries
-                    try:
-                        # Step 1: Write to IODIRA register (set all to inputs = 0xFF)
-                        # This "wakes up" the device and is less likely to timeout
-                        self.mcp_bus.write_byte_data(self.mcp_addr, self.IODIRA, 0xFF)
-                        time.sleep(0.1)  # Give device time to process
-                        
-                        # Step 2: Read back IODIRA to verify communication works
-                        test_read = self.mcp_bus.read_byte_data(self.mcp_addr, self.IODIRA)
-                        
-                        # If we get here, communication is working!
-                        mcp_working = True
-                        print(f"[HybridHardware] MCP23017 detected at address 0x{self.mcp_addr:x} (IODIRA=0x{test_read:02x})")
-                        break
-                    except (OSError, IOError) as e:
-                        err_code = e.errno if hasattr(e, 'errno') else None
-                        err_msg = str(e)
-                        
-                        if attempt < 7:
-                            # Exponential backoff: wait longer each time
-                            wait_time = 0.15 * (attempt + 1)
-                            time.sleep(wait_time)
-                            continue
-                        else:
-                            # Final attempt failed
-                            print(f"[HybridHardware] MCP23017 not responding at address 0x{self.mcp_addr:x}")
-                            print(f"[HybridHardware] Error: {err_msg} (errno: {err_code})")
-                            print("[HybridHardware] Continuing with Pi GPIO only. MCP lockers will not work.")
-                            print("[HybridHardware] Troubleshooting:")
-                            print("  - Verify MCP23017 is powered (check VDD pin)")
-                            print("  - Check I2C pull-up resistors (4.7kΩ on SDA/SCL to 3.3V)")
-                            print("  - Verify SDA/SCL connections (Pi pins 3 and 5)")
-                            print("  - Check RESET pin is HIGH (connected to 3.3V or 5V)")
-                            print("  - Try: sudo i2cget -y 1 0x20 0x00  (to test manual communication)")
-                            self.mcp_bus = None
-                            self.mcp_addr = None
+                # Step 2: Read back IODIRA to verify communication works
+                test_read = bus.read_byte_data(address, MCP23017Chip.IODIRA)
                 
-                if mcp_working:
-                    try:
-                        # Configure Port A as outputs (for relays)
-                        self.mcp_bus.write_byte_data(self.mcp_addr, self.IODIRA, 0x00)
-                        time.sleep(0.01)  # Small delay between writes
-                        self.mcp_bus.write_byte_data(self.mcp_addr, self.GPIOA, 0x00)
-                        time.sleep(0.01)
-                        
-                        # Configure Port B as inputs (for sensors) with pull-ups
-                        self.mcp_bus.write_byte_data(self.mcp_addr, self.IODIRB, 0xFF)
-                        time.sleep(0.01)
-                        self.mcp_bus.write_byte_data(self.mcp_addr, self.GPPUB, 0xFF)
-                        
-                        # Map MCP lockers to pin indices
-                        mcp_pin_index = 0
-                        for locker_id, config in sorted(self.locker_config.items()):
-                            if config['type'] == 'mcp':
-                                self.mcp_pins[locker_id] = mcp_pin_index
-                                mcp_pin_index += 1
-                                if mcp_pin_index >= 10:  # Only 10 MCP pins available
-                                    break
-                        
-                        print(f"[HybridHardware] Initialized: {len(self.pi_gpios)} Pi GPIOs, {len(self.mcp_pins)} MCP pins")
-                    except Exception as e:
-                        print(f"[HybridHardware] MCP23017 configuration failed: {e}")
-                        print("[HybridHardware] Continuing with Pi GPIO only.")
-                        self.mcp_bus = None
-                        self.mcp_addr = None
+                # If we get here, communication is working!
+                print(f"[HybridHardware] MCP23017 detected at address 0x{address:x} (IODIRA=0x{test_read:02x})")
+                return True
+            except (OSError, IOError) as e:
+                if attempt < attempts - 1:
+                    i2c_retries.inc(bus.bus_num, f'0x{address:02x}')
+                    # Exponential backoff: wait longer each time
+                    time.sleep(0.15 * (attempt + 1))
+                    continue
+                # Final attempt failed
+                if attempts == 1:
+                    return False  # Periodic re-probe: stay quiet
+                err_code = e.errno if hasattr(e, 'errno') else None
+                print(f"[HybridHardware] MCP23017 not responding at address 0x{address:x}")
+                print(f"[HybridHardware] Error: {e} (errno: {err_code})")
+                print("[HybridHardware] Lockers on this chip will not work until it answers.")
+                print("[HybridHardware] Troubleshooting:")
+                print("  - Verify MCP23017 is powered (check VDD pin)")
+                print("  - Check I2C pull-up resistors (4.7kΩ on SDA/SCL to 3.3V)")
+                print("  - Verify SDA/SCL connections (Pi pins 3 and 5)")
+                print("  - Check RESET pin is HIGH (connected to 3.3V or 5V)")
+                print("  - Check A0-A2 address pins match the configured address")
+                print(f"  - Try: sudo i2cget -y 1 0x{address:x} 0x00  (to test manual communication)")
+        return False
+    
+    def _init_chip(self, bus_num, address, lockers):
+        """Program a chip that answered its probe and publish its relays. Returns True on success."""
+        try:
+            bus = self._get_bus(bus_num)
+            chip = MCP23017Chip(bus, bus_num, address)
+            # Sensors first: a pin wired as a sensor is never driven as an output
+            for locker_id, _, sensor_pin in lockers:
+                chip.add_sensor(locker_id, sensor_pin)
+            for locker_id, pin, _ in lockers:
+                if chip.input_mask & (1 << pin):
+                    print(f"[HybridHardware] Locker {locker_id}: relay pin {pin} on {chip} is wired as a sensor, skipping relay")
+                    continue
+                chip.add_relay(locker_id, pin)
+            
+            chip.configure(self.scheduler)
+            with self._chip_lock:
+                self.mcp_chips[(bus_num, address)] = chip
+                for locker_id, pin in chip.relay_pins.items():
+                    self.mcp_pins[locker_id] = (chip, pin)
+            return True
+        except Exception as e:
+            print(f"[HybridHardware] MCP23017 0x{address:x} on bus {bus_num} init failed: {e}")
+            print("[HybridHardware] Lockers on this chip will not work until it answers.")
+            return False
+    
+    def _drop_chip(self, key):
+        with self._chip_lock:
+            chip = self.mcp_chips.pop(key, None)
+            if chip is not None:
+                for locker_id in chip.relay_pins:
+                    if self.mcp_pins.get(locker_id, (None,))[0] is chip:
+                        del self.mcp_pins[locker_id]
+        return chip
+    
+    def _health_loop(self):
+        first = True
+        while not self._closed:
+            self._health_wake.clear()
+            try:
+                # Full probe with retries at bring-up, a single attempt afterwards
+                self._check_chips(attempts=8 if first else 1)
             except Exception as e:
-                print(f"[HybridHardware] MCP23017 init failed: {e}")
-                print("[HybridHardware] Continuing with Pi GPIO only. MCP lockers will not work.")
-                self.mcp_bus = None
-                self.mcp_addr = None
-        else:
-            print("[HybridHardware] Warning: smbus not available, MCP23017 will not work")
+                print(f"[HybridHardware] Health check failed: {e}")
+            if first:
+                first = False
+                print(f"[HybridHardware] Initialized: {len(self.pi_gpios)} Pi GPIOs, "
+                      f"{len(self.mcp_pins)} MCP relays on {len(self.mcp_chips)} chip(s)")
+                self._ready.set()
+            self._health_wake.wait(MCP_HEALTH_CHECK_SECONDS)
     
-    def _default_config(self):
-        """Default configuration: lockers 1-22 = Pi GPIO, 23-32 = MCP"""
-        config = {}
-        # Pi GPIO pins (using available GPIOs, avoiding reserved ones)
-        # Common available GPIOs: 4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27
-        pi_gpios = [4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 2, 3, 14, 15, 8]
-        pi_sensors = [7, 8, 9, 10, 11, 14, 15, 2, 3, 4, 5, 6, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23]
+    def _check_chips(self, attempts=1):
+        """Bring up missing chips, verify working ones. Notifies chip_listeners on any change."""
+        with self._rewire_lock:
+            changed = self._check_chips_locked(attempts)
+        if changed:
+            self._build_sensor_maps()
+            for callback in list(self.chip_listeners):
+                try:
+                    callback(self)
+                except Exception as e:
+                    print(f"[HybridHardware] Chip listener failed: {e}")
+    
+    def _check_chips_locked(self, attempts):
+        changed = False
+        for key, lockers in sorted(self._mcp_topology(self.locker_config).items()):
+            if self._closed:
+                return changed
+            bus_num, address = key
+            with self._chip_lock:
+                health = self.chip_health.setdefault(key, ChipHealth(bus_num, address))
+            chip = self.mcp_chips.get(key)
+            
+            if chip is None:
+                try:
+                    answered = self._probe_chip(self._get_bus(bus_num), address, attempts)
+                except Exception as e:
+                    print(f"[HybridHardware] Probe of 0x{address:x} on bus {bus_num} failed: {e}")
+                    answered = False
+                if answered and self._init_chip(bus_num, address, lockers):
+                    if health.state == 'down':
+                        print(f"[HybridHardware] MCP23017 0x{address:x} on bus {bus_num} is back online")
+                    health.state, health.failures, health.last_seen = 'up', 0, time.time()
+                    changed = True
+                else:
+                    health.state = 'down'
+                continue
+            
+            try:
+                iodir, gppu = chip.read_config()
+            except (OSError, IOError) as e:
+                health.failures += 1
+                if health.failures >= MCP_HEALTH_FAILURES:
+                    print(f"[HybridHardware] {chip} stopped responding ({e}), taking it offline")
+                    self._drop_chip(key)
+                    health.state = 'down'
+                    changed = True
+                continue
+            
+            health.failures, health.last_seen = 0, time.time()
+            if iodir != chip.iodir or gppu != chip.iodir:
+                # A reset chip comes back with every pin an unpulled input and its latches cleared
+                print(f"[HybridHardware] {chip} was reset (IODIR=0x{iodir:04x} GPPU=0x{gppu:04x}), reprogramming")
+                health.resets += 1
+                chip.configure(self.scheduler)
+                changed = True
+        return changed
+    
+    def wait_ready(self, timeout=None):
+        """Block until the first MCP bring-up pass has finished. Returns False on timeout."""
+        return self._ready.wait(timeout)
+    
+    def health(self):
+        return {
+            'ready': self._ready.is_set(),
+            'chips': [health.to_dict() for _, health in self._chip_health_items()],
+        }
+    
+    def _chip_health_items(self):
+        with self._chip_lock:
+            return sorted(self.chip_health.items())
+    
+    def close(self):
+        self._closed = True
+        self._health_wake.set()
+        # Offline chips too: their latch may still be ours
+        for (bus_num, address), _ in self._chip_health_items():
+            release_output_latch(self.mcp_buses.get(bus_num), bus_num, address)
+    
+    @timed('reconfigure')
+    def reconfigure(self, locker_config):
+        """
+        Apply a new locker_config in place, touching only what changed:
+        Pi pins of changed lockers are set up again, and only chips whose set
+        of lockers/pins changed are reprogrammed. Buses stay open and chips
+        that already answered are not probed again. Runs in milliseconds
+        unless a new chip has to be probed. Returns the changed locker ids.
+        """
+        # No health pass runs while the wiring changes under it
+        with self._rewire_lock:
+            return self._rewire(locker_config)
+    
+    def _rewire(self, locker_config):
+        old_config = self.locker_config
+        changed = {locker_id for locker_id in set(old_config) | set(locker_config)
+                   if old_config.get(locker_id) != locker_config.get(locker_id)}
+        if not changed:
+            return changed
+        self.locker_config = locker_config
         
-        for i in range(1, 23):  # Lockers 1-22
-            config[i] = {
-                'type': 'pi',
-                'pin': pi_gpios[i-1] if i-1 < len(pi_gpios) else 4,
-                'sensor_pin': pi_sensors[i-1] if i-1 < len(pi_sensors) else 7
-            }
+        # Pi GPIOs: drop the old assignment, set up the new one
+        for locker_id in changed:
+            self.pi_gpios.pop(locker_id, None)
+            config = locker_config.get(locker_id)
+            if HAS_GPIO and config and config['type'] == 'pi':
+                self._setup_pi_locker(locker_id, config)
         
-        for i in range(23, 33):  # Lockers 23-32
-            config[i] = {
-                'type': 'mcp',
-                'pin': i - 23,  # MCP pin index 0-9
-                'sensor_pin': i - 23  # Same pin for sensor (Port B)
-            }
+        # MCP chips: only those whose (locker, relay pin, sensor pin) list changed
+        old_topology = self._mcp_topology(old_config)
+        new_topology = self._mcp_topology(locker_config)
+        rewired = [key for key in set(old_topology) | set(new_topology)
+                   if old_topology.get(key) != new_topology.get(key)]
+        answered = set()
+        with self._chip_lock:
+            for key in rewired:
+                if self.mcp_chips.pop(key, None) is not None:
+                    answered.add(key)
+                for locker_id, _, _ in old_topology.get(key, []):
+                    self.mcp_pins.pop(locker_id, None)
+                if key not in new_topology:
+                    self.chip_health.pop(key, None)
+        for key in sorted(rewired):
+            if key in answered and key in new_topology:
+                chip_bus, address = key
+                self._init_chip(chip_bus, address, new_topology[key])
+        if self.bus_factory and any(key in new_topology and key not in answered for key in rewired):
+            self._health_wake.set()  # New chips are probed in the background
         
+        self._build_sensor_maps()
+        print(f"[HybridHardware] Rewired locker(s) {', '.join(map(str, sorted(changed)))}")
+        return changed
+    
+    def _build_sensor_maps(self):
+        """Precompute what get_all_lockers_states() needs so a snapshot is just reads and bit tests."""
+        # (locker_id, BCM pin) for every Pi locker with a sensor
+        self.pi_sensor_pins = [
+            (locker_id, config['sensor_pin'])
+            for locker_id, config in sorted(self.locker_config.items())
+            if config['type'] == 'pi' and config.get('sensor_pin') is not None
+        ]
+        # Chips that have at least one sensor; each carries its (locker_id, mask) list
+        with self._chip_lock:
+            self.sensor_chips = [chip for chip in self.mcp_chips.values() if chip.sensor_masks]
+        self.mcp_sensor_chip = {
+            locker_id: (chip, mask)
+            for chip in self.sensor_chips
+            for locker_id, mask in chip.sensor_masks
+        }
+    
+    def _default_config(self, locker_count):
+        """Default configuration, matching the rows init_db() seeds for a fresh install"""
+        config = {}
+        for locker_id, hw_type, pin, sensor_pin, address, bus in default_locker_rows(1, locker_count):
+            config[locker_id] = {'type': hw_type, 'pin': pin, 'sensor_pin': sensor_pin}
+            if hw_type == 'mcp':
+                config[locker_id].update(address=address, bus=bus)
         return config
     
+    def _set_mcp_relay(self, chip, pin, state):
+        chip.latch.set_pin(pin, state)
+
+    def _report_pulse_error(self, locker_id, future):
+        error = future.exception()
+        if error is not None:
+            print(f"[HybridHardware] Error opening MCP locker {locker_id}: {error}")
+            self._health_wake.set()  # Check the chip now rather than at the next interval
+
+    @timed('open_locker')
     def open_locker(self, locker_id):
+        """
+        Start the solenoid pulse for a locker and return immediately.
+        Returns a Future resolved when the relay drops, or None if the locker
+        cannot be actuated.
+        """
         config = self.locker_config.get(locker_id)
         if not config:
             print(f"[HybridHardware] Locker {locker_id} not configured")
-            return
+            return None
+        
+        pulse_ms = config.get('pulse_ms') or DEFAULT_PULSE_MS
         
         if config['type'] == 'pi':
             if HAS_GPIO and locker_id in self.pi_gpios:
                 gpio_pin = self.pi_gpios[locker_id]
-                print(f"[HybridHardware] Opening locker {locker_id} (Pi GPIO {gpio_pin})")
-                GPIO.output(gpio_pin, GPIO.HIGH)
-                time.sleep(1)
-                GPIO.output(gpio_pin, GPIO.LOW)
+                print(f"[HybridHardware] Opening locker {locker_id} (Pi GPIO {gpio_pin}, {pulse_ms} ms)")
+                return self.scheduler.pulse(
+                    (self, locker_id),
+                    lambda: GPIO.output(gpio_pin, GPIO.HIGH),
+                    lambda: GPIO.output(gpio_pin, GPIO.LOW),
+                    pulse_ms)
             else:
                 print(f"[HybridHardware] Pi GPIO not available for locker {locker_id}")
         elif config['type'] == 'mcp':
-            if self.mcp_bus and self.mcp_addr and locker_id in self.mcp_pins:
-                try:
-                    pin_index = self.mcp_pins[locker_id]
-                    port = self.GPIOA if pin_index < 8 else self.GPIOB
-                    pin = pin_index if pin_index < 8 else pin_index - 8
-                    
-                    print(f"[HybridHardware] Opening locker {locker_id} (MCP pin {pin_index})")
-                    current = self.mcp_bus.read_byte_data(self.mcp_addr, port)
-                    new_val = current | (1 << pin)
-                    self.mcp_bus.write_byte_data(self.mcp_addr, port, new_val)
-                    time.sleep(1)
-                    new_val = current & ~(1 << pin)
-                    self.mcp_bus.write_byte_data(self.mcp_addr, port, new_val)
-                except Exception as e:
-                    print(f"[HybridHardware] Error opening MCP locker {locker_id}: {e}")
+            if locker_id in self.mcp_pins:
+                chip, pin = self.mcp_pins[locker_id]
+                print(f"[HybridHardware] Opening locker {locker_id} ({chip} pin {pin}, {pulse_ms} ms)")
+                future = self.scheduler.pulse(
+                    (self, locker_id),
+                    lambda: self._set_mcp_relay(chip, pin, True),
+                    lambda: self._set_mcp_relay(chip, pin, False),
+                    pulse_ms)
+                future.add_done_callback(lambda f: self._report_pulse_error(locker_id, f))
+                return future
             else:
                 print(f"[HybridHardware] MCP not available for locker {locker_id} (chip not connected)")
+        return None
     
+    @timed('read_door_state')
     def read_door_state(self, locker_id):
         config = self.locker_config.get(locker_id)
         if not config:
             return True  # Default: closed
         
         if config['type'] == 'pi':
-            if HAS_GPIO and 'sensor_pin' in config:
+            if HAS_GPIO and config.get('sensor_pin') is not None:
                 sensor_pin = config['sensor_pin']
                 state = GPIO.input(sensor_pin)
                 # Assuming pull-up: LOW (0) = door closed, HIGH (1) = door open
                 return state == GPIO.LOW
             return True  # Default: closed
         elif config['type'] == 'mcp':
-            if self.mcp_bus and self.mcp_addr and locker_id in self.mcp_pins:
+            if locker_id in self.mcp_sensor_chip:
+                chip, mask = self.mcp_sensor_chip[locker_id]
                 try:
-                    pin_index = self.mcp_pins[locker_id]
-                    port = self.GPIOB  # Sensors on Port B
-                    pin = pin_index if pin_index < 8 else pin_index - 8
-                    
-                    val = self.mcp_bus.read_byte_data(self.mcp_addr, port)
-                    is_closed = not ((val >> pin) & 1)
-                    return is_closed
+                    return not (chip.read_inputs() & mask)
                 except Exception as e:
                     print(f"[HybridHardware] Error reading MCP sensor for locker {locker_id}: {e}")
                     return True  # Default: closed
             return True  # Default: closed (MCP not available)
+        return True
     
+    @timed('get_all_lockers_states')
     def get_all_lockers_states(self):
-        states = {}
-        for locker_id in range(1, 33):  # 32 lockers
-            states[locker_id] = self.read_door_state(locker_id)
+        """
+        Snapshot every door sensor: one pass over the Pi sensor pins and a
+        single GPIOA+GPIOB block read per MCP chip, decoded with the masks
+        from _build_sensor_maps(). Unreadable sensors default to closed.
+        """
+        states = dict.fromkeys(self.locker_config, True)  # Default: closed
+        
+        if HAS_GPIO:
+            low = GPIO.LOW
+            for locker_id, sensor_pin in self.pi_sensor_pins:
+                # Assuming pull-up: LOW (0) = door closed, HIGH (1) = door open
+                states[locker_id] = GPIO.input(sensor_pin) == low
+        
+        for chip in self.sensor_chips:
+            try:
+                inputs = chip.read_inputs()
+            except Exception as e:
+                print(f"[HybridHardware] Error reading MCP sensors on {chip}: {e}")
+                continue
+            for locker_id, mask in chip.sensor_masks:
+                states[locker_id] = not (inputs & mask)
+        
         return states
 
-def get_hardware(use_mock=True, locker_config=None):
+# Held for the life of the process that drives the real GPIO/I2C lines
+HARDWARE_LOCK_FILE = '/tmp/smartlocker-hardware.lock'
+_hardware_lock = None
+
+def claim_hardware(lock_file=HARDWARE_LOCK_FILE):
+    """
+    Make this process the only hardware owner. Raises RuntimeError if another
+    process (a second server worker, a reloader child, a stray app.py) holds it.
+    """
+    global _hardware_lock
+    if _hardware_lock is not None:
+        return
+    import fcntl
+    f = open(lock_file, 'a+')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.seek(0)
+        owner = f.read().strip() or 'unknown'
+        f.close()
+        raise RuntimeError(f"Locker hardware is already owned by process {owner} ({lock_file})")
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _hardware_lock = f
+
+def get_hardware(use_mock=True, locker_config=None, locker_count=DEFAULT_LOCKER_COUNT, simulate=False):
+    if simulate:
+        # Simulated MCP23017 bank for load testing off-device (see simulator.py)
+        from simulator import HardwareSimulator
+        simulator = HardwareSimulator(locker_count=locker_count)
+        simulator.clock.start()
+        return simulator.hardware()
     if use_mock:
-        return MockMCP23017()
+        return MockMCP23017(locker_count=locker_count)
     else:
+        # Two processes toggling the same relays would fire solenoids at random
+        claim_hardware()
         try:
-            return HybridHardware(locker_config=locker_config)
+            return HybridHardware(locker_config=locker_config, locker_count=locker_count)
         except Exception as e:
             print(f"Failed to init real hardware: {e}. Falling back to Mock.")
-            return MockMCP23017()
+            return MockMCP23017(locker_count=locker_count)
@@ -0,0 +1,65 @@
+import json
+import os
+
+TRANSLATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'translations')
+DEFAULT_LANGUAGE = 'fr'
+
+
+class Language:
+    def __init__(self, code, name, dir, strings):
+        self.code = code
+        self.name = name
+        self.dir = dir
+        self.strings = strings
+
+
+class TranslationCatalog:
+    """
+    UI strings, one translations/<code>.json file per language:
+        {"name": "Français", "dir": "ltr", "strings": {"key": "text", ...}}
+    Files are read once by load(). Keys missing from a language are filled
+    from the default language at load time, so every language is a complete
+    flat dict and a template lookup is a single dict access. Adding a
+    language is adding a file.
+    """
+    def __init__(self, directory=TRANSLATIONS_DIR, default=DEFAULT_LANGUAGE):
+        self.directory = directory
+        self.default = default
+        self._languages = {}
+
+    def load(self):
+        raw = {}
+        for filename in sorted(os.listdir(self.directory)):
+            code, ext = os.path.splitext(filename)
+            if ext != '.json':
+                continue
+            with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                raw[code] = json.load(f)
+        if self.default not in raw:
+            raise ValueError(f"No catalog for default language '{self.default}' in {self.directory}")
+
+        fallback = raw[self.default]['strings']
+        languages = {}
+        # Default language first so it leads the language switcher
+        for code in sorted(raw, key=lambda c: (c != self.default, c)):
+            data = raw[code]
+            strings = dict(fallback)
+            strings.update(data.get('strings', {}))
+            languages[code] = Language(code, data.get('name', code.upper()), data.get('dir', 'ltr'), strings)
+        self._languages = languages
+        print(f"[i18n] Loaded languages: {', '.join(languages)}")
+
+    def __contains__(self, code):
+        return code in self._languages
+
+    def get(self, code):
+        """Language for code, or the default language if code is unknown."""
+        return self._languages.get(code) or self._languages[self.default]
+
+    @property
+    def languages(self):
+        return list(self._languages.values())
+
+
+# Shared by all routes in this process
+catalog = TranslationCatalog()
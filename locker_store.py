@@ -0,0 +1,124 @@
+import threading
+
+from database import db_connection, after_commit
+
+# Columns of the lockers table mirrored in memory
+COLUMNS = ('id', 'is_occupied', 'door_closed', 'otp_code', 'hardware_type', 'gpio_pin',
+           'sensor_pin', 'special_code', 'pulse_ms', 'mcp_address', 'i2c_bus', 'size',
+           'state', 'otp_expires_at')
+
+
+class LockerRecord:
+    """
+    Compact snapshot of one lockers row. Records are never mutated once
+    published, so a reader always sees a consistent locker. Supports
+    record['column'] like sqlite3.Row so templates work unchanged.
+    """
+    __slots__ = COLUMNS
+
+    def __init__(self, **fields):
+        for name in COLUMNS:
+            setattr(self, name, fields.get(name))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def replace(self, **changes):
+        fields = {name: getattr(self, name) for name in COLUMNS}
+        fields.update(changes)
+        return LockerRecord(**fields)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in COLUMNS}
+
+
+class LockerStore:
+    """
+    Authoritative in-memory copy of the lockers table.
+    This process is the only writer, so the table is loaded once and reads
+    never touch SQLite. update() writes through to the database and applies
+    the change in memory once the surrounding transaction commits, bumping
+    version and notifying subscribers with (record, changes, version).
+    """
+    def __init__(self):
+        self._records = {}
+        self._ordered = []  # Replaced (never mutated) on change so readers can iterate safely
+        self._positions = {}  # locker_id -> index in _ordered
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def load(self):
+        with db_connection() as conn:
+            rows = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM lockers ORDER BY id").fetchall()
+        with self._lock:
+            self._ordered = [LockerRecord(**dict(row)) for row in rows]
+            self._records = {record.id: record for record in self._ordered}
+            self._positions = {record.id: i for i, record in enumerate(self._ordered)}
+            self.version += 1
+
+    def subscribe(self, callback):
+        """callback(record, changes, version) after every committed update."""
+        self._listeners.append(callback)
+
+    def get(self, locker_id):
+        return self._records.get(locker_id)
+
+    def all(self):
+        """All lockers ordered by id."""
+        return self._ordered
+
+    def ids(self):
+        return [record.id for record in self._ordered]
+
+    def update(self, locker_id, expect=None, **changes):
+        """
+        Write changed columns through to SQLite; memory follows on commit.
+        expect={column: value or tuple of values} turns it into a
+        compare-and-set checked by the UPDATE itself, so a change another
+        thread committed since the caller looked is never overwritten.
+        Returns False if the row did not match (nothing written).
+        """
+        unknown = (set(changes) | set(expect or ())) - set(COLUMNS[1:])
+        if unknown:
+            raise ValueError(f"Unknown locker columns: {', '.join(sorted(unknown))}")
+        if not changes:
+            return True
+
+        assignments = ', '.join(f'{name} = ?' for name in changes)
+        conditions, params = ['id = ?'], [locker_id]
+        for name, allowed in (expect or {}).items():
+            allowed = allowed if isinstance(allowed, tuple) else (allowed,)
+            conditions.append(f"{name} IN ({', '.join('?' * len(allowed))})")
+            params.extend(allowed)
+        with db_connection() as conn:
+            cursor = conn.execute(f'UPDATE lockers SET {assignments}, updated_at = CURRENT_TIMESTAMP '
+                                  f'WHERE {" AND ".join(conditions)}', (*changes.values(), *params))
+            if expect and not cursor.rowcount:
+                return False
+            after_commit(lambda: self._apply(locker_id, changes))
+        return True
+
+    def _apply(self, locker_id, changes):
+        with self._lock:
+            record = self._records.get(locker_id)
+            if record is None:
+                return
+            record = record.replace(**changes)
+            self._records[locker_id] = record
+            ordered = list(self._ordered)
+            ordered[self._positions[locker_id]] = record
+            self._ordered = ordered
+            self.version += 1
+            version = self.version
+            # Called under the commit lock (see database.after_commit), so
+            # subscribers see changes in commit order
+            for callback in list(self._listeners):
+                try:
+                    callback(record, changes, version)
+                except Exception as e:
+                    print(f"[LockerStore] Listener failed for locker {locker_id}: {e}")
+
+
+# Shared by all routes in this process
+locker_store = LockerStore()
@@ -0,0 +1,304 @@
+import heapq
+import itertools
+import math
+import queue
+import threading
+import time
+
+from database import db_connection, after_commit
+
+# Locker states (lockers.state)
+IDLE = 'idle'                          # Empty, door closed
+DELIVERY_OPENING = 'delivery_opening'  # OTP issued, waiting for the door to open
+DELIVERY_OPEN = 'delivery_open'        # Courier loading, waiting for the door to close
+OCCUPIED = 'occupied'                  # Closed with a parcel inside
+PICKUP_OPENING = 'pickup_opening'      # Code accepted, waiting for the door to open
+PICKUP_OPEN = 'pickup_open'            # Customer collecting, waiting for the door to close
+RETURN_DUE = 'return_due'              # Code expired uncollected, waiting for the courier
+
+OPENING_STATES = (DELIVERY_OPENING, PICKUP_OPENING)
+
+# A door that has not opened this long after its pulse is rolled back
+DEFAULT_OPEN_TIMEOUT_S = 15
+# How often open doors are read while waiting for them to close, when their
+# sensors have no interrupt line
+DEFAULT_DOOR_RECHECK_S = 1.0
+# Longest wait for the next code expiry, so a clock step (NTP after boot on
+# the Pi) moves expiries with it
+EXPIRY_WAKEUP_S = 60
+
+
+def _expires(record):
+    # NaN would sit at the top of the heap forever, never due
+    return bool(record.otp_code and record.otp_expires_at and math.isfinite(record.otp_expires_at))
+
+
+class OccupancyTracker:
+    """
+    Per-locker state machine driving occupancy from the door sensors:
+
+        idle -> delivery_opening -> delivery_open -> occupied
+             -> pickup_opening -> pickup_open -> idle (picked up)
+        occupied -> return_due (code expired) -> pickup_opening (courier)
+
+    Routes only start a transition (begin_delivery/begin_pickup, inside
+    their transaction) and hand over the pulse Future (watch_pulse). The
+    rest happens on one event-loop thread fed by door events, pulse
+    results and a heap of deadlines: a locker becomes occupied when the
+    courier closes the door, and empty when the customer closes it after
+    it was opened. A transition whose door never opens (pulse failed, or
+    no open within open_timeout_s of the pulse) is rolled back, so the
+    OTP stays valid or the locker goes back to the free pool.
+    Sensors that only report when read are read every door_recheck_s while
+    a door is open, from the same deadline heap.
+    Every transition is a compare-and-set on the state it was decided from
+    (see _transition), so request threads and the loop thread never
+    overwrite each other's changes even while a route's transaction is
+    still open.
+    Codes expire from a second heap keyed by lockers.otp_expires_at (wall
+    clock), rebuilt from the locker store at start: an occupied locker whose
+    code lapses loses the code and waits for the courier to take the parcel
+    back (return_due). Codes from before expiry was configured get a full
+    otp_lifetime_s from the start.
+    """
+    def __init__(self, store, door_monitor, open_timeout_s=DEFAULT_OPEN_TIMEOUT_S,
+                 door_recheck_s=DEFAULT_DOOR_RECHECK_S, otp_lifetime_s=None):
+        self.store = store
+        self.door_monitor = door_monitor
+        self.open_timeout_s = open_timeout_s
+        self.otp_lifetime_s = otp_lifetime_s  # Default code lifetime (None = codes never expire)
+        self.door_recheck_s = door_recheck_s
+        self._events = queue.Queue()
+        self._deadlines = []  # heap of (deadline, seq, locker_id); locker_id None = door recheck
+        self._armed = {}  # locker_id -> seq of its live deadline
+        self._awaiting_close = set()  # Lockers open for a delivery or pickup
+        self._recheck_armed = False
+        self._expiries = []  # heap of (otp_expires_at, locker_id, otp_code); stale entries are skipped
+        self._rollback = {}  # locker_id -> changes to restore if a delivery/pickup never opens
+        self._seq = itertools.count()
+        self._thread = None
+
+    def start(self):
+        """Subscribe to door events, resume transitions left over from a restart and start the loop."""
+        self.door_monitor.subscribe(self._on_door)
+        self._thread = threading.Thread(target=self._run, name='occupancy', daemon=True)
+        self._thread.start()
+        self._events.put(('resume', None, None))
+
+    # --- Called from request threads ---
+
+    def state(self, locker_id):
+        record = self.store.get(locker_id)
+        return (record.state or IDLE) if record else None
+
+    def begin_delivery(self, locker_id, otp, expires_at=None):
+        """
+        Hand locker_id to a courier with a fresh OTP, valid until expires_at
+        (Unix time; None = no expiry). Joins the caller's transaction.
+        Returns False if the locker changed state meanwhile.
+        """
+        if expires_at is not None and not math.isfinite(expires_at):
+            raise ValueError(f"Code expiry must be a finite time, not {expires_at!r}")
+        record = self.store.get(locker_id)
+        previous = dict(state=record.state or IDLE, otp_code=record.otp_code, otp_expires_at=record.otp_expires_at)
+        with db_connection():
+            if not self._transition(locker_id, previous['state'], state=DELIVERY_OPENING,
+                                    otp_code=otp, otp_expires_at=expires_at):
+                return False
+            after_commit(lambda: self._events.put(('delivery', locker_id, previous)))
+        return True
+
+    def begin_pickup(self, locker_id, returning=False):
+        """
+        Start a pickup. The OTP stays valid until the door has actually
+        opened. returning=True is the courier taking back a parcel (also
+        from return_due). Returns False if there is nothing to pick up.
+        """
+        state = self.state(locker_id)
+        if state in (PICKUP_OPENING, PICKUP_OPEN):
+            return True  # Same customer again; the door is reopened
+        if state != OCCUPIED and not (returning and state == RETURN_DUE):
+            return False
+        with db_connection():
+            if not self._transition(locker_id, state, state=PICKUP_OPENING):
+                return False  # Expired or taken meanwhile
+            after_commit(lambda: self._events.put(('pickup', locker_id, dict(state=state))))
+        return True
+
+    def _transition(self, locker_id, from_states, **changes):
+        # Compare-and-set against the state the caller decided from. The
+        # UPDATE waits for any open transaction on the row, so a transition
+        # a route has written but not yet committed is seen here
+        if not isinstance(from_states, tuple):
+            from_states = (from_states,)
+        return self.store.update(locker_id, expect={'state': from_states}, **changes)
+
+    def watch_pulse(self, locker_id, future):
+        """Feed the result of the solenoid pulse that should open locker_id into the loop."""
+        def done(pulse):
+            ok = pulse.exception() is None and pulse.result() is not None
+            self._events.put(('pulse', locker_id, ok))
+        future.add_done_callback(done)
+
+    # --- Event loop ---
+
+    def _on_door(self, locker_id, closed):
+        self._events.put(('door', locker_id, closed))
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._deadlines:
+                timeout = max(0.0, self._deadlines[0][0] - time.monotonic())
+            if self._expiries:
+                until_expiry = min(max(0.0, self._expiries[0][0] - time.time()), EXPIRY_WAKEUP_S)
+                timeout = until_expiry if timeout is None else min(timeout, until_expiry)
+            try:
+                kind, locker_id, value = self._events.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                try:
+                    getattr(self, '_handle_' + kind)(locker_id, value)
+                except Exception as e:
+                    print(f"[Occupancy] Failed to handle {kind} for locker {locker_id}: {e}")
+            self._expire()
+            self._expire_codes()
+            self._schedule_recheck()
+
+    def _handle_resume(self, _, __):
+        if self.otp_lifetime_s:
+            expires_at = time.time() + self.otp_lifetime_s
+            with db_connection():
+                for record in self.store.all():
+                    if record.otp_code and not _expires(record):
+                        self.store.update(record.id, otp_expires_at=expires_at)
+        # One pass over the lockers in memory, then a linear-time heapify
+        self._expiries = [(record.otp_expires_at, record.id, record.otp_code) for record in self.store.all()
+                          if _expires(record)]
+        heapq.heapify(self._expiries)
+        doors = self.door_monitor.current_states()
+        for record in self.store.all():
+            state = record.state or IDLE
+            if state in OPENING_STATES:
+                self._arm(record.id)
+            elif state in (DELIVERY_OPEN, PICKUP_OPEN):
+                self._awaiting_close.add(record.id)
+                if doors.get(record.id, True):
+                    self._handle_door(record.id, True)
+
+    def _handle_delivery(self, locker_id, previous):
+        self._rollback[locker_id] = previous
+        record = self.store.get(locker_id)
+        if _expires(record):
+            self._push_expiry(record)
+
+    def _handle_pickup(self, locker_id, previous):
+        self._rollback[locker_id] = previous
+
+    def _handle_pulse(self, locker_id, ok):
+        if self.state(locker_id) not in OPENING_STATES:
+            return
+        if not ok:
+            self._roll_back(locker_id, 'the solenoid could not be pulsed')
+            return
+        # Sensors without an interrupt line only report on a read; a door that
+        # was already open produces no event at all
+        if not self.door_monitor.current_states().get(locker_id, True):
+            self._handle_door(locker_id, False)
+        else:
+            self._arm(locker_id)
+
+    def _handle_door(self, locker_id, closed):
+        state = self.state(locker_id)
+        if not closed and state == DELIVERY_OPENING:
+            if self._transition(locker_id, state, state=DELIVERY_OPEN):
+                self._disarm(locker_id)
+                self._rollback.pop(locker_id, None)
+                self._awaiting_close.add(locker_id)
+        elif not closed and state == PICKUP_OPENING:
+            # The code is spent once the door is open
+            if self._transition(locker_id, state, state=PICKUP_OPEN, otp_code=None, otp_expires_at=None):
+                self._disarm(locker_id)
+                self._rollback.pop(locker_id, None)
+                self._awaiting_close.add(locker_id)
+        elif closed and state == DELIVERY_OPEN:
+            self._awaiting_close.discard(locker_id)
+            self._transition(locker_id, state, state=OCCUPIED, is_occupied=1)
+        elif closed and state == PICKUP_OPEN:
+            self._awaiting_close.discard(locker_id)
+            if self._transition(locker_id, state, state=IDLE, is_occupied=0):
+                print(f"[Occupancy] Locker {locker_id} picked up")
+        elif not closed and state in (IDLE, OCCUPIED, RETURN_DUE):
+            print(f"[Occupancy] Locker {locker_id} opened without a delivery or pickup")
+
+    # --- Deadlines ---
+
+    def _arm(self, locker_id):
+        seq = next(self._seq)
+        self._armed[locker_id] = seq
+        heapq.heappush(self._deadlines, (time.monotonic() + self.open_timeout_s, seq, locker_id))
+
+    def _disarm(self, locker_id):
+        # The heap entry is skipped when it comes due
+        self._armed.pop(locker_id, None)
+
+    def _schedule_recheck(self):
+        if self._awaiting_close and not self._recheck_armed and self.door_monitor.needs_polling:
+            self._recheck_armed = True
+            heapq.heappush(self._deadlines, (time.monotonic() + self.door_recheck_s, next(self._seq), None))
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, seq, locker_id = heapq.heappop(self._deadlines)
+            if locker_id is None:
+                # Changes found come back as door events
+                self._recheck_armed = False
+                self.door_monitor.current_states()
+                continue
+            if self._armed.get(locker_id) != seq:
+                continue
+            del self._armed[locker_id]
+            if self.state(locker_id) in OPENING_STATES:
+                self._roll_back(locker_id, f'the door did not open within {self.open_timeout_s} s')
+
+    def _roll_back(self, locker_id, reason):
+        self._disarm(locker_id)
+        record = self.store.get(locker_id)
+        # After a restart the previous state is unknown: a locker that held a parcel keeps it
+        if record.state == PICKUP_OPENING:
+            guess = dict(state=OCCUPIED)
+        elif record.is_occupied:
+            guess = dict(state=OCCUPIED, otp_code=record.otp_code, otp_expires_at=record.otp_expires_at)
+        else:
+            guess = dict(state=IDLE, otp_code=None, otp_expires_at=None)
+        if self._transition(locker_id, record.state, **self._rollback.pop(locker_id, guess)):
+            print(f"[Occupancy] Locker {locker_id} rolled back to {self.state(locker_id)}: {reason}")
+
+    # --- Code expiry ---
+
+    def _push_expiry(self, record):
+        heapq.heappush(self._expiries, (record.otp_expires_at, record.id, record.otp_code))
+        # Replaced codes leave stale entries behind; rebuild once they dominate
+        if len(self._expiries) > 2 * len(self.store.ids()) + 16:
+            self._expiries = [(r.otp_expires_at, r.id, r.otp_code) for r in self.store.all() if _expires(r)]
+            heapq.heapify(self._expiries)
+
+    def _expire_codes(self):
+        now = time.time()
+        retry = []
+        while self._expiries and self._expiries[0][0] <= now:
+            _, locker_id, otp = heapq.heappop(self._expiries)
+            record = self.store.get(locker_id)
+            if record is None or record.otp_code != otp or not _expires(record) or record.otp_expires_at > now:
+                continue  # Picked up or replaced since
+            # Mid delivery or pickup (possibly one a request has not committed
+            # yet): decide once the door has settled
+            if record.state != OCCUPIED or not self._transition(locker_id, OCCUPIED, state=RETURN_DUE,
+                                                                otp_code=None, otp_expires_at=None):
+                retry.append((now + self.open_timeout_s, locker_id, otp))
+                continue
+            print(f"[Occupancy] Locker {locker_id} code expired, parcel due for return")
+        for entry in retry:
+            heapq.heappush(self._expiries, entry)
@@ -0,0 +1,169 @@
+import cProfile
+import os
+import random
+import threading
+import time
+
+from metrics import registry
+
+# Component times are only collected for sampled requests (see RequestProfiler)
+COMPONENTS = ('db', 'hardware', 'template')
+# Most recent cProfile snapshots kept in the output directory
+MAX_SNAPSHOTS = 50
+
+request_seconds = registry.histogram(
+    'smartlocker_request_seconds', 'Wall time of sampled requests.', ('endpoint',),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+request_component_seconds = registry.counter(
+    'smartlocker_request_component_seconds_total',
+    'Time sampled requests spent in the database, hardware calls and template rendering.',
+    ('endpoint', 'component'))
+request_sql_statements = registry.counter(
+    'smartlocker_request_sql_statements_total', 'SQL statements run by sampled requests.', ('endpoint',))
+slow_request_snapshots = registry.counter(
+    'smartlocker_slow_request_snapshots_total', 'cProfile snapshots written for slow requests.', ('endpoint',))
+
+_local = threading.local()  # .profile: RequestProfile of the sampled request on this thread
+_cprofile_lock = threading.Lock()  # One cProfile at a time
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.times = dict.fromkeys(COMPONENTS, 0.0)
+        self.sql_statements = 0
+        self.profiler = None
+        self._depth = dict.fromkeys(COMPONENTS, 0)  # Nested spans count once
+        self._started = {}
+
+    def begin(self, component):
+        if self._depth[component] == 0:
+            self._started[component] = time.perf_counter()
+        self._depth[component] += 1
+
+    def end(self, component):
+        self._depth[component] -= 1
+        if self._depth[component] == 0:
+            self.times[component] += time.perf_counter() - self._started[component]
+
+
+class _Span:
+    __slots__ = ('profile', 'component')
+
+    def __init__(self, profile, component):
+        self.profile = profile
+        self.component = component
+
+    def __enter__(self):
+        self.profile.begin(self.component)
+
+    def __exit__(self, *exc):
+        self.profile.end(self.component)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def current_profile():
+    """RequestProfile of the sampled request running on this thread, or None."""
+    return getattr(_local, 'profile', None)
+
+
+def span(component):
+    """Attribute the with-block's time to component ('db', 'hardware', 'template')."""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return _NULL_SPAN
+    return _Span(profile, component)
+
+
+class RequestProfiler:
+    """
+    Opt-in per-request profiling for the Flask app.
+    A random sample_rate fraction of requests is timed end to end, with the
+    time spent in SQLite, hardware calls made from the request thread and
+    template rendering split out, and the SQL statements counted. Results go
+    to /metrics per endpoint. A sampled request slower than slow_ms also
+    leaves a cProfile snapshot (.prof, open with pstats or snakeviz) in
+    output_dir. Unsampled requests pay one random() call.
+    """
+    def __init__(self, app, sample_rate=0.0, slow_ms=500, output_dir='profiles'):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.output_dir = output_dir
+        if sample_rate <= 0:
+            return
+
+        from flask import before_render_template, template_rendered
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._template_started, app, weak=False)
+        template_rendered.connect(self._template_finished, app, weak=False)
+        print(f"[Profiler] Sampling {self.sample_rate:.0%} of requests, "
+              f"snapshots of requests over {self.slow_ms} ms go to {self.output_dir}/")
+
+    def _before_request(self):
+        if random.random() >= self.sample_rate:
+            return
+        profile = RequestProfile()
+        # Only the slow-request snapshot needs cProfile, and only one can run at a time
+        if self.slow_ms is not None and _cprofile_lock.acquire(blocking=False):
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+        _local.profile = profile
+
+    def _teardown_request(self, exc):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return
+        _local.profile = None
+        elapsed = time.perf_counter() - profile.start
+        if profile.profiler is not None:
+            profile.profiler.disable()
+
+        from flask import request
+        endpoint = request.endpoint or 'unknown'
+        request_seconds.observe(elapsed, endpoint)
+        for component, seconds in profile.times.items():
+            request_component_seconds.inc(endpoint, component, amount=seconds)
+        request_sql_statements.inc(endpoint, amount=profile.sql_statements)
+
+        if profile.profiler is not None:
+            try:
+                if elapsed * 1000 >= self.slow_ms:
+                    self._write_snapshot(profile.profiler, endpoint, elapsed)
+            finally:
+                _cprofile_lock.release()
+
+    def _template_started(self, sender, **extra):
+        profile = getattr(_local, 'profile', None)
+        if profile is not None:
+            profile.begin('template')
+
+    def _template_finished(self, sender, **extra):
+        profile = getattr(_local, 'profile', None)
+        if profile is not None and profile._depth['template']:
+            profile.end('template')
+
+    def _write_snapshot(self, profiler, endpoint, elapsed):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{elapsed * 1000:.0f}ms.prof"
+            path = os.path.join(self.output_dir, name)
+            profiler.dump_stats(path)
+            slow_request_snapshots.inc(endpoint)
+            print(f"[Profiler] Slow request {endpoint} ({elapsed * 1000:.0f} ms), profile saved to {path}")
+
+            snapshots = sorted(f for f in os.listdir(self.output_dir) if f.endswith('.prof'))
+            for old in snapshots[:-MAX_SNAPSHOTS]:
+                os.remove(os.path.join(self.output_dir, old))
+        except OSError as e:
+            print(f"[Profiler] Could not save profile: {e}")
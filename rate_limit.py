@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import attempts_rejected
+
+MAX_CLIENTS = 4096  # Clients remembered per limiter; the least recently seen is forgotten first
+# Lockout for a client that stands for many people (the kiosk screen): short
+# enough not to punish the next customer, still escalating for a guesser
+SHARED_LOCKOUT_S = 5
+SHARED_LOCKOUT_MAX_S = 300
+
+
+class _Client:
+    __slots__ = ('tokens', 'updated', 'failures', 'locked_until')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0  # Consecutive failed attempts
+        self.locked_until = 0.0
+
+
+class AttemptLimiter:
+    """
+    Throttles guesses at a secret (PIN, OTP), checked before anything
+    touches the database:
+    - per client, a token bucket of failed attempts: burst failures at
+      once, refilled at per_minute; correct guesses cost nothing
+    - across all clients, a sliding window of global_per_minute attempts
+      (weighted count of the previous and current minute)
+    - progressive lockout: lockout_after consecutive failures lock the
+      client out for lockout_s, doubling with every further failure up to
+      lockout_max_s; a success clears the count. Clients that stand for
+      many people (the kiosk) escalate from shared_lockout_s up to
+      shared_lockout_max_s instead
+    Every operation is O(1). Clients live in an LRU of at most max_clients
+    entries, so a flood of addresses cannot grow memory.
+    """
+    def __init__(self, name, per_minute, burst, global_per_minute=None, lockout_after=5,
+                 lockout_s=30, lockout_max_s=900, shared_lockout_s=SHARED_LOCKOUT_S,
+                 shared_lockout_max_s=SHARED_LOCKOUT_MAX_S, max_clients=MAX_CLIENTS):
+        self.name = name
+        self.per_minute = per_minute
+        self.burst = burst
+        self.global_per_minute = global_per_minute
+        self.lockout_after = lockout_after
+        self.lockout_s = lockout_s
+        self.lockout_max_s = lockout_max_s
+        self.shared_lockout_s = shared_lockout_s
+        self.shared_lockout_max_s = shared_lockout_max_s
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._minute = 0
+        self._this_minute = 0
+        self._last_minute = 0
+
+    def _client(self, key, now):
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = _Client(self.burst, now)
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(key)
+        return client
+
+    def _global_wait(self, now):
+        minute, into = divmod(now, 60.0)
+        if minute != self._minute:
+            self._last_minute = self._this_minute if minute == self._minute + 1 else 0
+            self._this_minute = 0
+            self._minute = minute
+        weight = 1.0 - into / 60.0
+        if self._last_minute * weight + self._this_minute + 1 <= self.global_per_minute:
+            return 0.0
+        room = self.global_per_minute - self._this_minute - 1
+        if room < 0 or not self._last_minute:
+            return 60.0 - into  # Wait for the next minute
+        # Until enough of the previous minute has slid out of the window
+        return max(0.0, (1.0 - room / self._last_minute) * 60.0 - into)
+
+    def _refill(self, client, now):
+        client.tokens = min(self.burst, client.tokens + (now - client.updated) * self.per_minute / 60.0)
+        client.updated = now
+
+    def check(self, key):
+        """Admit one attempt for key. Returns 0 if allowed, else the seconds to wait."""
+        now = time.monotonic()
+        with self._lock:
+            client = self._client(key, now)
+            if client.locked_until > now:
+                reason, wait = 'lockout', client.locked_until - now
+            else:
+                self._refill(client, now)
+                if client.tokens < 1:
+                    reason, wait = 'client', (1 - client.tokens) * 60.0 / self.per_minute
+                else:
+                    reason, wait = 'global', self._global_wait(now) if self.global_per_minute else 0
+                    if not wait:
+                        self._this_minute += 1
+                        return 0
+        attempts_rejected.inc(self.name, reason)
+        return wait
+
+    def failed(self, key, shared=False):
+        """
+        Record a wrong guess: it takes a token from the client's bucket and
+        counts toward the lockout (the shorter one with shared=True). Returns
+        the lockout in seconds if this one started a lockout, else 0.
+        """
+        now = time.monotonic()
+        with self._lock:
+            client = self._client(key, now)
+            self._refill(client, now)
+            client.tokens -= 1  # Guesses let through together may leave a debt
+            client.failures += 1
+            if client.failures < self.lockout_after:
+                return 0
+            base, cap = ((self.shared_lockout_s, self.shared_lockout_max_s) if shared
+                         else (self.lockout_s, self.lockout_max_s))
+            lockout = min(cap, base * 2 ** (client.failures - self.lockout_after))
+            client.locked_until = now + lockout
+            return lockout
+
+    def succeeded(self, key):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                client.failures = 0
@@ -1,42 +1,68 @@
-from flask import render_template, request, jsonify, redirect, url_for, flash, session
-from app import app, hardware
-from database import get_db_connection
+from flask import render_template, request, jsonify, redirect, url_for, flash, session, Response
+from app import app, actuator, door_monitor, occupancy, login_limiter, code_limiter, MAX_OTP_LIFETIME_HOURS
+from actuator import PRIORITY_PICKUP, PRIORITY_DELIVERY, PRIORITY_DIAGNOSTIC
+from database import db_connection
+from access_codes import code_index, OTP, SPECIAL
+from events import change_bus
+from locker_store import locker_store
+from allocator import allocator, SIZES, DEFAULT_SIZE
+from audit import audit_log
+from occupancy import OCCUPIED, RETURN_DUE
+from i18n import catalog
+from fragment_cache import fragment_cache
+from metrics import registry
+from profiling import span
+import ipaddress
+import json
+import math
 import random
 import string
+import time
 from datetime import datetime, timedelta
 
 # --- Helpers ---
 
-def generate_otp(length=6):
-    return ''.join(random.choices(string.digits, k=length))
+def generate_otp(length=6, exclude=()):
+    # Never hand out a code that already opens another locker
+    # (exclude: codes issued in the same, not yet committed, transaction)
+    while True:
+        otp = ''.join(random.choices(string.digits, k=length))
+        if not code_index.is_active(otp) and otp not in exclude:
+            return otp
 
 def get_locker_status(locker_id):
-    conn = get_db_connection()
-    locker = conn.execute('SELECT * FROM lockers WHERE id = ?', (locker_id,)).fetchone()
-    conn.close()
-    return locker
+    return locker_store.get(locker_id)
 
-def update_locker_status(locker_id, is_occupied=None, door_closed=None, otp_code=None):
-    conn = get_db_connection()
-    query = 'UPDATE lockers SET updated_at = CURRENT_TIMESTAMP'
-    params = []
-    
+_UNSET = object()
+
+def update_locker_status(locker_id, is_occupied=None, door_closed=None, otp_code=_UNSET):
+    """Update a locker (write-through to SQLite). Pass otp_code=None to clear the OTP."""
+    changes = {}
     if is_occupied is not None:
-        query += ', is_occupied = ?'
-        params.append(is_occupied)
+        changes['is_occupied'] = is_occupied
     if door_closed is not None:
-        query += ', door_closed = ?'
-        params.append(door_closed)
-    if otp_code is not None:
-        query += ', otp_code = ?'
-        params.append(otp_code)
-        
-    query += ' WHERE id = ?'
-    params.append(locker_id)
+        changes['door_closed'] = door_closed
+    if otp_code is not _UNSET:
+        changes['otp_code'] = otp_code
     
-    conn.execute(query, params)
-    conn.commit()
-    conn.close()
+    # Joins the caller's transaction when called inside a db_connection() block
+    locker_store.update(locker_id, **changes)
+
+def publish_locker_change(record, changes, version):
+    """LockerStore listener: incremental change for /api/events subscribers."""
+    change = {'id': record.id}
+    if 'is_occupied' in changes:
+        change['is_occupied'] = bool(record.is_occupied)
+    if 'door_closed' in changes:
+        change['door_closed'] = bool(record.door_closed)
+    if 'otp_code' in changes:
+        change['has_otp'] = record.otp_code is not None
+    if 'state' in changes:
+        change['state'] = record.state
+    if len(change) > 1:
+        change_bus.publish('locker', **change)
+
+locker_store.subscribe(publish_locker_change)
 
 # --- Routes ---
 
@@ -46,121 +72,171 @@ def index():
 
 @app.route('/set_language/<lang>')
 def set_language(lang):
-    if lang in ['fr', 'ar']:
+    if lang in catalog:
         session['lang'] = lang
     return redirect(request.referrer or url_for('index'))
 
+def throttled(template, wait):
+    """429 response for a throttled guess, before it reaches the database."""
+    flash(f'Too many attempts, try again in {math.ceil(wait)} s', 'error')
+    return render_template(template), 429, {'Retry-After': str(math.ceil(wait))}
+
+def is_kiosk(client):
+    """The kiosk browser runs on the Pi itself, so every customer at the screen shares its address."""
+    try:
+        return ipaddress.ip_address(client).is_loopback
+    except ValueError:
+        return False
+
+def record_failed_attempt(limiter, client, kind, **data):
+    # The kiosk gets a short, still escalating cooldown so one customer's
+    # typos do not lock the next one out for long
+    lockout = limiter.failed(client, shared=is_kiosk(client))
+    audit_log.record(kind, client=client, **data)
+    if lockout:
+        audit_log.record('lockout', limiter=limiter.name, client=client, seconds=lockout)
+
 @app.route('/delivery/login', methods=['GET', 'POST'])
 def delivery_login():
     if request.method == 'POST':
+        # Clients are told apart by address: sessions are cookies a guesser can drop
+        client = request.remote_addr
+        wait = login_limiter.check(client)
+        if wait:
+            return throttled('delivery_login.html', wait)
+        
         pin = request.form.get('pin')
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM delivery_users WHERE pin_code = ?', (pin,)).fetchone()
-        conn.close()
+        with db_connection() as conn:
+            user = conn.execute('SELECT * FROM delivery_users WHERE pin_code = ?', (pin,)).fetchone()
         
         if user:
+            login_limiter.succeeded(client)
+            audit_log.record('login', user_id=user['id'])
             return redirect(url_for('delivery_dashboard'))
         else:
+            record_failed_attempt(login_limiter, client, 'login_failed')
             flash('Invalid PIN', 'error')
             
     return render_template('delivery_login.html')
 
 @app.route('/delivery/dashboard')
 def delivery_dashboard():
-    conn = get_db_connection()
-    lockers = conn.execute('SELECT * FROM lockers ORDER BY id').fetchall()
-    conn.close()
+    # The locker grid only changes with locker or door state, so it is
+    # re-rendered once per change and language instead of on every request
+    lang = catalog.get(session.get('lang')).code
+    version = (locker_store.version, door_monitor.version)
     
-    # Sync with hardware state (optional, but good for consistency)
-    hw_states = hardware.get_all_lockers_states()
-    # Note: In a real system, we might want to update DB based on HW state here
+    # Door states as last reported by the sensors (no hardware reads when interrupt-driven)
+    hw_states = door_monitor.current_states()
     
-    return render_template('delivery_dashboard.html', lockers=lockers, hw_states=hw_states)
+    grid = fragment_cache.get_or_render(('locker_grid', lang), version,
+                                        lambda: render_template('locker_grid.html', lockers=locker_store.all(),
+                                                                hw_states=hw_states))
+    return render_template('delivery_dashboard.html', locker_grid=grid)
 
 @app.route('/configuration', methods=['GET', 'POST'])
 def configuration():
-    conn = get_db_connection()
-    
     if request.method == 'POST':
-        # Update locker configurations
-        for locker_id in range(1, 33):
-            hw_type = request.form.get(f'hw_type_{locker_id}', 'pi')
-            gpio_pin = request.form.get(f'gpio_pin_{locker_id}')
-            sensor_pin = request.form.get(f'sensor_pin_{locker_id}')
-            special_code = request.form.get(f'special_code_{locker_id}', '').strip()
-            
-            try:
-                gpio_pin = int(gpio_pin) if gpio_pin else None
-                sensor_pin = int(sensor_pin) if sensor_pin else None
-            except:
-                gpio_pin = None
-                sensor_pin = None
-            
-            conn.execute('''UPDATE lockers 
-                SET hardware_type = ?, gpio_pin = ?, sensor_pin = ?, special_code = ?
-                WHERE id = ?''', 
-                (hw_type, gpio_pin, sensor_pin, special_code or None, locker_id))
+        # Update locker configurations: only changed columns of changed lockers,
+        # all in one transaction
+        rewired = False
+        changed = []
+        with db_connection() as conn:
+            for locker in locker_store.all():
+                locker_id = locker.id
+                hw_type = request.form.get(f'hw_type_{locker_id}', 'pi')
+                gpio_pin = request.form.get(f'gpio_pin_{locker_id}')
+                sensor_pin = request.form.get(f'sensor_pin_{locker_id}')
+                special_code = request.form.get(f'special_code_{locker_id}', '').strip()
+                pulse_ms = request.form.get(f'pulse_ms_{locker_id}')
+                mcp_address = request.form.get(f'mcp_address_{locker_id}', '').strip()
+                i2c_bus = request.form.get(f'i2c_bus_{locker_id}')
+                size = request.form.get(f'size_{locker_id}', locker.size)
+                
+                try:
+                    gpio_pin = int(gpio_pin) if gpio_pin else None
+                    sensor_pin = int(sensor_pin) if sensor_pin else None
+                except:
+                    gpio_pin = None
+                    sensor_pin = None
+                
+                try:
+                    pulse_ms = int(pulse_ms) if pulse_ms else None
+                except ValueError:
+                    pulse_ms = None
+                
+                try:
+                    # Accept "0x21" as well as "33"
+                    mcp_address = int(mcp_address, 0) if mcp_address else None
+                    i2c_bus = int(i2c_bus) if i2c_bus else None
+                except ValueError:
+                    mcp_address = None
+                    i2c_bus = None
+                
+                if size not in SIZES:
+                    size = locker.size
+                
+                values = dict(hardware_type=hw_type, gpio_pin=gpio_pin, sensor_pin=sensor_pin,
+                              special_code=special_code or None, pulse_ms=pulse_ms,
+                              mcp_address=mcp_address, i2c_bus=i2c_bus, size=size)
+                changes = {name: value for name, value in values.items() if locker[name] != value}
+                if changes:
+                    locker_store.update(locker_id, **changes)
+                    changed.append(locker_id)
+                    rewired = rewired or bool(set(changes) - {'special_code', 'size'})
         
-        conn.commit()
-        conn.close()
+        # The changed values themselves are in the lockers' audit events
+        audit_log.record('configuration', lockers=changed)
         
-        # Reload hardware configuration
-        from app import load_locker_config, USE_MOCK_HARDWARE
-        from hardware import HybridHardware
-        import app as app_module
-        if not USE_MOCK_HARDWARE:
-            try:
-                new_config = load_locker_config()
-                app_module.hardware = HybridHardware(locker_config=new_config)
-                hardware = app_module.hardware
-            except Exception as e:
-                print(f"Failed to reload hardware: {e}")
+        # Rewire only what changed, on the actuator thread between two commands
+        if rewired:
+            change_bus.publish('config')
+            from app import load_locker_config, USE_MOCK_HARDWARE
+            if not USE_MOCK_HARDWARE:
+                actuator.reconfigure(load_locker_config())
         
         flash('Configuration saved successfully', 'success')
         return redirect(url_for('configuration'))
     
-    lockers = conn.execute('SELECT * FROM lockers ORDER BY id').fetchall()
-    conn.close()
-    return render_template('configuration.html', lockers=lockers)
+    return render_template('configuration.html', lockers=locker_store.all(), sizes=SIZES)
 
 @app.route('/customer/pickup', methods=['GET', 'POST'])
 def customer_pickup():
     if request.method == 'POST':
-        code = request.form.get('otp', '').strip()
-        conn = get_db_connection()
+        client = request.remote_addr
+        wait = code_limiter.check(client)
+        if wait:
+            return throttled('customer_otp.html', wait)
         
-        # First try OTP code
-        locker = conn.execute('SELECT * FROM lockers WHERE otp_code = ?', (code,)).fetchone()
+        code = request.form.get('otp', '').strip()
         
-        # If not found, try special code
-        if not locker:
-            locker = conn.execute('SELECT * FROM lockers WHERE special_code = ?', (code,)).fetchone()
+        # Resolve the code in memory (OTP first, then special code);
+        # unknown codes are rejected without touching the database
+        match = code_index.lookup(code) if code else None
         
-        if locker:
+        if match:
             # Valid code (OTP or special)
-            locker_id = locker['id']
-            
-            # Open Locker
-            hardware.open_locker(locker_id)
-            
-            # Clear OTP and mark as empty (assuming customer takes package)
-            # In a real system, we might wait for door close to mark empty.
-            # But for simplicity, we mark it empty now or when door closes.
-            # Let's mark it empty now to prevent reuse of OTP immediately.
-            update_locker_status(locker_id, is_occupied=0, otp_code=None)
-            
-            # Log code usage (only if it was an OTP, not special code)
-            if locker.get('otp_code') == code:
-                conn.execute('INSERT INTO otp_codes (locker_id, code, used, expires_at) VALUES (?, ?, 1, CURRENT_TIMESTAMP)', 
-                             (locker_id, code))
-                conn.commit()
-            
-            conn.close()
+            locker_id, kind = match
+            with db_connection() as conn:
+                # The OTP is cleared once the door opens and the locker is
+                # emptied when it closes again (see occupancy.py)
+                first_attempt = occupancy.state(locker_id) == OCCUPIED
+                started = occupancy.begin_pickup(locker_id)
+                
+                # Log code usage (only if it was an OTP, not special code)
+                if kind == OTP and first_attempt:
+                    conn.execute('UPDATE otp_codes SET used = 1 WHERE locker_id = ? AND code = ? AND used = 0',
+                                 (locker_id, code))
             
-            return render_template('status.html', message='Locker Opened!', sub_message='Please take your package and close the door.', locker_id=locker_id)
-        else:
-            conn.close()
-            flash('Invalid Code', 'error')
+            # Special codes always open their locker; OTPs only with a parcel inside
+            if started or kind == SPECIAL:
+                # Open after the commit (customers jump ahead of queued deliveries and diagnostics)
+                occupancy.watch_pulse(locker_id, actuator.open_locker(locker_id, PRIORITY_PICKUP))
+                code_limiter.succeeded(client)
+                audit_log.record('pickup', locker_id, code=kind)
+                return render_template('status.html', message='Locker Opened!', sub_message='Please take your package and close the door.', locker_id=locker_id)
+        record_failed_attempt(code_limiter, client, 'code_rejected', locker_id=match[0] if match else None)
+        flash('Invalid Code', 'error')
             
     return render_template('customer_otp.html')
 
@@ -169,22 +245,20 @@ def customer_pickup():
 @app.route('/api/open_locker/<int:locker_id>', methods=['POST'])
 def api_open_locker(locker_id):
     # This is for Delivery Guy to open an empty locker
-    conn = get_db_connection()
-    locker = conn.execute('SELECT * FROM lockers WHERE id = ?', (locker_id,)).fetchone()
+    locker = locker_store.get(locker_id)
     
     if not locker:
         return jsonify({'success': False, 'error': 'Locker not found'}), 404
-        
-    # Open hardware
-    hardware.open_locker(locker_id)
-    
-    # Generate OTP for this locker (since delivery guy is putting something in)
-    new_otp = generate_otp()
     
-    # Update DB: Occupied, OTP set
-    update_locker_status(locker_id, is_occupied=1, otp_code=new_otp)
+    # Keep the allocator from handing it to another courier meanwhile; a
+    # locker already holding a parcel can be reopened to add another
+    if not allocator.reserve(locker_id) and occupancy.state(locker_id) != OCCUPIED:
+        return jsonify({'success': False, 'error': 'Locker is busy'}), 409
     
-    conn.close()
+    # New OTP, then open; it becomes occupied when the courier closes the door
+    new_otp = load_parcels([locker_id]).get(locker_id)
+    if new_otp is None:
+        return jsonify({'success': False, 'error': 'Locker is busy'}), 409
     
     return jsonify({
         'success': True, 
@@ -192,32 +266,249 @@ def api_open_locker(locker_id):
         'otp': new_otp
     })
 
+def requested_lifetime(data):
+    """
+    Code lifetime in seconds from the request's optional "lifetime_hours";
+    False if invalid or longer than MAX_OTP_LIFETIME_HOURS.
+    """
+    hours = data.get('lifetime_hours')
+    if hours is None:
+        return None
+    # JSON NaN/Infinity are numbers too, and NaN compares false with everything;
+    # the upper bound also keeps huge values from overflowing to inf in seconds
+    if (isinstance(hours, bool) or not isinstance(hours, (int, float)) or not math.isfinite(hours)
+            or not 0 < hours <= MAX_OTP_LIFETIME_HOURS):
+        return False
+    return hours * 3600
+
+def load_parcels(locker_ids, lifetime_s=None):
+    """
+    Issue an OTP for each reserved locker in one commit, queue the doors
+    for opening and return {locker_id: otp}. Each locker becomes occupied
+    when its door is closed again (see occupancy.py). Codes lapse after
+    lifetime_s (default OTP_LIFETIME_HOURS). A locker that changed state
+    meanwhile is left out. Reservations are handed back to the allocator
+    whatever happens (committed ones are already consumed).
+    """
+    lifetime_s = lifetime_s or occupancy.otp_lifetime_s
+    expires_at = time.time() + lifetime_s if lifetime_s else None
+    assigned = {}
+    try:
+        with db_connection() as conn:
+            for locker_id in locker_ids:
+                otp = generate_otp(exclude=assigned.values())
+                if not occupancy.begin_delivery(locker_id, otp, expires_at):
+                    continue
+                conn.execute("INSERT INTO otp_codes (locker_id, code, expires_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+                             (locker_id, otp, expires_at))
+                assigned[locker_id] = otp
+    finally:
+        for locker_id in locker_ids:
+            allocator.release(locker_id)
+    
+    # Opened after the commit so the door events find the new state
+    for locker_id in assigned:
+        occupancy.watch_pulse(locker_id, actuator.open_locker(locker_id, PRIORITY_DELIVERY))
+        audit_log.record('delivery', locker_id)
+    return assigned
+
+@app.route('/api/assign_locker', methods=['POST'])
+def api_assign_locker():
+    """Pick a free locker for one parcel ({"size": "S"|"M"|"L"}), open it and return its OTP."""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Body must be a JSON object'}), 400
+    size = data.get('size', DEFAULT_SIZE)
+    if size not in SIZES:
+        return jsonify({'success': False, 'error': f'size must be one of {", ".join(SIZES)}'}), 400
+    lifetime_s = requested_lifetime(data)
+    if lifetime_s is False:
+        return jsonify({'success': False, 'error': f'lifetime_hours must be a number of hours up to {MAX_OTP_LIFETIME_HOURS}'}), 400
+    
+    locker_id = allocator.allocate(size)
+    if locker_id is None:
+        return jsonify({'success': False, 'error': 'No free locker for this size'}), 409
+    
+    otp = load_parcels([locker_id], lifetime_s).get(locker_id)
+    if otp is None:
+        return jsonify({'success': False, 'error': 'No free locker for this size'}), 409
+    return jsonify({
+        'success': True,
+        'id': locker_id,
+        'size': locker_store.get(locker_id).size,
+        'otp': otp
+    })
+
+@app.route('/api/deliveries', methods=['POST'])
+def api_bulk_delivery():
+    """
+    Load several parcels in one request: {"lockers": [3, 4, 7]}, or let the
+    allocator pick with {"sizes": ["S", "S", "L"]} or {"count": 5, "size": "M"}.
+    "lifetime_hours" overrides OTP_LIFETIME_HOURS. All OTPs are committed in one transaction, then the doors are queued for
+    opening; the actuator sequences the pulses within the power budget
+    (MAX_CONCURRENT_PULSES).
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Body must be a JSON object'}), 400
+    requested = data.get('lockers')
+    sizes = data.get('sizes')
+    count = data.get('count')
+    lifetime_s = requested_lifetime(data)
+    if lifetime_s is False:
+        return jsonify({'success': False, 'error': f'lifetime_hours must be a number of hours up to {MAX_OTP_LIFETIME_HOURS}'}), 400
+    
+    if requested is not None:
+        if (not isinstance(requested, list) or not requested
+                or not all(isinstance(i, int) and not isinstance(i, bool) for i in requested)
+                or len(set(requested)) != len(requested)):
+            return jsonify({'success': False, 'error': 'lockers must be a list of distinct locker ids'}), 400
+        unknown = [i for i in requested if locker_store.get(i) is None]
+        if unknown:
+            return jsonify({'success': False, 'error': 'Locker not found', 'lockers': unknown}), 404
+        chosen = [i for i in requested if allocator.reserve(i)]
+        if len(chosen) < len(requested):
+            for locker_id in chosen:
+                allocator.release(locker_id)
+            busy = [i for i in requested if i not in chosen]
+            return jsonify({'success': False, 'error': 'Locker occupied', 'lockers': busy}), 409
+    else:
+        # JSON true is an int to Python
+        if sizes is None and isinstance(count, int) and not isinstance(count, bool) and count > 0:
+            if count > len(locker_store.ids()):
+                return jsonify({'success': False, 'error': 'count is larger than the number of lockers'}), 400
+            sizes = [data.get('size', DEFAULT_SIZE)] * count
+        if not isinstance(sizes, list) or not sizes or not all(size in SIZES for size in sizes):
+            return jsonify({'success': False,
+                            'error': f'Send "lockers", "sizes" ({", ".join(SIZES)}) or a positive "count"'}), 400
+        # Largest parcels first, so small ones don't take the last big lockers
+        chosen = []
+        for size in sorted(sizes, key=SIZES.index, reverse=True):
+            locker_id = allocator.allocate(size)
+            if locker_id is None:
+                for reserved in chosen:
+                    allocator.release(reserved)
+                return jsonify({'success': False, 'error': 'Not enough free lockers',
+                                'free': allocator.free_counts()}), 409
+            chosen.append(locker_id)
+    
+    assigned = load_parcels(chosen, lifetime_s)
+    return jsonify({
+        'success': True,
+        'lockers': [{'id': locker_id, 'size': locker_store.get(locker_id).size, 'otp': otp}
+                    for locker_id, otp in assigned.items()]
+    })
+
+@app.route('/api/return_locker/<int:locker_id>', methods=['POST'])
+def api_return_locker(locker_id):
+    """Open a locker for the courier to take back its parcel (code expired, or any occupied locker)."""
+    if locker_store.get(locker_id) is None:
+        return jsonify({'success': False, 'error': 'Locker not found'}), 404
+    
+    # Same path as a customer pickup: empty once the door closes again
+    if not occupancy.begin_pickup(locker_id, returning=True):
+        return jsonify({'success': False, 'error': 'No parcel to return'}), 409
+    
+    occupancy.watch_pulse(locker_id, actuator.open_locker(locker_id, PRIORITY_DELIVERY))
+    audit_log.record('return', locker_id)
+    return jsonify({'success': True, 'message': f'Locker {locker_id} opened'})
+
 @app.route('/api/status')
 def api_status():
     # Return status of all lockers
-    conn = get_db_connection()
-    lockers = conn.execute('SELECT * FROM lockers').fetchall()
-    conn.close()
+    lockers = locker_store.all()
     
     # Get hardware states
-    hw_states = hardware.get_all_lockers_states()
+    hw_states = door_monitor.current_states()
     
     data = []
     for l in lockers:
         data.append({
             'id': l['id'],
             'is_occupied': bool(l['is_occupied']),
+            'state': l['state'],
             'otp_code': l['otp_code'],
             'door_closed': hw_states.get(l['id'], True) # Use HW state if available
         })
         
     return jsonify({'lockers': data})
 
+registry.gauge('smartlocker_actuator_queue_depth', 'Hardware commands waiting for the actuator thread.',
+               (), lambda: {(): actuator.queue_depth})
+registry.gauge('smartlocker_active_pulses', 'Solenoids energised right now.',
+               (), lambda: {(): actuator.active_pulses})
+registry.gauge('smartlocker_lockers_return_due', 'Lockers whose code expired, waiting for the courier.',
+               (), lambda: {(): sum(1 for locker in locker_store.all() if locker.state == RETURN_DUE)})
+registry.gauge('smartlocker_free_lockers', 'Lockers the allocator can hand out, per size class.',
+               ('size',), lambda: {(size,): free for size, free in allocator.free_counts().items()})
+registry.gauge('smartlocker_mcp_chip_up', '1 if the MCP23017 is answering its health checks.',
+               ('bus', 'address'),
+               lambda: {(chip['bus'], chip['address']): int(chip['state'] == 'up')
+                        for chip in actuator.hardware.health()['chips']})
+registry.gauge('smartlocker_mcp_chip_resets', 'Times the MCP23017 was found reset and reprogrammed.',
+               ('bus', 'address'),
+               lambda: {(chip['bus'], chip['address']): chip['resets']
+                        for chip in actuator.hardware.health()['chips']})
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text exposition format
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/hardware/health')
+def api_hardware_health():
+    # MCP23017 bring-up and health monitor status
+    return jsonify(actuator.hardware.health())
+
+# Seconds between SSE comments that keep idle connections (and proxies) open
+SSE_KEEPALIVE_SECONDS = 15
+
+@app.route('/api/events')
+def api_events():
+    """
+    Server-Sent Events stream of locker changes.
+    Starts with a 'snapshot' event (skipped when the Last-Event-ID of a
+    reconnecting client can still be resumed from the history),
+    then one 'locker' event per change carrying only the fields that changed.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    sub = change_bus.subscribe(last_event_id)
+    
+    snapshot = None
+    if not sub.resumed:
+        lockers = locker_store.all()
+        door_states = door_monitor.current_states()
+        snapshot = [{
+            'id': l['id'],
+            'is_occupied': bool(l['is_occupied']),
+            'state': l['state'],
+            'has_otp': l['otp_code'] is not None,
+            'door_closed': door_states.get(l['id'], True)
+        } for l in lockers]
+    
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            if snapshot is not None:
+                yield f"event: snapshot\ndata: {json.dumps({'lockers': snapshot})}\n\n"
+            while not sub.overflowed:
+                event = sub.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield event.to_sse()
+        finally:
+            change_bus.unsubscribe(sub)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/mock/close_door/<int:locker_id>', methods=['POST'])
 def api_mock_close_door(locker_id):
     # Helper to close door in mock mode
-    if hasattr(hardware, 'mock_close_door'):
-        hardware.mock_close_door(locker_id)
+    if hasattr(actuator.hardware, 'mock_close_door'):
+        with span('hardware'):
+            actuator.submit(lambda hw: hw.mock_close_door(locker_id), PRIORITY_DIAGNOSTIC).result(timeout=5)
         # Update DB to reflect closed door
         update_locker_status(locker_id, door_closed=1)
         return jsonify({'success': True, 'message': f'Locker {locker_id} closed (Mock)'})
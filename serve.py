@@ -0,0 +1,37 @@
+"""
+Production entry point for the kiosk (used by smartlocker.service):
+
+    python3 serve.py
+
+Runs the app under waitress with a pool of request threads, without the
+debugger or reloader. Everything stays in this one process: it is the single
+owner of the GPIO/I2C hardware (enforced by hardware.claim_hardware) and of
+the in-memory locker store, access-code index and event bus, which request
+threads share directly instead of over IPC. Do not run it under a
+multi-process server (e.g. gunicorn -w 4): a second worker would be refused
+the hardware and would not see the first worker's in-memory state.
+"""
+from app import app
+
+# Configuration
+HOST = '0.0.0.0'
+PORT = 5000
+# Every open /api/events stream holds a thread, so leave room for the kiosk
+# dashboard and a few admin browsers on top of regular requests.
+THREADS = 16
+
+def main():
+    try:
+        from waitress import serve
+    except ImportError:
+        # Degraded but still single-process: Werkzeug's threaded server
+        print("[Serve] waitress not installed (sudo apt-get install python3-waitress), "
+              "falling back to the threaded development server")
+        app.run(host=HOST, port=PORT, debug=False, use_reloader=False, threaded=True)
+        return
+
+    print(f"[Serve] Listening on http://{HOST}:{PORT} with {THREADS} threads")
+    serve(app, host=HOST, port=PORT, threads=THREADS, ident='smartlocker')
+
+if __name__ == '__main__':
+    main()
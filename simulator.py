@@ -0,0 +1,326 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from hardware import HybridHardware, DEFAULT_PULSE_MS
+
+# Simulation defaults
+I2C_LATENCY_MS = 0.25  # One register transaction at 100 kHz (address, register, data)
+I2C_BYTE_MS = 0.09  # Each further byte of a block transfer
+UNLATCH_MS = 150  # The solenoid must stay energised this long to release the door
+CLOSE_DELAY_S = (3.0, 20.0)  # A customer closes the door after a uniform random delay
+LOCKERS_PER_CHIP = 8  # Relays on Port A, sensors on the matching Port B pin
+
+
+class VirtualClock:
+    """
+    Simulation time in seconds, with callbacks scheduled on it.
+    Manual by default: time only moves through advance(), and sleep()
+    advances it by the slept amount, so a run with a fixed seed is exactly
+    reproducible. start() makes the clock follow the wall clock (times
+    speed) from a driver thread, for running the real app on the simulator.
+    """
+    def __init__(self):
+        self._now = 0.0
+        self._timers = []  # heap of (due time, seq, callback)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.speed = None  # None = manual
+
+    def now(self):
+        return self._now
+
+    def call_later(self, delay, callback):
+        with self._lock:
+            heapq.heappush(self._timers, (self._now + delay, next(self._seq), callback))
+
+    def advance(self, seconds):
+        """Move time forward, running every callback that falls due, in time order."""
+        with self._lock:
+            target = self._now + seconds
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > target:
+                    self._now = max(self._now, target)
+                    return
+                due, _, callback = heapq.heappop(self._timers)
+                self._now = max(self._now, due)
+            # Run outside the lock: callbacks schedule further callbacks
+            callback()
+
+    def sleep(self, seconds):
+        if self.speed is None:
+            self.advance(seconds)
+        else:
+            time.sleep(seconds / self.speed)
+
+    def start(self, speed=1.0):
+        """Follow the wall clock at speed x real time from a background thread."""
+        self.speed = speed
+        threading.Thread(target=self._follow_wall_clock, name='sim-clock', daemon=True).start()
+
+    def _follow_wall_clock(self):
+        real_origin = time.monotonic()
+        origin = self._now
+        while True:
+            target = origin + (time.monotonic() - real_origin) * self.speed
+            if target > self._now:
+                self.advance(target - self._now)
+            time.sleep(0.001)
+
+
+class SimulatedMCP23017:
+    """Register-level model of one MCP23017 (IOCON.BANK = 0, sequential addressing)."""
+    IODIRA = 0x00
+    GPINTENA = 0x04
+    GPPUA = 0x0C
+    INTFA = 0x0E
+    INTCAPA = 0x10
+    GPIOA = 0x12
+    OLATA = 0x14
+    REGISTER_COUNT = 0x16
+
+    def __init__(self, bus_num, address):
+        self.bus_num = bus_num
+        self.address = address
+        self.inputs = 0x0000  # Levels applied to the pins from outside (Port B in the high byte)
+        self.online = True
+        self.relay_listeners = []  # callback(chip, pin, energised) on every output change
+        self.reset()
+
+    def reset(self):
+        """Power-on state, as after a brownout: every pin an input, latches cleared."""
+        self.registers = [0x00] * self.REGISTER_COUNT
+        self.registers[self.IODIRA] = self.registers[self.IODIRA + 1] = 0xFF
+
+    def _word(self, register_a):
+        return self.registers[register_a] | (self.registers[register_a + 1] << 8)
+
+    @property
+    def outputs(self):
+        """Levels driven on pins configured as outputs."""
+        return self._word(self.OLATA) & ~self._word(self.IODIRA) & 0xFFFF
+
+    def _gpio(self, port):
+        iodir = self.registers[self.IODIRA + port]
+        level = (self.inputs >> (8 * port)) & 0xFF
+        return (level & iodir) | (self.registers[self.OLATA + port] & ~iodir & 0xFF)
+
+    def read(self, register):
+        if register in (self.GPIOA, self.GPIOA + 1, self.INTCAPA, self.INTCAPA + 1):
+            port = (register - self.GPIOA) if register >= self.GPIOA else (register - self.INTCAPA)
+            value = self._gpio(port) if register >= self.GPIOA else self.registers[register]
+            self.registers[self.INTFA + port] = 0  # Reading GPIO or INTCAP clears the interrupt
+            return value
+        return self.registers[register]
+
+    def write(self, register, value):
+        if self.INTFA <= register < self.GPIOA:
+            return  # INTF/INTCAP are read-only
+        if register in (self.GPIOA, self.GPIOA + 1):
+            register += self.OLATA - self.GPIOA  # Writing GPIO writes the latch
+        before = self.outputs
+        self.registers[register] = value & 0xFF
+        changed = before ^ self.outputs
+        for pin in range(16):
+            if changed & (1 << pin):
+                for callback in self.relay_listeners:
+                    callback(self, pin, bool(self.outputs & (1 << pin)))
+
+    def set_input(self, pin, level):
+        """Apply a level to a pin from outside; latches INTCAP/INTF when interrupts are enabled."""
+        mask = 1 << pin
+        before = self.inputs
+        self.inputs = (self.inputs | mask) if level else (self.inputs & ~mask)
+        if before != self.inputs and self._word(self.GPINTENA) & mask:
+            port = pin // 8
+            if not self.registers[self.INTFA + port]:
+                self.registers[self.INTCAPA + port] = self._gpio(port)
+            self.registers[self.INTFA + port] |= 1 << (pin % 8)
+
+    @property
+    def interrupt(self):
+        """State of the (mirrored) INT output."""
+        return bool(self.registers[self.INTFA] or self.registers[self.INTFA + 1])
+
+
+class SimulatedBus:
+    """
+    smbus.SMBus stand-in that routes transactions to simulated chips.
+    Each transaction takes I2C time on the simulator clock and fails with
+    Remote I/O error (errno 121) if the chip is missing or offline, or at
+    random with the simulator's error_rate.
+    """
+    def __init__(self, simulator, bus_num):
+        self.simulator = simulator
+        self.bus_num = bus_num
+
+    def _transaction(self, address, data_bytes):
+        sim = self.simulator
+        sim.clock.sleep((sim.i2c_latency_ms + sim.i2c_byte_ms * (data_bytes - 1)) / 1000.0)
+        sim.transactions += 1
+        chip = sim.chips.get((self.bus_num, address))
+        if chip is None or not chip.online or sim.rng.random() < sim.error_rate:
+            sim.errors += 1
+            raise OSError(121, 'Remote I/O error')
+        return chip
+
+    def read_byte_data(self, address, register):
+        chip = self._transaction(address, 1)
+        with self.simulator.lock:
+            return chip.read(register)
+
+    def write_byte_data(self, address, register, value):
+        chip = self._transaction(address, 1)
+        with self.simulator.lock:
+            chip.write(register, value)
+
+    def read_i2c_block_data(self, address, register, length):
+        chip = self._transaction(address, length)
+        with self.simulator.lock:
+            return [chip.read(register + i) for i in range(length)]
+
+    def write_i2c_block_data(self, address, register, values):
+        chip = self._transaction(address, len(values))
+        with self.simulator.lock:
+            for i, value in enumerate(values):
+                chip.write(register + i, value)
+
+
+class SimulatedLocker:
+    def __init__(self, locker_id, chip, relay_pin, sensor_pin):
+        self.locker_id = locker_id
+        self.chip = chip
+        self.relay_pin = relay_pin
+        self.sensor_pin = sensor_pin
+        self.closed = True
+        self.energised_at = None  # Clock time the solenoid was switched on
+        self.pulses = 0
+
+
+class HardwareSimulator:
+    """
+    Off-device bank of MCP23017-wired lockers for load testing.
+    The real HybridHardware runs on top of it (hardware()), so latch writes,
+    block reads, health checks and door polling all go through the same code
+    as on the Pi, against:
+    - I2C transactions that take time on the clock and fail at error_rate
+    - solenoids that release the door only when energised for unlatch_ms
+    - customers who close an opened door after a random close_delay_s
+      (None: doors stay open until close_door())
+    - brownout()/disconnect() for fault injection
+    Everything random comes from one seeded generator.
+    """
+    def __init__(self, locker_count=32, seed=0, clock=None, i2c_latency_ms=I2C_LATENCY_MS,
+                 i2c_byte_ms=I2C_BYTE_MS, error_rate=0.0, unlatch_ms=UNLATCH_MS,
+                 close_delay_s=CLOSE_DELAY_S, pulse_ms=DEFAULT_PULSE_MS):
+        self.clock = clock or VirtualClock()
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.i2c_latency_ms = i2c_latency_ms
+        self.i2c_byte_ms = i2c_byte_ms
+        self.error_rate = error_rate
+        self.unlatch_ms = unlatch_ms
+        self.close_delay_s = close_delay_s
+        self.pulse_ms = pulse_ms
+        self.chips = {}  # (bus_num, address) -> SimulatedMCP23017
+        self.lockers = {}  # locker_id -> SimulatedLocker
+        self._by_relay = {}  # (bus_num, address, pin) -> SimulatedLocker
+        self._buses = {}
+        self.transactions = 0
+        self.errors = 0
+        self.doors_opened = 0
+        self.short_pulses = 0  # Pulses too short to release the door
+
+        for locker_id in range(1, locker_count + 1):
+            chip_index, pin = divmod(locker_id - 1, LOCKERS_PER_CHIP)
+            key = (1 + chip_index // 8, 0x20 + chip_index % 8)
+            chip = self.chips.get(key)
+            if chip is None:
+                chip = self.chips[key] = SimulatedMCP23017(*key)
+                chip.relay_listeners.append(self._on_relay)
+            locker = SimulatedLocker(locker_id, chip, pin, 8 + pin)
+            self.lockers[locker_id] = locker
+            self._by_relay[(chip.bus_num, chip.address, pin)] = locker
+
+    def locker_config(self):
+        """HybridHardware locker_config matching the simulated wiring."""
+        return {
+            locker.locker_id: {
+                'type': 'mcp',
+                'pin': locker.relay_pin,
+                'sensor_pin': locker.sensor_pin,
+                'address': locker.chip.address,
+                'bus': locker.chip.bus_num,
+                'pulse_ms': self.pulse_ms,
+            }
+            for locker in self.lockers.values()
+        }
+
+    def bus(self, bus_num):
+        """SMBus factory for HybridHardware(bus_factory=...)."""
+        if bus_num not in self._buses:
+            self._buses[bus_num] = SimulatedBus(self, bus_num)
+        return self._buses[bus_num]
+
+    def hardware(self, scheduler=None):
+        hw = HybridHardware(locker_config=self.locker_config(), scheduler=scheduler,
+                            bus_factory=self.bus, bus_settle_s=0)
+        hw.mock_close_door = self.close_door  # Lets the /api/mock close endpoint drive the simulation
+        return hw
+
+    def _on_relay(self, chip, pin, energised):
+        # Called with self.lock held, from a bus write
+        locker = self._by_relay.get((chip.bus_num, chip.address, pin))
+        if locker is None:
+            return
+        if energised:
+            locker.pulses += 1
+            locker.energised_at = self.clock.now()
+            pulse = locker.pulses
+            self.clock.call_later(self.unlatch_ms / 1000.0, lambda: self._release(locker, pulse))
+        else:
+            if locker.energised_at is not None and self.clock.now() - locker.energised_at < self.unlatch_ms / 1000.0:
+                self.short_pulses += 1
+            locker.energised_at = None
+
+    def _release(self, locker, pulse):
+        with self.lock:
+            if locker.energised_at is None or locker.pulses != pulse or not locker.closed:
+                return
+            locker.closed = False
+            locker.chip.set_input(locker.sensor_pin, 1)  # Switch opens, pull-up reads high
+            self.doors_opened += 1
+        if self.close_delay_s:
+            delay = self.rng.uniform(*self.close_delay_s)
+            self.clock.call_later(delay, lambda: self.close_door(locker.locker_id))
+
+    def close_door(self, locker_id):
+        with self.lock:
+            locker = self.lockers[locker_id]
+            locker.closed = True
+            locker.chip.set_input(locker.sensor_pin, 0)
+
+    def door_closed(self, locker_id):
+        return self.lockers[locker_id].closed
+
+    def brownout(self, address, bus_num=1):
+        """Reset a chip to its power-on registers, as a supply dip would."""
+        with self.lock:
+            self.chips[(bus_num, address)].reset()
+
+    def disconnect(self, address, bus_num=1, online=False):
+        """Make a chip stop (or, with online=True, resume) answering on the bus."""
+        self.chips[(bus_num, address)].online = online
+
+    def stats(self):
+        return {
+            'clock': self.clock.now(),
+            'transactions': self.transactions,
+            'errors': self.errors,
+            'doors_opened': self.doors_opened,
+            'short_pulses': self.short_pulses,
+            'open_doors': sum(1 for locker in self.lockers.values() if not locker.closed),
+        }
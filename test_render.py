@@ -1,8 +1,33 @@
 from flask import Flask, render_template
+from markupsafe import Markup
 import sqlite3
 
 app = Flask(__name__)
 
+# Mock translations
+TRANSLATIONS = {
+    'fr': {
+        'title': 'Système de Casier Intelligent',
+        'delivery': 'Livraison',
+        'pickup': 'Retrait',
+        'select_locker': 'Sélectionnez un Casier',
+        'logout': 'Déconnexion',
+        'door_open': 'PORTE OUVERTE',
+        'occupied': 'Occupé',
+        'available': 'Disponible',
+        'locker_opened': 'Casier Ouvert !',
+        'generated_otp': 'Code OTP Généré :',
+        'place_package': 'Veuillez déposer le colis et fermer la porte.',
+        'done': 'Terminé',
+        'already_occupied': 'Occupé',
+        'confirm_open': 'Ouvrir?',
+        'confirm_return': 'Reprendre?',
+        'return_due': 'À retourner',
+        'error': 'Erreur',
+        'request_failed': 'Echec'
+    }
+}
+
 @app.route('/index')
 def index():
     return "Index"
@@ -13,63 +38,28 @@ def set_language(lang):
 
 @app.context_processor
 def inject_conf_var():
-    # Mock translations
-    TRANSLATIONS = {
-        'fr': {
-            'title': 'Système de Casier Intelligent',
-            'delivery': 'Livraison',
-            'pickup': 'Retrait',
-            'select_locker': 'Sélectionnez un Casier',
-            'logout': 'Déconnexion',
-            'door_open': 'PORTE OUVERTE',
-            'occupied': 'Occupé',
-            'available': 'Disponible',
-            'locker_opened': 'Casier Ouvert !',
-            'generated_otp': 'Code OTP Généré :',
-            'place_package': 'Veuillez déposer le colis et fermer la porte.',
-            'done': 'Terminé',
-            'already_occupied': 'Occupé',
-            'confirm_open': 'Ouvrir?',
-            'error': 'Erreur',
-            'request_failed': 'Echec'
-        }
-    }
     return dict(lang='fr', t=TRANSLATIONS, dir='ltr')
 
 @app.route('/')
-def test():
+def dashboard():
     # Mock data
     lockers = [
-        {'id': 1, 'is_occupied': 0, 'door_closed': 1},
-        {'id': 2, 'is_occupied': 1, 'door_closed': 1}
+        {'id': 1, 'is_occupied': 0, 'door_closed': 1, 'state': 'idle'},
+        {'id': 2, 'is_occupied': 1, 'door_closed': 1, 'state': 'occupied'},
+        {'id': 3, 'is_occupied': 1, 'door_closed': 1, 'state': 'return_due'}
     ]
-    hw_states = {1: True, 2: True}
-    
-    try:
-        # Mock translations
-        TRANSLATIONS = {
-            'fr': {
-                'title': 'Système de Casier Intelligent',
-                'delivery': 'Livraison',
-                'pickup': 'Retrait',
-                'select_locker': 'Sélectionnez un Casier',
-                'logout': 'Déconnexion',
-                'door_open': 'PORTE OUVERTE',
-                'occupied': 'Occupé',
-                'available': 'Disponible',
-                'locker_opened': 'Casier Ouvert !',
-                'generated_otp': 'Code OTP Généré :',
-                'place_package': 'Veuillez déposer le colis et fermer la porte.',
-                'done': 'Terminé',
-                'already_occupied': 'Occupé',
-                'confirm_open': 'Ouvrir?',
-                'error': 'Erreur',
-                'request_failed': 'Echec'
-            }
-        }
-        return render_template('delivery_dashboard.html', lockers=lockers, hw_states=hw_states, t=TRANSLATIONS, lang='fr', dir='ltr')
-    except Exception as e:
-        return str(e)
+    hw_states = {1: True, 2: True, 3: True}
+
+    grid = render_template('locker_grid.html', lockers=lockers, hw_states=hw_states, t=TRANSLATIONS, lang='fr')
+    return render_template('delivery_dashboard.html', locker_grid=Markup(grid), t=TRANSLATIONS, lang='fr', dir='ltr')
+
+def test_dashboard_renders():
+    response = app.test_client().get('/')
+    assert response.status_code == 200
+    html = response.get_data(as_text=True)
+    assert 'data-locker-id="3"' in html
+    assert 'À retourner' in html # Return-due label
+    assert 'Reprendre?' in html # Return confirmation string handed to the script
 
 if __name__ == '__main__':
     app.run(debug=True, port=5003)
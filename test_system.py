@@ -1,7 +1,44 @@
 import unittest
 import os
-from database import init_db, get_db_connection
-from hardware import MockMCP23017
+import queue
+import threading
+import time
+from database import init_db, get_db_connection, close_pool
+from hardware import HybridHardware, MockMCP23017, MCPOutputLatch, MCP_HEALTH_FAILURES
+from door_monitor import DoorMonitor
+from access_codes import AccessCodeIndex, OTP, SPECIAL
+from events import ChangeBus, EVENT_HISTORY
+from locker_store import LockerStore
+from allocator import LockerAllocator, locker_chip
+from i18n import TranslationCatalog
+from fragment_cache import FragmentCache
+from metrics import MetricsRegistry
+from actuator import HardwareActuator, PRIORITY_PICKUP, PRIORITY_DELIVERY
+from simulator import HardwareSimulator
+from occupancy import OccupancyTracker, IDLE, DELIVERY_OPEN, OCCUPIED, PICKUP_OPENING, PICKUP_OPEN, RETURN_DUE
+from concurrent.futures import Future
+from audit import AuditLog, replay
+from rate_limit import AttemptLimiter
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+
+class FakeBus:
+    """Register-level stand-in for smbus.SMBus."""
+    def __init__(self):
+        self.registers = {}
+        self.reads = 0
+        self.writes = 0
+
+    def read_byte_data(self, addr, reg):
+        self.reads += 1
+        return self.registers.get((addr, reg), 0)
+
+    def write_byte_data(self, addr, reg, value):
+        self.writes += 1
+        self.registers[(addr, reg)] = value
 
 class TestSmartLocker(unittest.TestCase):
     def setUp(self):
@@ -13,6 +50,7 @@ class TestSmartLocker(unittest.TestCase):
         self.hw = MockMCP23017()
 
     def tearDown(self):
+        close_pool() # Pooled connections would outlive the deleted file
         if os.path.exists(self.test_db):
             os.remove(self.test_db)
 
@@ -25,11 +63,670 @@ class TestSmartLocker(unittest.TestCase):
         self.hw.open_locker(1)
         self.assertFalse(self.hw.read_door_state(1)) # Door open (False)
 
+    def test_open_locker_does_not_block(self):
+        hw = MockMCP23017(pulse_ms=50)
+        start = time.monotonic()
+        pulse = hw.open_locker(2)
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.assertTrue(hw.relays[1]) # Relay energised
+
+        pulse.result(timeout=1)
+        self.assertFalse(hw.relays[1]) # Released after the pulse
+
+    def test_output_latch_shadow(self):
+        bus = FakeBus()
+        latch = MCPOutputLatch(bus, 0x20)
+        latch.set_pin(0, True)
+        latch.set_pin(3, True)
+        latch.set_pin(0, False)
+        self.assertEqual(bus.registers[(0x20, MCPOutputLatch.OLATA)], 0b1000)
+        self.assertEqual(bus.reads, 0) # No read-modify-write
+
+        bus.registers[(0x20, MCPOutputLatch.OLATA)] = 0x00 # Chip reset
+        self.assertTrue(latch.reconcile())
+        self.assertEqual(bus.registers[(0x20, MCPOutputLatch.OLATA)], 0b1000)
+        self.assertFalse(latch.reconcile())
+
+    def test_door_monitor_events(self):
+        events = queue.Queue()
+        monitor = DoorMonitor()
+        monitor.subscribe(lambda locker_id, closed: events.put((locker_id, closed)))
+        monitor.attach(self.hw)
+
+        self.hw.open_locker(5)
+        self.assertEqual(events.get(timeout=1), (5, False))
+        self.hw.mock_close_door(5)
+        self.assertEqual(events.get(timeout=1), (5, True))
+        monitor.detach()
+
+    def test_access_code_index(self):
+        index = AccessCodeIndex()
+        index.load()
+        self.assertIsNone(index.lookup('123456'))
+
+        index.set_code(4, SPECIAL, '123456')
+        index.set_code(7, OTP, '123456')
+        self.assertEqual(index.lookup('123456'), (7, OTP)) # OTP wins
+
+        index.set_code(7, OTP, None)
+        self.assertEqual(index.lookup('123456'), (4, SPECIAL))
+
+    def test_migrations_run_once(self):
+        import database
+        init_db() # Already current: no-op
+        conn = get_db_connection()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        users = conn.execute('SELECT count(*) FROM delivery_users').fetchone()[0]
+        conn.close()
+        self.assertEqual(version, len(database.MIGRATIONS))
+        self.assertEqual(users, 1)
+
+    def test_change_bus_fan_out(self):
+        bus = ChangeBus()
+        first = bus.publish('locker', id=1, is_occupied=True)
+        a = bus.subscribe()
+        b = bus.subscribe(last_event_id=0) # Resumes from history
+        bus.publish('locker', id=2, door_closed=False)
+
+        self.assertEqual(a.get(timeout=1).data, {'id': 2, 'door_closed': False})
+        self.assertEqual(b.get(timeout=1).seq, first.seq)
+        self.assertEqual(b.get(timeout=1).data['id'], 2)
+        bus.unsubscribe(a)
+        self.assertEqual(bus.subscriber_count, 1)
+        self.assertTrue(b.resumed)
+        self.assertFalse(bus.subscribe(last_event_id=99).resumed) # From before a restart
+
+        for i in range(EVENT_HISTORY):
+            bus.publish('locker', id=i)
+        stale = bus.subscribe(last_event_id=first.seq) # Its next event was dropped from the history
+        self.assertFalse(stale.resumed)
+        self.assertIsNone(stale.get(timeout=0))
+
+    def test_connection_pool(self):
+        from database import db_connection, after_commit
+        with db_connection() as conn:
+            with db_connection() as inner:
+                self.assertIs(inner, conn) # Nested blocks share the transaction
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        with db_connection() as again:
+            self.assertIs(again, conn) # Reused, not reopened
+
+        def visible():
+            # Read on a separate connection: only sees committed rows
+            other = get_db_connection()
+            row = other.execute('SELECT otp_code FROM lockers WHERE id = 1').fetchone()
+            other.close()
+            return row[0]
+        seen = []
+        with db_connection() as conn:
+            conn.execute("UPDATE lockers SET otp_code = '111111' WHERE id = 1")
+            after_commit(lambda: seen.append(('first', visible())))
+            after_commit(lambda: seen.append(('second', visible())))
+            self.assertEqual(seen, [])
+        self.assertEqual(seen, [('first', '111111'), ('second', '111111')])
+
+        with self.assertRaises(RuntimeError):
+            with db_connection():
+                after_commit(lambda: seen.append('rolled back'))
+                raise RuntimeError('rolled back')
+        self.assertEqual(len(seen), 2)
+
+        # Transactions on other threads run their callbacks in commit order
+        order = []
+        committed, release = threading.Event(), threading.Event()
+        def slow():
+            with db_connection() as conn:
+                conn.execute("UPDATE lockers SET otp_code = '222222' WHERE id = 2")
+                after_commit(committed.set)
+                after_commit(lambda: release.wait(timeout=5))
+                after_commit(lambda: order.append(1))
+        def fast():
+            with db_connection() as conn:
+                conn.execute("UPDATE lockers SET otp_code = '333333' WHERE id = 3")
+                after_commit(lambda: order.append(2))
+        first = threading.Thread(target=slow)
+        first.start()
+        self.assertTrue(committed.wait(timeout=5))
+        second = threading.Thread(target=fast)
+        second.start()
+        second.join(timeout=0.2)
+        release.set()
+        first.join(timeout=5)
+        second.join(timeout=5)
+        self.assertEqual(order, [1, 2])
+
+    def test_locker_store_applies_on_commit(self):
+        from database import db_connection
+        store = LockerStore()
+        store.load()
+        seen = []
+        store.subscribe(lambda record, changes, version: seen.append((record.id, changes, version)))
+        version = store.version
+
+        with db_connection():
+            store.update(3, is_occupied=1, otp_code='123456')
+            self.assertEqual(store.get(3).otp_code, None) # Not visible before commit
+        self.assertEqual(store.get(3).otp_code, '123456')
+        self.assertEqual(seen, [(3, {'is_occupied': 1, 'otp_code': '123456'}, version + 1)])
+
+        with self.assertRaises(RuntimeError):
+            with db_connection():
+                store.update(4, is_occupied=1)
+                raise RuntimeError('rolled back')
+        self.assertEqual(store.get(4).is_occupied, 0)
+        self.assertEqual(store.version, version + 1)
+
+    def test_locker_store_notifies_in_commit_order(self):
+        from database import db_connection, after_commit
+        store = LockerStore()
+        store.load()
+        order = []
+        store.subscribe(lambda record, changes, version: order.append(record.id))
+        committed, release = threading.Event(), threading.Event()
+
+        def slow_commit():
+            with db_connection():
+                after_commit(committed.set)
+                after_commit(lambda: release.wait(timeout=5)) # Held up between commit and apply
+                store.update(1, is_occupied=1)
+        first = threading.Thread(target=slow_commit)
+        first.start()
+        self.assertTrue(committed.wait(timeout=5))
+        second = threading.Thread(target=store.update, args=(2,), kwargs={'is_occupied': 1})
+        second.start()
+        second.join(timeout=0.2)
+        self.assertTrue(second.is_alive()) # Waits for the first commit's callbacks
+        release.set()
+        first.join(timeout=5)
+        second.join(timeout=5)
+        self.assertEqual(order, [1, 2])
+
+    def test_allocator_size_classes(self):
+        store = LockerStore()
+        store.load()
+        store.update(1, size='S')
+        store.update(2, size='L')
+        allocator = LockerAllocator(store)
+        allocator.load()
+        store.subscribe(allocator.sync)
+
+        self.assertEqual(allocator.allocate('S'), 1)
+        self.assertIsNone(allocator.allocate('S', exact=True))
+        medium = allocator.allocate('M')
+        self.assertNotIn(medium, (1, 2))
+        self.assertFalse(allocator.reserve(1)) # Already reserved
+
+        # Committed delivery consumes the reservation, release() gives one back
+        store.update(1, is_occupied=1)
+        allocator.release(1)
+        allocator.release(medium)
+        self.assertEqual(allocator.free_counts()['S'], 0)
+        self.assertEqual(store.get(allocator.allocate('S')).size, 'M') # Next size up
+        self.assertEqual(allocator.allocate('L'), 2)
+
+        # Picked up: free again
+        store.update(1, is_occupied=0)
+        self.assertEqual(allocator.allocate('S'), 1)
+
+        # Spread over chips: with the Pi GPIO lockers nearly full, the expander goes first
+        for locker_id in range(5, 23):
+            store.update(locker_id, is_occupied=1)
+        self.assertEqual(locker_chip(store.get(allocator.allocate('M'))), (1, 0x20))
+
+    def test_occupancy_follows_doors(self):
+        store = LockerStore()
+        store.load()
+        monitor = DoorMonitor()
+        monitor.attach(self.hw)
+        tracker = OccupancyTracker(store, monitor, open_timeout_s=0.2)
+        tracker.start()
+
+        def wait_for(locker_id, state):
+            deadline = time.monotonic() + 2
+            while tracker.state(locker_id) != state and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(tracker.state(locker_id), state)
+
+        # Occupied once the courier closes the door
+        tracker.begin_delivery(3, '111111')
+        tracker.watch_pulse(3, self.hw.open_locker(3))
+        wait_for(3, DELIVERY_OPEN)
+        self.assertFalse(tracker.begin_pickup(3)) # Nothing inside yet
+        self.hw.mock_close_door(3)
+        wait_for(3, OCCUPIED)
+        self.assertEqual(store.get(3).is_occupied, 1)
+
+        # Empty once the customer closes it again; the code is spent on opening
+        self.assertTrue(tracker.begin_pickup(3))
+        tracker.watch_pulse(3, self.hw.open_locker(3))
+        wait_for(3, PICKUP_OPEN)
+        self.assertIsNone(store.get(3).otp_code)
+        self.hw.mock_close_door(3)
+        wait_for(3, IDLE)
+        self.assertEqual(store.get(3).is_occupied, 0)
+
+        # A door that never opens is rolled back
+        tracker.begin_delivery(4, '222222')
+        pulse = Future()
+        pulse.set_result(4)
+        tracker.watch_pulse(4, pulse)
+        wait_for(4, IDLE)
+        self.assertIsNone(store.get(4).otp_code)
+        monitor.detach()
+
+    def test_expiry_never_overwrites_an_uncommitted_pickup(self):
+        from database import db_connection
+        store = LockerStore()
+        store.load()
+        expired = time.time() - 1
+        store.update(5, state=OCCUPIED, is_occupied=1, otp_code='333333', otp_expires_at=expired)
+        tracker = OccupancyTracker(store, DoorMonitor()) # Loop not started: the sweep runs by hand
+        tracker._expiries = [(expired, 5, '333333')]
+
+        with db_connection():
+            self.assertTrue(tracker.begin_pickup(5))
+            sweep = threading.Thread(target=tracker._expire_codes)
+            sweep.start()
+            sweep.join(timeout=0.2)
+            self.assertTrue(sweep.is_alive()) # Its UPDATE waits for the pickup's transaction
+        sweep.join(timeout=5)
+        self.assertEqual(tracker.state(5), PICKUP_OPENING)
+        self.assertEqual(len(tracker._expiries), 1) # Decided again once the door has settled
+
+    def test_otp_expiry_rebuilt_at_start(self):
+        store = LockerStore()
+        store.load()
+        now = time.time()
+        store.update(6, state=OCCUPIED, is_occupied=1, otp_code='333333', otp_expires_at=now - 1)
+        store.update(7, state=OCCUPIED, is_occupied=1, otp_code='444444', otp_expires_at=now + 0.3)
+        store.update(8, state=OCCUPIED, is_occupied=1, otp_code='555555') # Issued before expiry existed
+        monitor = DoorMonitor()
+        monitor.attach(self.hw)
+        tracker = OccupancyTracker(store, monitor, otp_lifetime_s=3600)
+        tracker.start()
+
+        deadline = time.monotonic() + 2
+        while tracker.state(7) != RETURN_DUE and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(tracker.state(6), RETURN_DUE)
+        self.assertEqual(tracker.state(7), RETURN_DUE)
+        self.assertIsNone(store.get(7).otp_code)
+        self.assertEqual(tracker.state(8), OCCUPIED)
+        self.assertGreater(store.get(8).otp_expires_at, now + 3000)
+
+        # Only the courier can take it back
+        self.assertFalse(tracker.begin_pickup(6))
+        self.assertTrue(tracker.begin_pickup(6, returning=True))
+        monitor.detach()
+
+    def test_audit_log_batches_compacts_and_replays(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # Left over from yesterday: numbering resumes after it
+        yesterday = time.time() - 86400
+        with open(os.path.join(directory, 'current.jsonl'), 'w') as f:
+            f.write(json.dumps({'seq': 1, 'ts': yesterday, 'kind': 'door', 'locker_id': 1, 'closed': False}) + '\n')
+
+        store = LockerStore()
+        store.load()
+        log = AuditLog(flush_interval_s=0.05)
+        log.open(directory)
+        log.snapshot(store)
+        store.subscribe(log.locker_changed)
+        store.update(2, is_occupied=1, otp_code='123456')
+        log.record('door', 2, closed=True)
+        self.assertTrue(log.flush())
+
+        # The first batch after midnight moved yesterday into its segment
+        self.assertEqual(len(log.segments()), 1)
+        self.assertEqual([event['seq'] for event in log.events()], [1, 2, 3, 4])
+
+        lockers = replay(log.events())
+        self.assertEqual(lockers[2]['otp_code'], '123456')
+        self.assertEqual(lockers[2]['is_occupied'], 1)
+        self.assertEqual(lockers[1]['otp_code'], None)
+        self.assertEqual(replay(log.events(), until=yesterday), {}) # No snapshot yet
+
+    def test_attempt_limiter(self):
+        limiter = AttemptLimiter('test', per_minute=60, burst=3, lockout_after=2, lockout_s=10,
+                                 shared_lockout_s=1, shared_lockout_max_s=4, max_clients=2)
+        self.assertEqual([limiter.check('a') for _ in range(5)], [0] * 5) # Successes are free
+        # Kiosk: a shorter lockout, still escalating
+        self.assertEqual([limiter.failed('a', shared=True) for _ in range(5)], [0, 1, 2, 4, 4])
+        self.assertGreater(limiter.check('a'), 0.5)
+
+        # Progressive lockout
+        self.assertEqual(limiter.failed('b'), 0)
+        self.assertEqual(limiter.failed('b'), 10)
+        self.assertEqual(limiter.failed('b'), 20)
+        self.assertGreater(limiter.check('b'), 19)
+        limiter.succeeded('b')
+        self.assertEqual(limiter.failed('b'), 0) # Count cleared
+
+        # Bounded LRU: the least recently seen client is forgotten
+        limiter.check('c')
+        self.assertEqual(list(limiter._clients), ['b', 'c'])
+
+        # Global window across clients
+        shared = AttemptLimiter('test', per_minute=60, burst=3, global_per_minute=2)
+        self.assertEqual([shared.check(client) for client in 'xy'], [0, 0])
+        self.assertGreater(shared.check('z'), 0)
+
+    def _app_client(self):
+        # The app sets up its database, hardware and audit log on import
+        import audit
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        audit.AUDIT_DIR = directory
+        from app import app
+        self.addCleanup(audit.audit_log.flush)
+        return app.test_client()
+
+    def test_kiosk_code_guesses_lock_out(self):
+        client = self._app_client()
+        from app import code_limiter, LOCKOUT_AFTER_FAILURES
+        code_limiter._clients.clear() # The test client is 127.0.0.1, like the kiosk
+        self.addCleanup(code_limiter._clients.clear)
+        for _ in range(LOCKOUT_AFTER_FAILURES):
+            self.assertEqual(client.post('/customer/pickup', data={'otp': '000000'}).status_code, 200)
+        response = client.post('/customer/pickup', data={'otp': '000000'})
+        self.assertEqual(response.status_code, 429)
+        self.assertLessEqual(int(response.headers['Retry-After']), 5)
+
+    def test_bulk_delivery(self):
+        client = self._app_client()
+        response = client.post('/api/deliveries', json={'lockers': [5, 6]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([locker['id'] for locker in response.get_json()['lockers']], [5, 6])
+        response = client.post('/api/deliveries', json={'count': 2, 'size': 'M'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()['lockers']), 2)
+
+        # Let the app's doors open before the next test swaps the database under it
+        from app import occupancy
+        deadline = time.monotonic() + 5
+        loaded = [5, 6] + [locker['id'] for locker in response.get_json()['lockers']]
+        while any(occupancy.state(i) != DELIVERY_OPEN for i in loaded) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        for body in ({'lockers': [True]}, {'count': True}): # Booleans are not ids or counts
+            response = client.post('/api/deliveries', json=body)
+            self.assertEqual(response.status_code, 400, body)
+
+    def test_delivery_lifetime_must_be_finite(self):
+        client = self._app_client()
+        for body in ('{"count": 1, "lifetime_hours": NaN}', '{"count": 1, "lifetime_hours": Infinity}',
+                     '{"count": 1, "lifetime_hours": 1e306}'): # Overflows to inf in seconds
+            for url in ('/api/deliveries', '/api/assign_locker'):
+                response = client.post(url, data=body, content_type='application/json')
+                self.assertEqual(response.status_code, 400, (url, body))
+
+    def test_delivery_rejects_malformed_bodies(self):
+        client = self._app_client()
+        for body in ('[1, 2]', '"x"', '3'):
+            for url in ('/api/deliveries', '/api/assign_locker'):
+                response = client.post(url, data=body, content_type='application/json')
+                self.assertEqual(response.status_code, 400, (url, body))
+                self.assertFalse(response.get_json()['success'])
+        response = client.post('/api/deliveries', json={'count': 10 ** 9})
+        self.assertEqual(response.status_code, 400)
+
+    def test_translation_catalog(self):
+        catalog = TranslationCatalog()
+        catalog.load()
+        self.assertIn('ar', catalog)
+        self.assertEqual(catalog.get('ar').dir, 'rtl')
+        self.assertEqual(catalog.get('xx').code, 'fr') # Unknown -> default
+        # Every language has every key of the default language
+        self.assertLessEqual(set(catalog.get('fr').strings), set(catalog.get('ar').strings))
+
+    def test_fragment_cache_versions(self):
+        cache = FragmentCache()
+        renders = []
+        render = lambda: renders.append(1) or '<b>grid</b>'
+        cache.get_or_render(('grid', 'fr'), 1, render)
+        html = cache.get_or_render(('grid', 'fr'), 1, render)
+        cache.get_or_render(('grid', 'ar'), 1, render)
+        cache.get_or_render(('grid', 'fr'), 2, render)
+        self.assertEqual(str(html), '<b>grid</b>')
+        self.assertEqual((len(renders), cache.hits), (3, 1))
+
+    def test_actuator_priorities_and_coalescing(self):
+        import threading
+        gate = threading.Event()
+        opened = []
+        class SlowHardware:
+            def open_locker(self, locker_id):
+                gate.wait(2)
+                opened.append(locker_id)
+        actuator = HardwareActuator(SlowHardware())
+        first = actuator.open_locker(1) # Occupies the actuator thread
+        time.sleep(0.05)
+        delivery = actuator.open_locker(2, PRIORITY_DELIVERY)
+        actuator.open_locker(3, PRIORITY_DELIVERY)
+        pickup = actuator.open_locker(2, PRIORITY_PICKUP) # Coalesced and promoted
+        actuator.open_locker(4, PRIORITY_PICKUP)
+        self.assertIs(pickup, delivery)
+        self.assertEqual(actuator.queue_depth, 3)
+
+        gate.set()
+        first.result(timeout=2)
+        delivery.result(timeout=2)
+        actuator.submit(lambda hw: None).result(timeout=2)
+        self.assertEqual(opened, [1, 2, 4, 3])
+
+        swapped = actuator.replace(MockMCP23017).result(timeout=2)
+        self.assertIs(actuator.hardware, swapped)
+
+    def test_actuator_pulse_budget(self):
+        hw = MockMCP23017(locker_count=4, pulse_ms=50)
+        energised = []
+        set_relay = hw._set_relay
+        def track(idx, state):
+            set_relay(idx, state)
+            energised.append(sum(hw.relays))
+        hw._set_relay = track
+        actuator = HardwareActuator(hw, max_concurrent_pulses=2)
+        pulses = [actuator.open_locker(locker_id) for locker_id in (1, 2, 3, 4)]
+        for pulse in pulses:
+            pulse.result(timeout=2)
+        self.assertEqual(max(energised), 2)
+        self.assertEqual(actuator.active_pulses, 0)
+
+    def test_metrics_exposition(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram('op_seconds', 'Latency.', ('operation',), buckets=(0.01, 0.1))
+        errors = registry.counter('errors_total', 'Errors.', ('address',))
+        latency.observe(0.005, 'open')
+        latency.observe(0.05, 'open')
+        errors.inc('0x20')
+        text = registry.render()
+        self.assertIn('op_seconds_bucket{operation="open",le="0.01"} 1', text)
+        self.assertIn('op_seconds_bucket{operation="open",le="+Inf"} 2', text)
+        self.assertIn('op_seconds_count{operation="open"} 2', text)
+        self.assertIn('errors_total{address="0x20"} 1', text)
+
+    def test_request_profiler_splits_time(self):
+        from flask import Flask, render_template_string
+        from database import db_connection
+        from profiling import (RequestProfiler, request_seconds, request_component_seconds,
+                               request_sql_statements)
+        app = Flask(__name__)
+        RequestProfiler(app, sample_rate=1, slow_ms=None)
+
+        @app.route('/profiled')
+        def profiled():
+            with db_connection() as conn:
+                conn.execute('SELECT COUNT(*) FROM lockers').fetchone()
+                conn.execute('SELECT * FROM lockers WHERE id = ?', (1,)).fetchone()
+                conn.execute("UPDATE lockers SET is_occupied = is_occupied WHERE id = 1")
+            time.sleep(0.05)
+            return render_template_string('{{ n }}', n=1)
+
+        with db_connection():
+            pass # Pooled connection ready, so its PRAGMAs aren't counted
+        self.assertEqual(app.test_client().get('/profiled').status_code, 200)
+        self.assertEqual(request_sql_statements.value('profiled'), 3)
+        self.assertEqual(request_seconds.count('profiled'), 1)
+        total = request_seconds._series[('profiled',)][-2]
+        db = request_component_seconds.value('profiled', 'db')
+        template = request_component_seconds.value('profiled', 'template')
+        self.assertGreater(db, 0)
+        self.assertGreater(template, 0)
+        self.assertEqual(request_component_seconds.value('profiled', 'hardware'), 0)
+        self.assertGreaterEqual(total, 0.05)
+        self.assertLess(db + template, total - 0.04) # The sleep is in neither
+
+    def test_simulator_door_cycle(self):
+        sim = HardwareSimulator(locker_count=8, close_delay_s=(1.0, 2.0))
+        bus = sim.bus(1)
+        bus.write_byte_data(0x20, 0x00, 0x00)  # Port A outputs
+        bus.write_byte_data(0x20, 0x14, 0x01)  # Energise locker 1
+        sim.clock.advance(0.05)
+        bus.write_byte_data(0x20, 0x14, 0x00)  # Too short to unlatch
+        self.assertTrue(sim.door_closed(1))
+        self.assertEqual(sim.short_pulses, 1)
+
+        bus.write_byte_data(0x20, 0x14, 0x01)
+        sim.clock.advance(0.2)
+        self.assertFalse(sim.door_closed(1))
+        self.assertEqual(bus.read_byte_data(0x20, 0x13) & 0x01, 1)  # Sensor reads open
+        bus.write_byte_data(0x20, 0x14, 0x00)
+        sim.clock.advance(2.0)
+        self.assertTrue(sim.door_closed(1))
+        self.assertGreater(sim.clock.now(), 2.25)  # Transactions take bus time
+
+        sim.error_rate = 1.0
+        with self.assertRaises(OSError):
+            bus.read_byte_data(0x20, 0x13)
+
+    def test_door_snapshot_matches_single_reads(self):
+        sim = HardwareSimulator(locker_count=24, close_delay_s=None) # Three chips
+        hw = sim.hardware()
+        self.addCleanup(hw.close)
+        self.assertTrue(hw.wait_ready(timeout=5))
+        for locker_id in (2, 11, 24):
+            locker = sim.lockers[locker_id]
+            with sim.lock:
+                locker.closed = False
+                locker.chip.set_input(locker.sensor_pin, 1)
+
+        states = hw.get_all_lockers_states()
+        self.assertEqual(sorted(states), list(range(1, 25)))
+        self.assertEqual({locker_id for locker_id, closed in states.items() if not closed}, {2, 11, 24})
+        self.assertEqual(states, {locker_id: hw.read_door_state(locker_id) for locker_id in states})
+
+    def test_output_latch_follows_new_hardware(self):
+        first, second = HardwareSimulator(locker_count=8), HardwareSimulator(locker_count=8)
+        old_hw = first.hardware()
+        self.assertTrue(old_hw.wait_ready(timeout=5))
+        hw = second.hardware() # Takes the chip over
+        self.assertTrue(hw.wait_ready(timeout=5))
+        hw.open_locker(1).result(timeout=2)
+        self.assertEqual((first.lockers[1].pulses, second.lockers[1].pulses), (0, 1))
+
+        latch = hw.mcp_chips[(1, 0x20)].latch
+        old_hw.close()  # No longer the owner: reconciliation goes on
+        self.assertIsNotNone(latch.reconcile_timer)
+        hw.close()
+        self.assertIsNone(latch.reconcile_timer)
+
+    def test_chip_health_recovery(self):
+        sim = HardwareSimulator(locker_count=8)
+        hw = sim.hardware()
+        self.addCleanup(hw.close)
+        self.assertTrue(hw.wait_ready(timeout=5))
+        chip, simulated = hw.mcp_chips[(1, 0x20)], sim.chips[(1, 0x20)]
+        chip.latch.set_pin(7, True)
+        self.addCleanup(chip.latch.set_pin, 7, False)
+
+        # Checks are run by hand; the health thread sleeps between its own
+        sim.brownout(0x20)
+        self.assertEqual(simulated._word(simulated.IODIRA), 0xFFFF)
+        hw._check_chips()
+        self.assertEqual(simulated._word(simulated.IODIRA), chip.iodir) # Reprogrammed
+        self.assertEqual(simulated.registers[simulated.OLATA], 0x80) # Latch restored from the shadow
+        self.assertEqual(hw.health()['chips'][0]['resets'], 1)
+
+        sim.disconnect(0x20)
+        for _ in range(MCP_HEALTH_FAILURES):
+            hw._check_chips()
+        self.assertEqual(hw.health()['chips'][0]['state'], 'down')
+        self.assertNotIn((1, 0x20), hw.mcp_chips)
+
+        sim.disconnect(0x20, online=True)
+        hw._check_chips()
+        self.assertEqual(hw.health()['chips'][0]['state'], 'up')
+        self.assertIn((1, 0x20), hw.mcp_chips)
+
+    def test_input_only_chip_reset_detected(self):
+        sim = HardwareSimulator(locker_count=9)
+        config = {1: dict(sim.locker_config()[1]),
+                  9: {'type': 'mcp', 'pin': 8, 'sensor_pin': 8, 'address': 0x21, 'bus': 1}} # Sensor only
+        hw = HybridHardware(locker_config=config, bus_factory=sim.bus, bus_settle_s=0)
+        self.addCleanup(hw.close)
+        self.assertTrue(hw.wait_ready(timeout=5))
+        simulated = sim.chips[(1, 0x21)]
+        self.assertEqual(simulated._word(simulated.IODIRA), 0xFFFF)
+
+        sim.brownout(0x21) # IODIR reads the same, only the pull-ups are gone
+        hw._check_chips()
+        self.assertEqual(simulated._word(simulated.GPPUA), 0xFFFF)
+        self.assertEqual(hw.health()['chips'][1]['resets'], 1)
+
+    def test_reconfigure_touches_only_rewired_chips(self):
+        sim = HardwareSimulator(locker_count=20) # Chips 0x20 and 0x21 full, 0x22 half
+        hw = sim.hardware()
+        self.addCleanup(hw.close)
+        self.assertTrue(hw.wait_ready(timeout=5))
+        chips = dict(hw.mcp_chips)
+
+        config = sim.locker_config()
+        config[1] = dict(config[1], pulse_ms=120)
+        transactions = sim.transactions
+        self.assertEqual(hw.reconfigure(config), {1})
+        self.assertEqual(sim.transactions, transactions) # Pulse width only: no bus traffic
+        self.assertEqual(hw.mcp_chips, chips)
+
+        config = dict(config) # reconfigure keeps the dict it was given
+        config[16] = dict(config[16], address=0x22, pin=4, sensor_pin=12)
+        self.assertEqual(hw.reconfigure(config), {16})
+        self.assertIs(hw.mcp_chips[(1, 0x20)], chips[(1, 0x20)]) # Untouched chip kept as is
+        self.assertIsNot(hw.mcp_chips[(1, 0x21)], chips[(1, 0x21)])
+        self.assertIsNot(hw.mcp_chips[(1, 0x22)], chips[(1, 0x22)])
+        self.assertEqual(hw.mcp_pins[16][0].address, 0x22)
+
+    def test_second_hardware_owner_refused(self):
+        import hardware
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lock_file = os.path.join(directory, 'hardware.lock')
+        owner = subprocess.Popen(
+            [sys.executable, '-c', f'import hardware; hardware.claim_hardware({lock_file!r}); print("ready", flush=True); input()'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.addCleanup(owner.wait, 5)
+        self.addCleanup(owner.stdin.close)
+        self.assertEqual(owner.stdout.readline().strip(), 'ready')
+
+        self.assertIsNone(hardware._hardware_lock)
+        with self.assertRaisesRegex(RuntimeError, f'process {owner.pid}'):
+            hardware.claim_hardware(lock_file)
+        self.assertIsNone(hardware._hardware_lock)
+
     def test_database_init(self):
         conn = get_db_connection()
         count = conn.execute('SELECT count(*) FROM lockers').fetchone()[0]
-        self.assertEqual(count, 16)
+        self.assertEqual(count, 32)
+        conn.close()
+
+    def test_database_grows_to_locker_count(self):
+        init_db(locker_count=40)
+        conn = get_db_connection()
+        count = conn.execute('SELECT count(*) FROM lockers').fetchone()[0]
+        locker = conn.execute('SELECT * FROM lockers WHERE id = 40').fetchone()
         conn.close()
+        self.assertEqual(count, 40)
+        self.assertEqual((locker['hardware_type'], locker['mcp_address'], locker['gpio_pin']), ('mcp', 0x22, 1))
 
 if __name__ == '__main__':
     unittest.main()